@@ -31,8 +31,20 @@ DEFAULTS = {
         "direct_base_url": "http://cjis.lincoln.ne.gov/~ACC",
     },
     "database": {
-        "uri": "sqlite:///crashes.sqlite",
+        "uri": "json:",
         "dumpdir": "db_dump",
+        "journal": False,
+        "cache_size": "4096",
+        "compact": False,
+        "sharding": {
+            "by": "prefix",
+            "length": 2,
+            "prefixes": ["NDOR"],
+        },
+        # shards written past this many bytes are split; 0 never
+        # splits them
+        "max_shard_size": "0",
+        "compression": None,
     },
     "files": {
         "datadir": "data",
@@ -43,6 +55,7 @@ DEFAULTS = {
         "bike_route_geojson": "bike-paths.geojson",
         "csvdir": "csv",
         "layout": "layout.yml",
+        "parse_cache": "parse-cache",
         "fixtures": "fixtures",
         "db": "db",
     },
@@ -121,6 +134,8 @@ def parse_args():
         _get_config("files", "graph_data"), options.datadir)
     options.csvdir = _canonicalize(_get_config("files", "csvdir"), os.getcwd())
     options.layout = _canonicalize(_get_config("files", "layout"), os.getcwd())
+    options.parse_cache = _canonicalize(
+        _get_config("files", "parse_cache"), options.datadir)
     options.fixtures = _canonicalize(
         _get_config("files", "fixtures"), options.datadir)
     options.dbdir = _canonicalize(_get_config("files", "db"), options.datadir)
@@ -133,6 +148,31 @@ def parse_args():
     options.database = _get_config("database", "uri")
     options.dumpdir = _canonicalize(
         _get_config("database", "dumpdir"), options.datadir)
+    options.database_journal = bool(_get_config("database", "journal"))
+    options.database_cache_size = int(_get_config("database", "cache_size"))
+    options.database_compact = bool(_get_config("database", "compact"))
+    try:
+        options.database_sharding = db.make_sharding(
+            max_size=int(_get_config("database", "max_shard_size")),
+            **_get_config("database", "sharding"))
+    except ValueError as err:
+        parser.error(str(err))
+
+    # either a single compression format for every database, or a
+    # dict of database name to format
+    compression = _get_config("database", "compression")
+    if not isinstance(compression, dict):
+        compression = {
+            os.path.splitext(d.filename)[0]: compression
+            for d in db.DATABASES
+        }
+    try:
+        options.database_compression = {
+            name: db.get_compression(fmt)
+            for name, fmt in compression.items()
+        }
+    except ValueError as err:
+        parser.error(str(err))
 
     options.func = options.command(options)
     return options
@@ -141,7 +181,16 @@ def parse_args():
 def main():
     options = parse_args()
     log.setup_logging(options.verbose)
-    db.init(options.dbdir, options.fixtures)
+    db.init(
+        options.dbdir,
+        options.fixtures,
+        uri=options.database,
+        journal=options.database_journal,
+        cache_size=options.database_cache_size,
+        compact=options.database_compact,
+        sharding=options.database_sharding,
+        compression=options.database_compression,
+        read_only=options.command.read_only)
 
     if not os.path.exists(options.datadir):
         LOG.info("Creating datadir %s", options.datadir)
@@ -156,7 +205,11 @@ def main():
         LOG.info("Creating geocoding directory %s", options.geocoding)
         os.makedirs(options.geocoding)
 
-    return options.func()
+    retval = options.func()
+    for database in db.DATABASES:
+        LOG.debug("Record cache for %s: %s", database.filename,
+                  database.cache_info())
+    return retval
 
 
 if __name__ == "__main__":
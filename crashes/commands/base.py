@@ -22,6 +22,10 @@ class Command(object):
 
     arguments = []
 
+    # commands that never change the databases read them from
+    # snapshots of the deserialized records, which is much faster
+    read_only = False
+
     def __init__(self, options):
         self.options = options
 
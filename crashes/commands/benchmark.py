@@ -0,0 +1,510 @@
+"""Benchmark the database and parser against the real data."""
+
+from __future__ import print_function
+
+import contextlib
+import glob
+import logging
+import os
+import random
+import shutil
+import tempfile
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import yaml
+
+from crashes.commands import base
+from crashes.commands import parse
+from crashes import db
+from crashes import utils
+
+LOG = logging.getLogger(__name__)
+
+
+def _uri(scheme, path):
+    return "%s:///%s" % (scheme, os.path.abspath(path))
+
+
+def _time(func, *args):
+    """Time a single call to a function, in milliseconds."""
+    start = timeit.default_timer()
+    func(*args)
+    return (timeit.default_timer() - start) * 1000
+
+
+def _time_each(func, items):
+    """Time calling a function with each of a list of items, in
+    milliseconds per item."""
+    return _time(lambda: [func(i) for i in items]) / len(items)
+
+
+def _consume(iterable):
+    for _ in iterable:
+        pass
+
+
+@contextlib.contextmanager
+def _scratch_copy(database):
+    """Copy the files of a JSON database to a temporary directory.
+
+    Benchmarks change the data, so they must never run against the
+    real database.
+    """
+    name = os.path.splitext(database.filename)[0]
+    scratch = tempfile.mkdtemp(prefix="crashes-benchmark-")
+    try:
+        for filepath in glob.glob(
+                os.path.join(database.backend.location, "%s*" % name)):
+            shutil.copy(filepath, scratch)
+        yield scratch
+    finally:
+        shutil.rmtree(scratch)
+
+
+def _fresh(uri, **settings):
+    """Get a copy of the collisions database at a URI, with the given
+    attributes set, and nothing read or cached yet."""
+    database = db.collisions.using(uri)
+    for name, value in settings.items():
+        setattr(database, name, value)
+    database._reset()  # pylint: disable=protected-access
+    return database
+
+
+def _backend_uris(scratch):
+    """Copy the collisions in a scratch directory to an SQLite database
+    next to them, and get the URIs of both, by backend name."""
+    uris = [("json", _uri("json", scratch)),
+            ("sqlite", _uri("sqlite", os.path.join(scratch,
+                                                   "crashes.sqlite")))]
+    sqlite = db.collisions.using(uris[1][1])
+    sqlite.backend.extend(db.collisions.using(uris[0][1]).backend)
+    sqlite.sync()
+    return uris
+
+
+def _probe_decode(serializers, record):
+    """Decode a record by offering each value to each serializer.
+
+    This is how records were decoded before Codec, kept to benchmark
+    against.
+    """
+    retval = {}
+    for key, val in record.items():
+        for serializer in serializers:
+            try:
+                retval[key] = serializer.deserialize(val)
+                break
+            except db.DeserializationNotSupported:
+                pass
+        else:
+            retval[key] = val
+    return retval
+
+
+def _probe_encode(serializers, record):
+    retval = {}
+    for key, val in record.items():
+        for serializer in serializers:
+            try:
+                retval[key] = serializer.serialize(val)
+                break
+            except db.SerializationNotSupported:
+                pass
+        else:
+            retval[key] = val
+    return retval
+
+
+def _scan_layout(parser, coords, page_name):
+    """Find the layout objects that contain the coordinates by checking
+    every skip region and object of the page type.
+
+    This is how objects were found before the layout was indexed, kept
+    to benchmark against.
+    """
+    # pylint: disable=protected-access
+    for skip_coords in parser.layout["skip"].get(page_name, []):
+        if skip_coords.contains(coords, fuzz=parser._skip_fuzz):
+            return {}
+    return {
+        name: obj
+        for name, obj in parser.layout["objects"][page_name].items()
+        if obj["coordinates"].contains(coords, fuzz=parser._obj_fuzz)
+    }
+
+
+def _find_in_layout(parser, coords, page_name):
+    # pylint: disable=protected-access
+    if parser._find_skip_region(coords, page_name) is not None:
+        return {}
+    return parser._find_candidates(coords, page_name)
+
+
+def _print_table(title, columns, rows):
+    width = max([12] + [len(label) + 1 for label, _ in rows])
+    print(title)
+    print(" " * width + "".join("%14s" % c for c in columns))
+    for label, values in rows:
+        print(label.ljust(width) + "".join(
+            "%14.2f" % v if isinstance(v, float) else "%14s" % v
+            for v in values))
+    print()
+
+
+def _compare(title, columns, variants, measure, total=False):
+    """Measure each of several variants, and print a table with a row
+    of measurements for each.
+
+    ``variants`` is a list of (label, value) pairs; ``measure`` is
+    called with each value, and gives the values of its row. If
+    ``total`` is set, a last row adds up each column.
+    """
+    rows = [(label, tuple(measure(value))) for label, value in variants]
+    if total:
+        columns_values = zip(*(values for _, values in rows))
+        rows.append(("total", tuple(sum(c) for c in columns_values)))
+    _print_table(title, columns, rows)
+
+
+class Benchmark(base.Command):
+    """Benchmark the database and parser against the real data."""
+
+    arguments = [
+        base.Argument(
+            "benchmarks",
+            nargs="*",
+            help="Benchmarks to run (default: all of them)"),
+        base.Argument(
+            "--sample",
+            type=int,
+            default=100,
+            help="Number of records to look up and update "
+            "(default: %(default)s)"),
+        base.Argument(
+            "--bandwidth",
+            type=float,
+            default=10.0,
+            help="Read bandwidth of the storage to estimate load times "
+            "for, in MB/s (default: %(default)s)"),
+    ]
+
+    def _get_benchmarks(self):
+        available = sorted(
+            name[len("benchmark_"):] for name in dir(self)
+            if name.startswith("benchmark_"))
+        for name in self.options.benchmarks:
+            if name not in available:
+                raise SystemExit("Unknown benchmark %s; choose from %s" %
+                                 (name, ", ".join(available)))
+        return self.options.benchmarks or available
+
+    def _sample_keys(self, database):
+        keys = [r[database.key] for r in database.backend]
+        return random.sample(keys, min(self.options.sample, len(keys)))
+
+    def benchmark_storage(self):
+        """Compare load, lookup, and update times of storage backends."""
+        with _scratch_copy(db.collisions) as scratch:
+            uris = _backend_uris(scratch)
+            keys = self._sample_keys(db.collisions.using(uris[0][1]))
+
+            def measure(uri):
+                load = _time(_consume, db.collisions.using(uri))
+                database = db.collisions.using(uri)
+                return (load, _time(database.get, keys[0]),
+                        _time_each(database.get, keys),
+                        _time_each(
+                            lambda k: database.merge({
+                                database.key: k,
+                                "benchmark": 1
+                            }), keys))
+
+            _compare(
+                "Storage backends: %s records, times in ms" %
+                len(db.collisions), ("load", "cold lookup", "lookup",
+                                     "update"), uris, measure)
+
+    def benchmark_projection(self):
+        """Compare full scans with scans of only a few fields."""
+        fields = ["case_no", "date", "road_location"]
+        with _scratch_copy(db.collisions) as scratch:
+
+            def measure(uri):
+                database = _fresh(uri, cache_size=0)
+                _consume(database)
+                return (_time(_consume, database),
+                        _time(_consume, database.iter(fields=fields)))
+
+            _compare(
+                "Projection: %s records, %s fields, times in ms" %
+                (len(db.collisions), len(fields)),
+                ("full scan", "projected"), _backend_uris(scratch), measure)
+
+    def benchmark_codec(self):
+        """Compare serializer probing with the tag-dispatch codec."""
+        records = list(db.collisions.backend)
+        codec = db.collisions.codec
+        serializers = db.collisions.serializers
+        decoded = [codec.decode(r) for r in records]
+
+        def measure(funcs):
+            decode, encode = funcs
+            return (1000 / _time_each(decode, records),
+                    1000 / _time_each(encode, decoded))
+
+        _compare(
+            "Record codec: %s records, records/second" % len(records),
+            ("decode", "encode"),
+            [("probing", (lambda r: _probe_decode(serializers, r),
+                          lambda r: _probe_encode(serializers, r))),
+             ("codec", (codec.decode, codec.encode))], measure)
+
+    def benchmark_cache(self):
+        """Compare repeated scans and lookups with and without the
+        record cache."""
+        keys = self._sample_keys(db.collisions)
+        count = len(db.collisions)
+
+        def measure(cache_size):
+            database = _fresh(db.collisions.uri, cache_size=cache_size)
+            scan = _time(lambda: [_consume(database) for _ in range(3)])
+            lookup = _time_each(database.get, keys * 3)
+            info = database.cache_info()
+            return (scan / 3, lookup, info.hits, info.misses)
+
+        _compare("Record cache: %s records, times in ms" % count,
+                 ("scan", "lookup", "hits", "misses"),
+                 [("%s records" % n, n) for n in (0, count // 2, count)],
+                 measure)
+
+    def benchmark_memory(self):
+        """Compare the memory used by plain and compact records."""
+        if tracemalloc is None:
+            LOG.warning("tracemalloc is not available, skipping memory "
+                        "benchmark")
+            return
+
+        def measure(compact):
+            database = _fresh(db.collisions.uri, compact=compact)
+            tracemalloc.start()
+            try:
+                load = _time(len, database)
+                size = tracemalloc.get_traced_memory()[0]
+            finally:
+                tracemalloc.stop()
+            return (size / 1024.0 / 1024.0, float(size // len(database)),
+                    load)
+
+        _compare(
+            "Record memory: %s records, with tracemalloc" %
+            len(db.collisions), ("MiB", "bytes/record", "load (ms)"),
+            [("plain", False), ("compact", True)], measure)
+
+    def benchmark_stream(self):
+        """Compare a full scan of loaded records with one of streamed
+        records."""
+
+        def measure(stream):
+            database = _fresh(db.collisions.uri, cache_size=0)
+            if tracemalloc is None:
+                return (_time(_consume, database.iter(stream=stream)), "n/a")
+            tracemalloc.start()
+            try:
+                scan = _time(_consume, database.iter(stream=stream))
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            return (scan, peak / 1024.0 / 1024.0)
+
+        _compare(
+            "Streaming: %s records, scan time in ms" % len(db.collisions),
+            ("scan", "peak MiB"), [("loaded", False), ("streamed", True)],
+            measure)
+
+    def benchmark_sharding(self):
+        """Compare the cost of saving single-record updates with whole
+        shards and with shards split to the configured maximum size."""
+        sharding = db.collisions.sharding
+        with _scratch_copy(db.collisions) as scratch:
+
+            def measure(max_size):
+                database = db.collisions.using(_uri("json", scratch))
+                database.sharding = db.make_sharding(
+                    max_size=max_size, **sharding.config())
+                shards = database.rebalance()
+                written = []
+
+                def update(key):
+                    database.merge({database.key: key, "benchmark": 1})
+                    # pylint: disable=protected-access
+                    written.append(
+                        os.path.getsize(
+                            database.backend._get_filepath(
+                                suffix=database.backend.key_shard(key))))
+
+                elapsed = _time_each(update, self._sample_keys(database))
+                return (len(shards), sum(written) / 1024.0 / len(written),
+                        elapsed)
+
+            _compare(
+                "Sharding: %s records, %r" % (len(db.collisions), sharding),
+                ("shards", "KiB written", "update (ms)"),
+                [("whole", None), ("split", sharding.max_size or 65536)],
+                measure)
+
+    def benchmark_compression(self):
+        """Compare load and save times, and sizes on disk, of shards
+        written with each compression format."""
+        formats = [("none", None)] + [
+            (name, db.COMPRESSION[name]) for name in sorted(db.COMPRESSION)
+            if db.COMPRESSION[name].available
+        ]
+        with _scratch_copy(db.collisions) as scratch:
+
+            def measure(compression):
+                database = db.collisions.using(_uri("json", scratch))
+                database.compression = compression
+                _consume(database.backend)
+                save = _time(database.sync)
+
+                # pylint: disable=protected-access
+                size = sum(
+                    os.path.getsize(database.backend._get_filepath(suffix=s))
+                    for s in database.backend.shards())
+                database._reset()
+                load = _time(_consume, database.backend)
+                # reading the files over slower storage takes this much
+                # longer again
+                slow_load = load + size / (self.options.bandwidth * 1000)
+                return (load, save, size / 1024.0, slow_load)
+
+            _compare(
+                "Shard compression: %s records, times in ms" %
+                len(db.collisions),
+                ("load", "save", "KiB", "at %gMB/s" % self.options.bandwidth),
+                formats, measure)
+
+    def benchmark_bulk(self):
+        """Compare changing records one at a time with the bulk
+        operations."""
+        with _scratch_copy(db.collisions) as scratch:
+            database = db.collisions.using(_uri("json", scratch))
+            keys = self._sample_keys(database)
+            records = [database[k] for k in keys]
+
+            def partial(i):
+                return [{database.key: k, "benchmark": i} for k in keys]
+
+            def new(prefix):
+                return [{
+                    database.key: "%s-%05d" % (prefix, i)
+                } for i in range(len(keys))]
+
+            def measure(operation):
+                one, bulk, first, second = operation
+                return (1000 / _time_each(one, first),
+                        len(second) / (_time(bulk, second) / 1000))
+
+            _compare(
+                "Bulk operations: %s records, records/second" %
+                len(db.collisions), ("one at a time", "bulk"),
+                [("merge", (database.merge, database.merge_many, partial(1),
+                            partial(2))),
+                 ("update", (database.update, database.update_many, records,
+                             records)),
+                 ("upsert", (database.upsert, database.upsert_many,
+                             records + new("U1"), records + new("U2"))),
+                 ("append", (database.append, database.append_many,
+                             new("A1"), new("A2")))], measure)
+
+    def benchmark_snapshot(self):
+        """Compare a full scan that deserializes the shards with one
+        from a snapshot, both as it's built and once it has been."""
+        with _scratch_copy(db.collisions) as scratch:
+
+            def measure(read_only):
+                database = _fresh(
+                    _uri("json", scratch), read_only=read_only, cache_size=0)
+                return (_time(_consume, database), _time(_consume, database))
+
+            _compare(
+                "Snapshot: %s records, times in ms" % len(db.collisions),
+                ("first scan", "next scan"),
+                [("json", False), ("build snapshot", True),
+                 ("snapshot", True)], measure)
+
+    def benchmark_layout(self):
+        """Compare finding the layout objects for the text on each page
+        type by checking every object, by looking them up in the
+        spatial index, and by matching the whole page at once."""
+        parser = parse.Parser(self.options)
+
+        def measure(page_name):
+            # a page with every field filled in, and text in every skip
+            # region
+            boxes = [
+                o["coordinates"]
+                for o in parser.layout["objects"][page_name].values()
+            ] + parser.layout["skip"].get(page_name, [])
+            page = [
+                parse.Coordinates(b.xmin + 1, b.ymin + 1, b.xmax - 1,
+                                  b.ymax - 1) for b in boxes
+            ]
+
+            def find(func):
+                for coords in page:
+                    func(parser, coords, page_name)
+
+            # the first lookups build the indexes, which is only done
+            # once per process
+            cold = _time(find, _find_in_layout)
+            # pylint: disable=protected-access
+            matcher = parser._get_matcher(page_name)
+            bboxes = [(c.xmin, c.ymin, c.xmax, c.ymax) for c in page]
+            return (len(boxes), _time(find, _scan_layout), cold,
+                    _time(find, _find_in_layout),
+                    _time(matcher.match, bboxes))
+
+        _compare("Layout lookups: text on every field, times in ms",
+                 ("boxes", "scan", "cold index", "index", "whole page"),
+                 [(n, n) for n in sorted(parser.layout["objects"])], measure)
+
+    def benchmark_startup(self):
+        """Compare parsing the fixtures and layout with loading them from
+        the compiled cache."""
+        sources = [(os.path.splitext(os.path.basename(f))[0],
+                    (f, yaml.safe_load))
+                   for f in sorted(
+                       glob.glob(os.path.join(self.options.fixtures,
+                                              "*.yml")))]
+        sources.append(("layout", (self.options.layout, yaml.load)))
+
+        def _load(filepath, loader):
+            with open(filepath) as yamlfile:
+                loader(yamlfile)
+
+        def measure(source):
+            filepath, loader = source
+            # pylint: disable=protected-access
+            cache_path = utils._yaml_cache_path(filepath)
+            if os.path.exists(cache_path):
+                os.unlink(cache_path)
+            return (_time(_load, filepath, loader),
+                    _time(utils.load_yaml, filepath, loader),
+                    _time(utils.load_yaml, filepath, loader))
+
+        _compare("Fixture and layout loading, times in ms",
+                 ("yaml", "cold cache", "warm cache"), sources, measure,
+                 total=True)
+
+    def __call__(self):
+        for name in self._get_benchmarks():
+            LOG.info("Running %s benchmark", name)
+            getattr(self, "benchmark_%s" % name)()
+        return 0
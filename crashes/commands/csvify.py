@@ -10,9 +10,17 @@ import unicodecsv
 
 from crashes.commands import base
 from crashes import db
+from crashes import utils
 
 LOG = logging.getLogger(__name__)
 
+# the fields of each collision that are dumped
+_COLLISION_FIELDS = [
+    "case_no", "dob", "gender", "initials", "date", "time", "injury_region",
+    "injury_severity", "location", "geojson", "latitude", "longitude",
+    "hit_and_run", "hit_and_run_status", "road_location", "report"
+]
+
 
 def _collision_row_sort(row):
     date = row[4]
@@ -36,6 +44,8 @@ def _ticket_row_sort(row):
 class CSVify(base.Command):
     """Export data as CSV."""
 
+    read_only = True
+
     def dump_tickets(self):
         output_path = os.path.join(self.options.csvdir, "ticket.csv")
         LOG.info("Dumping data from %s to %s", db.tickets.filename,
@@ -61,7 +71,7 @@ class CSVify(base.Command):
         LOG.info("Dumping data from %s to %s", db.collisions.filename,
                  output_path)
         rows = []
-        for crash in db.collisions:
+        for crash in db.collisions.iter(fields=_COLLISION_FIELDS, stream=True):
             if crash.get("road_location") in (None, "not involved"):
                 continue
             row = [
@@ -92,7 +102,7 @@ class CSVify(base.Command):
                 crash.get("hit_and_run"),
                 crash.get("hit_and_run_status"),
                 crash.get("road_location"),
-                crash.get("report")
+                utils.get_text(crash.get("report"))
             ])
             rows.append(row)
         rows.sort(key=_collision_row_sort)
@@ -115,7 +125,7 @@ class CSVify(base.Command):
             LOG.info("Dumping data on %s traffic from %s to %s", ttype,
                      db.traffic.filename, output_path)
             rows = []
-            for record in db.traffic:
+            for record in db.traffic.iter(stream=True):
                 if record["type"] == ttype:
                     rows.append(
                         (record["date"], record["start"], record["end"],
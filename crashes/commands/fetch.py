@@ -89,6 +89,7 @@ class Fetch(base.Command):
         ticket_table = page_data.find('table', attrs={'border': 1})
 
         current_person = None
+        tickets = []
         for row in ticket_table.find_all("tr"):
             if "person cited" in row.text.lower():
                 headers = row.find_all("th")
@@ -98,11 +99,12 @@ class Fetch(base.Command):
                 data = row.find_all("td")
                 charge = data[3].b.text.strip()
                 LOG.debug("Found ticket for %s: %s", current_person, charge)
-                db.tickets.append({
+                tickets.append({
                     "case_no": case_no,
                     "initials": current_person,
                     "desc": charge
                 })
+        db.tickets.append_many(tickets)
 
     def _list_reports_for_date(self, date):
         """Get a list of URLs for reports from a given date."""
@@ -134,9 +136,11 @@ class Fetch(base.Command):
                 if row.td and row.th and row.th.a:
                     case_no = row.th.a.string.strip()
                     cols = row.find_all("td")
-                    record = db.collisions.get(case_no)
                     hit_and_run = "H&R" in cols[3].string
-                    if record is None:
+                    # the key index answers these without loading any
+                    # records, which is all that's needed for nearly
+                    # every row
+                    if not db.collisions.exists(case_no):
                         date = datetime.datetime.strptime(
                             cols[1].string.strip(), "%m-%d-%Y").date()
                         db.collisions.append({
@@ -154,7 +158,9 @@ class Fetch(base.Command):
 
                             self._parse_tickets(case_no, ticket_url,
                                                 ticket_post_data)
-                    elif hit_and_run != record.get("hit_and_run"):
+                    elif hit_and_run != db.collisions.flag_value(
+                            case_no, "hit_and_run"):
+                        record = db.collisions[case_no]
                         LOG.info(
                             "Setting hit-and-run status for %s: %s (was %s)",
                             case_no, hit_and_run, record.get("hit_and_run"))
@@ -172,7 +178,7 @@ class Fetch(base.Command):
             end = datetime.date.today()
 
         if self.options.autostart:
-            last = max(r["date"] for r in db.collisions if r.get("date"))
+            last = next(db.collisions.range("date", reverse=True))["date"]
             LOG.debug("Last report was fetched from %s", last)
             current = last - datetime.timedelta(2)
         elif self.options.start:
@@ -195,7 +201,7 @@ class Fetch(base.Command):
         filepath = os.path.join(self.options.pdfdir, filename)
         case_no = utils.filename_to_case_no(filename)
 
-        if not force and db.collisions[case_no].get("parsed"):
+        if not force and db.collisions.flagged(case_no, "parsed"):
             LOG.debug("Already parsed %s, skipping", case_no)
         elif os.path.exists(filepath):
             LOG.debug("%s already exists, skipping", filepath)
@@ -225,8 +231,9 @@ class Fetch(base.Command):
 
     def _fetch_curated(self):
         reports = [
-            c for c in db.collisions if c["road_location"] is not None
-            and not c["case_no"].startswith("NDOR")
+            c for c in db.collisions.find(
+                road_location=lambda loc: loc is not None)
+            if not c["case_no"].startswith("NDOR")
         ]
         for report in reports:
             filename = utils.case_no_to_filename(report.case_no)
@@ -17,6 +17,7 @@ import termcolor
 
 from crashes.commands import base
 from crashes import db
+from crashes import utils
 
 LOG = logging.getLogger(__name__)
 
@@ -201,16 +202,16 @@ class Geocode(base.Command):
 
     def __call__(self):
         coded = 0
-        for report in db.collisions:
-            if (report.get("road_location") not in (None, "not involved")
-                    and not report.get("skip_geojson")
+        for report in db.collisions.find(
+                road_location=lambda loc: loc not in (None, "not involved")):
+            if (not report.get("skip_geojson")
                     and report.get("geojson") is None):
                 print(
                     termcolor.colored(
                         "%-10s %50s" % (report["case_no"], report["date"]),
                         'red',
                         attrs=['bold']))
-                print(textwrap.fill(report["report"]))
+                print(textwrap.fill(utils.get_text(report["report"])))
                 geojson = self._get_coordinates(report)
                 if geojson is None:
                     report["skip_geojson"] = True
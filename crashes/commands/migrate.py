@@ -0,0 +1,50 @@
+"""Copy the databases from one storage backend to another."""
+
+import logging
+
+from crashes.commands import base
+from crashes import db
+
+LOG = logging.getLogger(__name__)
+
+
+class Migrate(base.Command):
+    """Copy the databases from one storage backend to another."""
+
+    arguments = [
+        base.Argument(
+            "--source",
+            default="json:",
+            help="URI of the databases to copy (default: %(default)s)"),
+        base.Argument(
+            "--dest",
+            help="URI to copy the databases to (default: the configured "
+            "database URI)"),
+    ]
+
+    def __call__(self):
+        dest_uri = self.options.dest or self.options.database
+        if db.parse_uri(dest_uri) == db.parse_uri(self.options.source):
+            raise SystemExit("Source and destination are both %s" % dest_uri)
+
+        for database in db.DATABASES:
+            dest = database.using(dest_uri)
+            if len(dest):
+                raise SystemExit("%s already contains %s records in %s" %
+                                 (dest.filename, len(dest), dest_uri))
+
+        for database in db.DATABASES:
+            source = database.using(self.options.source)
+            dest = database.using(dest_uri)
+            LOG.info("Copying %s records in %s from %s to %s", len(source),
+                     database.filename, self.options.source, dest_uri)
+            if database.text_fields:
+                for digest in source.blobs:
+                    dest.blobs.put(source.blobs.get(digest))
+            # copy the serialized records straight across, rather than
+            # deserializing and reserializing every one, but move any
+            # text that's still in the records out into the blob store
+            dest.backend.extend(
+                dest.store_text(dict(r)) for r in source.backend)
+            dest.sync()
+        return 0
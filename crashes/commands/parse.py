@@ -6,14 +6,17 @@ import collections
 import copy
 import datetime
 import glob
+import hashlib
 import itertools
 import logging
+import math
 import multiprocessing
 import os
 import re
 import time
 import traceback
 
+import numpy
 from pdfminer import converter as pdfconverter
 from pdfminer import layout as pdflayout
 from pdfminer import pdfdocument
@@ -21,6 +24,7 @@ from pdfminer import pdfinterp
 from pdfminer import pdfpage
 from pdfminer import pdfparser
 from pdfminer import psparser
+from six.moves import cPickle as pickle
 from six.moves import input
 from six.moves import queue
 import yaml
@@ -31,6 +35,10 @@ from crashes import utils
 
 LOG = logging.getLogger(__name__)
 
+# bump this whenever a change to the parser or the converters changes
+# what's parsed from a report, so that cached results are thrown out
+CACHE_VERSION = 1
+
 ParsedPDFObjectData = collections.namedtuple("ParsedPDFObjectData",
                                              ("name", "data"))
 
@@ -167,6 +175,19 @@ class IntegerMapping(Integer):
         return self._values[super(IntegerMapping, self).convert(data)]
 
 
+class LayoutAggregator(pdfconverter.PDFPageAggregator):
+    """Device that analyzes the layout of each page only when asked
+    to, so that a page can be classified from its characters first."""
+
+    def __init__(self, rsrcmgr, pageno=1, laparams=None):
+        pdfconverter.PDFPageAggregator.__init__(
+            self, rsrcmgr, pageno=pageno, laparams=None)
+        self.analysis_params = laparams or pdflayout.LAParams()
+
+    def analyze(self, ltpage):
+        ltpage.analyze(self.analysis_params)
+
+
 class PDFDocument(collections.Iterable):
     def __init__(self, filename, layout):
         self.filename = filename
@@ -183,12 +204,23 @@ class PDFDocument(collections.Iterable):
             self.document = pdfdocument.PDFDocument(
                 pdfparser.PDFParser(self.stream))
             self.rsrcmgr = pdfinterp.PDFResourceManager()
-            self.device = pdfconverter.PDFPageAggregator(
-                self.rsrcmgr, laparams=pdflayout.LAParams())
+            self.device = LayoutAggregator(self.rsrcmgr)
             self.interpreter = pdfinterp.PDFPageInterpreter(
                 self.rsrcmgr, self.device)
 
     def __iter__(self):
+        return self.pages()
+
+    def pages(self, skip=()):
+        """Iterate over the pages in the document.
+
+        Each page is classified from its characters before its layout
+        is analyzed, and pages that can only be of one of the types
+        named in ``skip`` are passed over without analyzing them at
+        all. Every other page is analyzed and identified by its
+        layout. ``skip`` is checked afresh for each page, so it can be
+        added to while iterating.
+        """
         self._parse()
 
         page_num = 0
@@ -196,6 +228,15 @@ class PDFDocument(collections.Iterable):
             page_num += 1
             self.interpreter.process_page(raw_page)
             layout = self.device.get_result()
+
+            candidates = PDFPage.classify(get_text(layout))
+            if (len(candidates) == 1 and candidates[0].distinctive
+                    and candidates[0].name in skip):
+                LOG.warning("Skipping %s page %s of %s", candidates[0].name,
+                            page_num, self.filename)
+                continue
+
+            self.device.analyze(layout)
             objects = list(layout)
 
             try:
@@ -214,6 +255,15 @@ class PDFPage(collections.Iterable):
     name = None
     _subclasses = None
 
+    # text that's on every page of this type, with the whitespace
+    # removed, for classifying pages before their layout is analyzed
+    signature = None
+
+    # whether the signature is only ever found on pages of this type;
+    # a page whose only candidate type has a signature that isn't is
+    # still analyzed and matched before it can be skipped
+    distinctive = True
+
     def __init__(self, objects, layout, number=0):
         self.objects = objects
         self.layout = layout
@@ -247,6 +297,23 @@ class PDFPage(collections.Iterable):
                     cls._subclasses.append(obj)
         return cls._subclasses
 
+    @classmethod
+    def classify(cls, text):
+        """Get the page types whose signatures are in the text of a
+        page, ignoring whitespace.
+
+        The text is in the order that it was drawn in, before the
+        layout of the page is analyzed, so a signature is only found
+        if its characters were drawn one after another. A page that
+        exactly one distinctive signature is found on can only be of
+        that type. If no signature is found, or several are, it takes
+        analyzing the layout of the page to tell."""
+        text = re.sub(r"\s+", "", text)
+        return [
+            s for s in cls._get_subclasses()
+            if s.signature is not None and s.signature in text
+        ]
+
     @classmethod
     def matches(cls, objects):
         raise NotImplementedError()
@@ -254,6 +321,7 @@ class PDFPage(collections.Iterable):
 
 class ReportPage(PDFPage):
     name = "report"
+    signature = "MotorVehicleAccidentReport"
 
     @classmethod
     def matches(cls, objects):
@@ -262,6 +330,7 @@ class ReportPage(PDFPage):
 
 class DiagramPage(PDFPage):
     name = "diagram"
+    signature = "THEFOLLOWINGINFORMATIONISREQUIRED"
 
     @classmethod
     def matches(cls, objects):
@@ -271,6 +340,7 @@ class DiagramPage(PDFPage):
 
 class AdditionalDiagramPage(PDFPage):
     name = "addl_diagram"
+    signature = "ADDITIONAL-DIAGRAM"
 
     @classmethod
     def matches(cls, objects):
@@ -279,6 +349,9 @@ class AdditionalDiagramPage(PDFPage):
 
 class ContinuationPage40a(PDFPage):
     name = "40a"
+    signature = "40a"
+    # the form number can turn up in the text of other pages
+    distinctive = False
 
     @classmethod
     def matches(cls, objects):
@@ -288,6 +361,8 @@ class ContinuationPage40a(PDFPage):
 
 class ContinuationPage40b(PDFPage):
     name = "40b"
+    signature = "40b"
+    distinctive = False
 
     @classmethod
     def matches(cls, objects):
@@ -296,6 +371,7 @@ class ContinuationPage40b(PDFPage):
 
 class TruckAndBusPage(PDFPage):
     name = "truck_bus"
+    signature = "SupplementalTruckandBus"
 
     @classmethod
     def matches(cls, objects):
@@ -352,6 +428,182 @@ class Coordinates(collections.Iterable):
             yield item
 
 
+class GridIndex(object):
+    """Uniform grid over a set of boxes, to find the boxes that might
+    contain another box without checking every one of them.
+
+    Each box is added to every cell that it overlaps, grown by
+    ``fuzz``, so any box that contains another (give or take
+    ``fuzz``) is always in the cell under the center of that other
+    box. The grid has about as many cells as there are boxes.
+    """
+
+    def __init__(self, boxes, fuzz=0):
+        """Index the boxes, given as (item, Coordinates) pairs."""
+        boxes = list(boxes)
+        self._cells = collections.defaultdict(list)
+        self._xmin = self._ymin = 0.0
+        self._width = self._height = 1.0
+        if not boxes:
+            return
+
+        self._xmin = min(c.xmin for _, c in boxes) - fuzz
+        self._ymin = min(c.ymin for _, c in boxes) - fuzz
+        xmax = max(c.xmax for _, c in boxes) + fuzz
+        ymax = max(c.ymax for _, c in boxes) + fuzz
+        per_side = int(math.ceil(math.sqrt(len(boxes))))
+        self._width = (xmax - self._xmin) / per_side or 1.0
+        self._height = (ymax - self._ymin) / per_side or 1.0
+
+        for item, coords in boxes:
+            col0, row0 = self._cell(coords.xmin - fuzz, coords.ymin - fuzz)
+            col1, row1 = self._cell(coords.xmax + fuzz, coords.ymax + fuzz)
+            for col in range(col0, col1 + 1):
+                for row in range(row0, row1 + 1):
+                    self._cells[(col, row)].append((item, coords))
+
+    def _cell(self, x, y):
+        return (int(math.floor((x - self._xmin) / self._width)),
+                int(math.floor((y - self._ymin) / self._height)))
+
+    def candidates(self, coords):
+        """Get the (item, Coordinates) pairs whose boxes might contain
+        the given box."""
+        return self._cells.get(
+            self._cell((coords.xmin + coords.xmax) / 2.0,
+                       (coords.ymin + coords.ymax) / 2.0), ())
+
+
+class PageMatcher(object):
+    """The skip regions and objects of one page type as arrays, to
+    match all of the objects on a page against all of them at once.
+    """
+
+    def __init__(self, skip, objects, skip_fuzz=0, obj_fuzz=0):
+        self.skip = list(skip)
+        self.objects = objects
+        self.names = list(objects)
+        self.skip_fuzz = skip_fuzz
+        self.obj_fuzz = obj_fuzz
+        self._skip = self._to_array([c.to_list() for c in self.skip])
+        self._objects = self._to_array(
+            [objects[n]["coordinates"].to_list() for n in self.names])
+
+    @staticmethod
+    def _to_array(boxes):
+        return numpy.array(boxes, dtype=float).reshape(-1, 4)
+
+    @staticmethod
+    def _contained(page, boxes, fuzz):
+        """Get the matrix of whether each box on the page (as rows)
+        is contained in each layout box (as columns), as
+        Coordinates.contains() does it."""
+        page = page[:, numpy.newaxis, :]
+        return ((page[..., 0] + fuzz >= boxes[:, 0])
+                & (page[..., 1] - fuzz <= boxes[:, 1])
+                & (page[..., 2] + fuzz >= boxes[:, 2])
+                & (page[..., 3] - fuzz <= boxes[:, 3]))
+
+    def match(self, bboxes):
+        """Match the bounding boxes of the objects on a page.
+
+        Returns a list with, for each object, a tuple of the skip
+        region that contains it, or None, and a dict of the names of
+        the layout objects that contain it to the objects; the dict
+        is None for skipped objects.
+        """
+        bboxes = self._to_array(bboxes)
+        # as Coordinates: xmin, xmax, ymin, ymax
+        page = numpy.column_stack(
+            (numpy.minimum(bboxes[:, 0], bboxes[:, 2]),
+             numpy.maximum(bboxes[:, 0], bboxes[:, 2]),
+             numpy.minimum(bboxes[:, 1], bboxes[:, 3]),
+             numpy.maximum(bboxes[:, 1], bboxes[:, 3])))
+
+        skipped = self._contained(page, self._skip, self.skip_fuzz)
+        found = self._contained(page, self._objects, self.obj_fuzz)
+        counts = found.sum(axis=1)
+        if self.skip:
+            first_skipped = numpy.where(
+                skipped.any(axis=1), skipped.argmax(axis=1), -1)
+        else:
+            first_skipped = numpy.full(len(page), -1, dtype=int)
+        first_found = found.argmax(axis=1) if self.names else counts
+
+        retval = []
+        for i, skip_idx in enumerate(first_skipped.tolist()):
+            if skip_idx >= 0:
+                retval.append((self.skip[skip_idx], None))
+                continue
+            if counts[i] == 1:
+                names = [self.names[first_found[i]]]
+            else:
+                names = [self.names[j] for j in numpy.flatnonzero(found[i])]
+            retval.append((None, {n: self.objects[n] for n in names}))
+        return retval
+
+
+class ResultCache(object):
+    """Results of parsing reports, keyed by a hash of the report and of
+    everything else that determines what's parsed from it.
+
+    Each result is pickled to its own file, so the parser processes
+    can share the cache without any locking. Reading a result marks it
+    as used, and prune() removes the least recently used results once
+    there are more than ``max_entries``. Like the compiled YAML cache,
+    it's never required, so results that can't be read or written are
+    ignored.
+    """
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+
+    def _get_path(self, key):
+        return os.path.join(self.path, "%s.pickle" % key)
+
+    def get(self, key):
+        """Get the result cached for a key, or None if there isn't one."""
+        path = self._get_path(key)
+        try:
+            with open(path, "rb") as cachefile:
+                result = pickle.load(cachefile)
+            os.utime(path, None)
+            return result
+        except (IOError, OSError):
+            pass
+        except Exception as err:  # pylint: disable=broad-except
+            LOG.debug("Ignoring unreadable cached result %s: %s", path, err)
+        return None
+
+    def put(self, key, result):
+        path = self._get_path(key)
+        tmp_path = "%s.%s.tmp" % (path, os.getpid())
+        try:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            with open(tmp_path, "wb") as cachefile:
+                pickle.dump(result, cachefile, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as err:
+            LOG.debug("Could not cache result %s: %s", path, err)
+
+    def prune(self):
+        """Remove the least recently used results over the size cap."""
+        try:
+            paths = glob.glob(os.path.join(self.path, "*.pickle"))
+            if len(paths) <= self.max_entries:
+                return
+            paths.sort(key=os.path.getmtime)
+            for path in paths[:len(paths) - self.max_entries]:
+                os.unlink(path)
+        except (IOError, OSError) as err:
+            LOG.debug("Could not prune cache %s: %s", self.path, err)
+            return
+        LOG.info("Removed %s old results from %s",
+                 len(paths) - self.max_entries, self.path)
+
+
 class Parse(base.Command):
     """Extract data from all downloaded reports."""
     result_batch_size = 30
@@ -364,6 +616,17 @@ class Parse(base.Command):
         base.Argument("--reparse-curated", action="store_true"),
         base.Argument("--reparse-all", action="store_true"),
         base.Argument("--reparse-old", action="store_true"),
+        base.Argument(
+            "--no-cache",
+            action="store_true",
+            help="Parse every report, rather than reusing results cached "
+            "from parsing the same report with the same layout"),
+        base.Argument(
+            "--cache-size",
+            type=int,
+            default=100000,
+            help="Maximum number of parse results to cache "
+            "(default: %(default)s)"),
     ]
 
     def __init__(self, options):
@@ -382,7 +645,7 @@ class Parse(base.Command):
             try:
                 # collect results that are available
                 count = self._handle_results()
-                LOG.info("Writing %s results", count)
+                LOG.info("%s more reports parsed", count)
                 parsed += count
 
                 # see if any processes have completed
@@ -423,45 +686,38 @@ class Parse(base.Command):
         return error
 
     def _handle_results(self, timeout=1, interval=15):
+        """Count the reports that the child processes have parsed.
+
+        The children save their own results, so only the case numbers
+        come back on the result queue.
+        """
         results = 0
         start = time.time()
-        with db.collisions.delay_write():
-            # we want to exit this loop periodically to check on things
-            # like stopped processes and report on time elapsed and
-            # remaining
-            while (time.time() - start < interval
-                   and results < self.result_batch_size):
-                try:
-                    result = self._result_queue.get(True, timeout)
-                    if result:
-                        LOG.debug(
-                            "Got result for %(case_no)s from result queue",
-                            result)
-                        LOG.debug("%s items still in result queue",
-                                  self._result_queue.qsize())
-                        self._store_one_result(result)
-                        results += 1
-                except queue.Empty:
-                    LOG.debug("Result queue empty")
-                    continue
+        # we want to exit this loop periodically to check on things
+        # like stopped processes and report on time elapsed and
+        # remaining
+        while (time.time() - start < interval
+               and results < self.result_batch_size):
+            try:
+                case_no = self._result_queue.get(True, timeout)
+                LOG.debug("Got result for %s from result queue", case_no)
+                LOG.debug("%s items still in result queue",
+                          self._result_queue.qsize())
+                results += 1
+            except queue.Empty:
+                LOG.debug("Result queue empty")
+                continue
         return results
 
-    def _store_one_result(self, result):
-        if self.options.files:
-            print(repr(result))
-        elif db.collisions.record_exists(result):
-            db.collisions.merge(result)
-        else:
-            db.collisions.append(result)
-
     def _build_filelist(self):
         LOG.debug("Building list of files to parse...")
         if self.options.files:
             return self.options.files
         elif self.options.reparse_curated:
             reports = [
-                r for r in db.collisions if r.get("road_location") not in
-                (None, 'not involved') and not r["case_no"].startswith("NDOR")
+                r for r in db.collisions.find(road_location=lambda loc: (
+                    loc not in (None, 'not involved')))
+                if not r["case_no"].startswith("NDOR")
             ]
             return [
                 os.path.join(self.options.pdfdir,
@@ -482,16 +738,18 @@ class Parse(base.Command):
         elif self.options.reparse_all:
             return glob.glob(os.path.join(self.options.pdfdir, "*"))
         else:
-            LOG.debug("Building list of already parsed cases")
-            case_numbers = [
-                r["case_no"] for r in db.collisions
-                if r.get("parsed") and not r["case_no"].startswith("NDOR")
-            ]
-            LOG.debug("Found %s already parsed cases", len(case_numbers))
+            LOG.debug("Skipping already parsed cases")
+
+            def parsed(fpath):
+                case_no = utils.filename_to_case_no(fpath)
+                # NDOR reports are always parsed again
+                return (not case_no.startswith("NDOR")
+                        and db.collisions.flagged(case_no, "parsed"))
+
             return [
                 fpath
                 for fpath in glob.glob(os.path.join(self.options.pdfdir, "*"))
-                if utils.filename_to_case_no(fpath) not in case_numbers
+                if not parsed(fpath)
             ]
 
     def __call__(self):
@@ -499,23 +757,30 @@ class Parse(base.Command):
         LOG.debug("Parsing %s files", len(filelist))
 
         if self.options.interactive:
-            return self.run_foreground(filelist)
-        elif len(filelist) < self.options.processes:
-            LOG.debug("Fewer files than processes (%s files, %s processes)" %
-                      (len(filelist), self.options.processes))
-        nprocs = min(len(filelist), self.options.processes)
-
-        if nprocs < 2:
-            return self.run_foreground(filelist)
+            retval = self.run_foreground(filelist)
         else:
-            return self.run_multiprocess(filelist, nprocs)
+            if len(filelist) < self.options.processes:
+                LOG.debug(
+                    "Fewer files than processes (%s files, %s processes)" %
+                    (len(filelist), self.options.processes))
+            nprocs = min(len(filelist), self.options.processes)
+
+            if nprocs < 2:
+                retval = self.run_foreground(filelist)
+            else:
+                retval = self.run_multiprocess(filelist, nprocs)
+
+        if not self.options.no_cache:
+            ResultCache(self.options.parse_cache,
+                        self.options.cache_size).prune()
+        return retval
 
     def run_foreground(self, filelist):
         parser = Parser(self.options)
         for fpath in filelist:
             result = parser.parse(fpath)
             if result:
-                self._store_one_result(result)
+                parser.store(result)
 
     def run_multiprocess(self, filelist, nprocs):
         for fpath in filelist:
@@ -560,7 +825,16 @@ class Parser(object):
 
     def __init__(self, options):
         self.options = options
-        self.layout = yaml.load(open(self.options.layout))
+        self.layout = utils.load_yaml(self.options.layout, loader=yaml.load)
+        # other commands that use the parser don't take --no-cache, and
+        # shouldn't get results from the cache
+        self.cache = None
+        if not getattr(options, "no_cache", True) and not options.interactive:
+            self.cache = ResultCache(options.parse_cache, options.cache_size)
+            with open(self.options.layout, "rb") as layoutfile:
+                digest = hashlib.sha256(layoutfile.read())
+            digest.update(str(CACHE_VERSION).encode("ascii"))
+            self._inputs_digest = digest.hexdigest()
 
         for objects in self.layout["objects"].values():
             for obj in objects.values():
@@ -585,6 +859,64 @@ class Parser(object):
                 Coordinates(*c) for c in coords_list
             ]
 
+        # spatial indexes of the skip regions and the objects of each
+        # page type, built as they're needed; anything that changes
+        # the layout must clear them
+        self._skip_indexes = {}
+        self._object_indexes = {}
+        self._matchers = {}
+        self._layout_version = 0
+
+    def _get_skip_index(self, page_name):
+        if page_name not in self._skip_indexes:
+            self._skip_indexes[page_name] = GridIndex(
+                ((c, c) for c in self.layout["skip"].get(page_name, [])),
+                fuzz=self._skip_fuzz)
+        return self._skip_indexes[page_name]
+
+    def _get_object_index(self, page_name):
+        if page_name not in self._object_indexes:
+            self._object_indexes[page_name] = GridIndex(
+                ((name, obj["coordinates"]) for name, obj in
+                 self.layout["objects"][page_name].items()),
+                fuzz=self._obj_fuzz)
+        return self._object_indexes[page_name]
+
+    def _get_matcher(self, page_name):
+        if page_name not in self._matchers:
+            self._matchers[page_name] = PageMatcher(
+                self.layout["skip"].get(page_name, []),
+                self.layout["objects"][page_name],
+                skip_fuzz=self._skip_fuzz,
+                obj_fuzz=self._obj_fuzz)
+        return self._matchers[page_name]
+
+    def _layout_changed(self):
+        self._skip_indexes.clear()
+        self._object_indexes.clear()
+        self._matchers.clear()
+        self._layout_version += 1
+        self.cache = None
+
+    def _find_skip_region(self, coords, page_name):
+        """Get the skip region that contains the coordinates, or None."""
+        for skip_coords, _ in self._get_skip_index(page_name).candidates(
+                coords):
+            if skip_coords.contains(coords, fuzz=self._skip_fuzz):
+                return skip_coords
+        return None
+
+    def _find_candidates(self, coords, page_name):
+        """Get the layout objects that contain the coordinates, as a
+        dict of name to object."""
+        objects = self.layout["objects"][page_name]
+        return {
+            name: objects[name]
+            for name, obj_coords in self._get_object_index(
+                page_name).candidates(coords)
+            if obj_coords.contains(coords, fuzz=self._obj_fuzz)
+        }
+
     def _munge_name(self, name):
         """Anonymize a name so that it can be compared but not read.
 
@@ -616,6 +948,7 @@ class Parser(object):
             obj = self.layout["objects"][page.name][name]
             obj["coordinates"] = new_coords
             obj["raw_coordinates"] = new_coords.to_list()
+            self._layout_changed()
             return name, layout_obj
         else:
             raise PDFObjectMultipleCandidates(
@@ -637,6 +970,7 @@ class Parser(object):
             if name.upper() == 'S':
                 LOG.debug("Adding %s to skip list for %s", coords, page.name)
                 self.layout["skip"].setdefault(page.name, []).append(coords)
+                self._layout_changed()
                 return None, None
             else:
                 layout_record = {
@@ -646,33 +980,38 @@ class Parser(object):
 
                 LOG.debug("Adding %s to layout object list", name)
                 self.layout["objects"][page.name][name] = layout_record
+                self._layout_changed()
                 return name, layout_record
         else:
             raise PDFObjectUnknown(
                 "Could not determine what %s on page %s is: no candidates" %
                 (pdfobj_repr(pdfobj), page.name))
 
-    def _parse_pdfobj(self, pdfobj, page, filename):
+    def _parse_pdfobj(self, pdfobj, page, filename, match=None):
+        """Parse a single object on a page.
+
+        ``match`` is what PageMatcher.match() found for the object,
+        if the whole page has been matched already; otherwise the
+        object is looked up in the layout by itself.
+        """
         record = get_text(pdfobj)
         if not record:
             return None
         coords = Coordinates(*pdfobj.bbox)
 
-        skip_pdf_obj = False
-        for skip_coords in self.layout["skip"].get(page.name, []):
-            if skip_coords.contains(coords, fuzz=self._skip_fuzz):
-                LOG.debug("Skipping PDF object %s: contained within %s",
-                          pdfobj_repr(pdfobj), skip_coords)
-                skip_pdf_obj = True
-                break
-        if skip_pdf_obj:
+        if match is None:
+            skip_coords = self._find_skip_region(coords, page.name)
+            candidates = None
+        else:
+            skip_coords, candidates = match
+        if skip_coords is not None:
+            LOG.debug("Skipping PDF object %s: contained within %s",
+                      pdfobj_repr(pdfobj), skip_coords)
             return None
 
         LOG.debug("Finding candidates for %s", pdfobj_repr(pdfobj))
-        candidates = {}
-        for obj_name, obj in self.layout["objects"][page.name].items():
-            if obj["coordinates"].contains(coords, fuzz=self._obj_fuzz):
-                candidates[obj_name] = obj
+        if candidates is None:
+            candidates = self._find_candidates(coords, page.name)
         if len(candidates) > 1:
             obj_name, layout_obj = self._handle_record_multiple_candidates(
                 pdfobj, page, filename, candidates)
@@ -680,7 +1019,7 @@ class Parser(object):
             obj_name, layout_obj = self._handle_record_without_candidates(
                 pdfobj, page, filename)
         elif len(candidates) == 1:
-            obj_name, layout_obj = candidates.items()[0]
+            obj_name, layout_obj = list(candidates.items())[0]
 
         if layout_obj:
             if "converter" in layout_obj:
@@ -714,7 +1053,7 @@ class Parser(object):
             return data
 
         page_types = []
-        for page in doc:
+        for page in doc.pages(skip=page_types):
             if isinstance(page, UnknownPageType):
                 LOG.warning("Unknown page type: %s" % page)
                 continue
@@ -726,9 +1065,19 @@ class Parser(object):
 
             LOG.debug("Parsing page %s (%s)", page.number, page.name)
 
-            for pdfobj in page:
+            objects = list(page)
+            version = self._layout_version
+            matches = self._get_matcher(page.name).match(
+                [o.bbox for o in objects])
+            for pdfobj, match in zip(objects, matches):
+                if self._layout_version != version:
+                    # the layout has been changed interactively, so
+                    # the rest of the page has to be looked up in the
+                    # new one
+                    match = None
                 try:
-                    obj_data = self._parse_pdfobj(pdfobj, page, filename)
+                    obj_data = self._parse_pdfobj(
+                        pdfobj, page, filename, match=match)
                 except PDFObjectParsingException as err:
                     LOG.error(err)
                     if "unparsed_data" not in data:
@@ -746,12 +1095,46 @@ class Parser(object):
         data["parsed"] = True
         return data
 
+    def _get_cache_key(self, filename):
+        try:
+            with open(filename, "rb") as pdffile:
+                digest = hashlib.sha256(pdffile.read()).hexdigest()
+        except IOError:
+            return None
+        return "%s-%s" % (digest, self._inputs_digest)
+
     def parse(self, filename):
+        key = None
+        if self.cache is not None:
+            key = self._get_cache_key(filename)
+            result = self.cache.get(key) if key else None
+            if result is not None:
+                LOG.debug("Using cached result for %s", filename)
+                # the same report may have been cached under another name
+                result["filename"] = filename
+                result["case_no"] = utils.filename_to_case_no(filename)
+                return result
+
         try:
-            return self._parse_pdf(filename)
+            result = self._parse_pdf(filename)
         except psparser.PSException as err:
             LOG.warn("Parsing %s failed, skipping: %s", filename, err)
             return None
+        # a change to the layout made interactively isn't in the key,
+        # so nothing parsed since then can be cached
+        if key and self.cache is not None:
+            self.cache.put(key, result)
+        return result
+
+    def store(self, result):
+        """Save the data parsed from a report, or print it if files to
+        parse were given explicitly."""
+        if self.options.files:
+            print(repr(result))
+        elif db.collisions.record_exists(result):
+            db.collisions.merge(result)
+        else:
+            db.collisions.append(result)
 
 
 class ParseChildProcess(Parser, multiprocessing.Process):
@@ -776,7 +1159,23 @@ class ParseChildProcess(Parser, multiprocessing.Process):
 
         LOG.info("Created child process %s", name)
 
+    def _store_batch(self, batch):
+        """Save a batch of results in one write, and report them done.
+
+        The database merges our changes with those of the other
+        children, so each child can save its own results."""
+        if not batch:
+            return
+        LOG.info("Saving data for %s reports", len(batch))
+        with db.collisions.delay_write():
+            for data in batch:
+                self.store(data)
+        for data in batch:
+            self._result_queue.put(data["case_no"])
+        del batch[:]
+
     def run(self):
+        batch = []
         while not self._terminate.is_set():
             while self._result_queue.qsize() >= self._max_result_queue_length:
                 LOG.info("Result queue contains %s items, > %s",
@@ -791,12 +1190,14 @@ class ParseChildProcess(Parser, multiprocessing.Process):
                 LOG.info("Got file path from work queue: %s", fpath)
                 data = self.parse(fpath)
                 if data:
-                    LOG.info("Returning data for %s to results queue", fpath)
-                    self._result_queue.put(data)
+                    batch.append(data)
+                    if len(batch) >= Parse.result_batch_size:
+                        self._store_batch(batch)
             except queue.Empty:
                 LOG.info("Work queue is empty, exiting")
                 break
             except KeyboardInterrupt:
                 LOG.info("Caught Ctrl-C, exiting")
                 break
+        self._store_batch(batch)
         LOG.info("Exited loop normally")
@@ -0,0 +1,22 @@
+"""Rewrite the database shards according to the sharding policy."""
+
+import logging
+
+from crashes.commands import base
+from crashes import db
+
+LOG = logging.getLogger(__name__)
+
+
+class Rebalance(base.Command):
+    """Rewrite the database shards according to the sharding policy."""
+
+    def __call__(self):
+        for database in db.DATABASES:
+            if database.sharding is None:
+                continue
+            before = database.backend.shards()
+            after = database.rebalance()
+            LOG.info("Rebalanced %s from %s shards to %s", database.filename,
+                     len(before), len(after))
+        return 0
@@ -27,6 +27,8 @@ def literal(text):
 class Template(base.Command):
     """Render the templates."""
 
+    read_only = True
+
     def __init__(self, options):
         super(Template, self).__init__(options)
         self._template_data = json.load(
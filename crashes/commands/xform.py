@@ -70,6 +70,8 @@ def get_crash_time(report):
 class Xform(base.Command):
     """Produce nicely transformed data for graphs."""
 
+    read_only = True
+
     narrow_age_ranges = [
         AgeRange(max=5),
         AgeRange(6, 10),
@@ -147,13 +149,11 @@ class Xform(base.Command):
         ignore = [None, "not involved"]
         if not unknown:
             ignore.append("unknown")
-        for report in db.collisions:
-            if report.get("road_location") not in ignore:
-                yield report
+        return db.collisions.find(road_location=lambda loc: loc not in ignore)
 
     @staticmethod
     def _get_bike_traffic():
-        for record in db.traffic:
+        for record in db.traffic.iter(stream=True):
             if record["type"] == "bike":
                 yield record
 
@@ -222,7 +222,7 @@ class Xform(base.Command):
 
         cur_year = datetime.date.today().year
         expected = 0
-        last = max(c["date"] for c in db.collisions if c.get("date"))
+        last = next(db.collisions.range("date", reverse=True))["date"]
 
         rate_labels = []
         monthly_rate = []
@@ -632,7 +632,8 @@ class Xform(base.Command):
         LOG.info("Transforming data on hit-and-runs")
 
         hit_and_runs = collections.defaultdict(int)
-        for report in db.collisions:
+        for report in db.collisions.iter(fields=["hit_and_run_status"],
+                                         stream=True):
             if report.get("hit_and_run_status") is not None:
                 hit_and_runs[report["hit_and_run_status"]] += 1
 
@@ -799,7 +800,8 @@ class Xform(base.Command):
         last_report = None
         post_2011_reports = 0
         bike_report_count = 0
-        for report in db.collisions:
+        for report in db.collisions.iter(
+                fields=["case_no", "date", "road_location"], stream=True):
             if report["date"] is None:
                 self._template_data['unparseable_count'] += 1
                 continue
@@ -824,10 +826,8 @@ class Xform(base.Command):
             "bike_reports"] / self._template_data["post_2011_reports"])
 
         status_counts = collections.defaultdict(int)
-        for report in db.collisions:
-            if report.get("road_location") not in (None, "not involved",
-                                                   "unknown"):
-                status_counts[report["road_location"]] += 1
+        for report in self._get_relevant_crashes(unknown=False):
+            status_counts[report["road_location"]] += 1
 
         self._template_data['statuses'] = dict(status_counts)
         self._template_data['total_road'] = (
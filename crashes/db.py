@@ -9,16 +9,39 @@ serialization (until we actually request data from a record).
 """
 
 import abc
+import atexit
+import binascii
+import bisect
+import bz2
+import codecs
 import collections
 import contextlib
 import copy
 import datetime
+import hashlib
 import logging
 import json
+import mmap
+from multiprocessing import pool
 import os
+import re
+import sqlite3
+import struct
+import time
+import zlib
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+try:
+    import lzma
+except ImportError:  # Python 2
+    lzma = None
 
 import six
-import yaml
+from six.moves import cPickle as pickle
 
 from crashes import utils
 
@@ -33,6 +56,10 @@ class NoSuchDatabase(Exception):
     """No such database."""
 
 
+class NoSuchIndex(Exception):
+    """Field is not indexed."""
+
+
 class SerializationNotSupported(Exception):
     """Can't serialize objects of this type."""
 
@@ -41,13 +68,201 @@ class DeserializationNotSupported(Exception):
     """Can't deserialize objects of this type."""
 
 
+class ConcurrentModification(Exception):
+    """Changes conflict with changes made by another process."""
+
+
+def _lock(filepath, exclusive=False):
+    """Take an advisory lock on a lock file, and return the open file.
+
+    Any number of readers can share a lock, but a writer holds it
+    alone. Where fcntl isn't available, or the lock file can't be
+    created, nothing is locked and None is returned.
+    """
+    if fcntl is None:
+        return None
+    try:
+        lockfile = open(filepath, "a")
+    except (IOError, OSError) as err:
+        LOG.debug("Not locking %s: %s", filepath, err)
+        return None
+    try:
+        fcntl.flock(lockfile.fileno(),
+                    fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+    except BaseException:
+        lockfile.close()
+        raise
+    return lockfile
+
+
+def _unlock(lockfile):
+    if lockfile is not None:
+        # closing the file releases the lock
+        lockfile.close()
+
+
+@contextlib.contextmanager
+def _locked(filepath, exclusive=False):
+    lockfile = _lock(filepath, exclusive=exclusive)
+    try:
+        yield
+    finally:
+        _unlock(lockfile)
+
+
+def _file_stamp(filepath):
+    """Describe the state of a file, so that changes to it can be
+    noticed. Files are always replaced by renaming a new file over
+    them, or appended to, so this changes whenever a file does."""
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return [os.path.basename(filepath), None]
+    return [
+        os.path.basename(filepath), stat.st_size, stat.st_mtime, stat.st_ino
+    ]
+
+
+def _generation(filepath):
+    """Get the number of writes counted in a lock file."""
+    try:
+        with open(filepath) as lockfile:
+            return int(lockfile.read() or 0)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _count_write(filepath):
+    """Count a write in a lock file; the caller must hold an exclusive
+    lock on it.
+
+    File stamps alone can miss a write: mtimes only move on every few
+    milliseconds, and a file that's replaced by renaming can get back
+    the inode that it had a moment before.
+    """
+    generation = (_generation(filepath) or 0) + 1
+    try:
+        with open(filepath, "a+") as lockfile:
+            lockfile.truncate(0)
+            lockfile.write(str(generation))
+    except (IOError, OSError) as err:
+        LOG.debug("Not counting write in %s: %s", filepath, err)
+
+
+class Compression(object):
+    """A compression format from the standard library that shards can
+    be written in.
+
+    Shards are recognized as compressed, and in which format, by the
+    magic bytes that they start with, so the format can be changed at
+    any time: shards are read in whatever format they were written in,
+    and written in the new one.
+    """
+
+    def __init__(self, name, magic, compress, decompressor):
+        self.name = name
+        self.magic = magic
+        self._compress = compress
+        self._decompressor = decompressor
+
+    @property
+    def available(self):
+        return self._compress is not None
+
+    def compress(self, data):
+        return self._compress(data)
+
+    def decompressor(self):
+        if not self.available:
+            raise IOError("%s compression is not available" % self.name)
+        return self._decompressor()
+
+    def __repr__(self):
+        return "Compression(%s)" % self.name
+
+
+def _gzip_compress(data):
+    # gzip.compress() is Python 3 only, but zlib can write the gzip
+    # format itself
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _gzip_decompressor():
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+COMPRESSION = {
+    "gzip": Compression("gzip", b"\x1f\x8b", _gzip_compress,
+                        _gzip_decompressor),
+    "bz2": Compression("bz2", b"BZh", bz2.compress, bz2.BZ2Decompressor),
+    "lzma": Compression("lzma", b"\xfd7zXZ\x00", getattr(
+        lzma, "compress", None), getattr(lzma, "LZMADecompressor", None)),
+}
+
+
+def get_compression(name):
+    """Get a compression format by name, or None for no compression."""
+    if name is None or name == "none":
+        return None
+    if name not in COMPRESSION:
+        raise ValueError("Unknown compression %s; choose from none, %s" %
+                         (name, ", ".join(sorted(COMPRESSION))))
+    if not COMPRESSION[name].available:
+        raise ValueError("%s compression is not available" % name)
+    return COMPRESSION[name]
+
+
+class _Decompressed(object):
+    """A file-like view of the decompressed contents of a file."""
+
+    def __init__(self, infile, decompressor):
+        self._infile = infile
+        self._decompressor = decompressor
+
+    def read(self, size=-1):
+        while True:
+            data = self._infile.read(size)
+            if not data:
+                flush = getattr(self._decompressor, "flush", None)
+                return flush() if flush is not None else b""
+            data = self._decompressor.decompress(data)
+            if data:
+                return data
+
+    def close(self):
+        self._infile.close()
+
+
+def _open_shard_file(filepath):
+    """Open a shard file to read its text, decompressing it if it was
+    written compressed."""
+    infile = open(filepath, "rb")
+    magic = infile.read(max(len(c.magic) for c in COMPRESSION.values()))
+    infile.seek(0)
+    for compression in COMPRESSION.values():
+        if magic.startswith(compression.magic):
+            LOG.debug("%s is compressed with %s", filepath, compression.name)
+            try:
+                infile = _Decompressed(infile, compression.decompressor())
+            except IOError:
+                infile.close()
+                raise
+            break
+    return codecs.getreader("utf-8")(infile)
+
+
 @six.add_metaclass(abc.ABCMeta)
 class Serializer(object):
     cls = None
 
+    @property
+    def tag(self):
+        return self.__class__.__name__
+
     @property
     def _magic(self):
-        return "{%s}" % self.__class__.__name__
+        return "{%s}" % self.tag
 
     def serialize(self, value):
         """Serialize a value, including the magic to flag it as serialized."""
@@ -81,32 +296,253 @@ class Serializer(object):
 class DatetimeSerializer(Serializer):
     cls = datetime.datetime
     fmt = "%Y-%m-%dT%H:%M:%S"
+    iso_re = re.compile(r"^(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)$")
 
     def converter(self, obj):  # pylint: disable=no-self-use
         return obj
 
+    def from_parts(self, *parts):  # pylint: disable=no-self-use
+        return datetime.datetime(*parts)
+
     def encode(self, value):
         return value.strftime(self.fmt)
 
     def decode(self, value):
+        # strptime() is slow, and decoding dates is much of the cost
+        # of reading a record, so pick apart values that are in the
+        # format we write by hand
+        match = self.iso_re.match(value)
+        if match:
+            return self.from_parts(*[int(p) for p in match.groups()])
         return self.converter(datetime.datetime.strptime(value, self.fmt))
 
 
 class TimeSerializer(DatetimeSerializer):
     cls = datetime.time
     fmt = "%H:%M:%S"
+    iso_re = re.compile(r"^(\d\d):(\d\d):(\d\d)$")
 
     def converter(self, obj):
         return obj.time()
 
+    def from_parts(self, *parts):
+        return datetime.time(*parts)
+
 
 class DateSerializer(DatetimeSerializer):
     cls = datetime.date
     fmt = "%Y-%m-%d"
+    iso_re = re.compile(r"^(\d{4})-(\d\d)-(\d\d)$")
 
     def converter(self, obj):
         return obj.date()
 
+    def from_parts(self, *parts):
+        return datetime.date(*parts)
+
+
+class BlobRef(object):
+    """A reference to text in a BlobStore, which is only read when it's
+    needed."""
+
+    __slots__ = ("store", "digest")
+
+    def __init__(self, store, digest):
+        self.store = store
+        self.digest = digest
+
+    def read(self):
+        return self.store.get(self.digest)
+
+    def __eq__(self, other):
+        return isinstance(other, BlobRef) and self.digest == other.digest
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.digest)
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, self.digest)
+
+
+class BlobStore(object):
+    """Content-addressed store of text, in a single append-only file.
+
+    Each entry is the SHA-1 digest of the text, its length, and the
+    text itself, encoded as UTF-8. When the store is first used, the
+    index of entries is built by hopping from header to header; the
+    text is read through a memory map, and only when it's asked for.
+
+    Other processes can add to the store at the same time; entries
+    are only appended while holding a lock on the store, and the
+    index picks up other processes' entries when it's asked for one
+    that it doesn't know about.
+    """
+
+    _header = struct.Struct(">20sI")
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._index = None
+        self._size = 0
+        self._map = None
+        self._outfile = None
+
+    @property
+    def _lock_filepath(self):
+        return "%s.lock" % self.filepath
+
+    def _scan(self):
+        """Index entries that have been added since the file was last
+        scanned. The caller must hold a lock on the store.
+
+        Returns the size of the file.
+        """
+        if not os.path.exists(self.filepath):
+            return 0
+        with open(self.filepath, "rb") as infile:
+            total = os.fstat(infile.fileno()).st_size
+            while self._size + self._header.size <= total:
+                infile.seek(self._size)
+                digest, length = self._header.unpack(
+                    infile.read(self._header.size))
+                start = self._size + self._header.size
+                if start + length > total:
+                    break
+                self._index[digest] = (start, length)
+                self._size = start + length
+        return total
+
+    def _load_index(self):
+        if self._index is None:
+            self._index = {}
+            self._size = 0
+            LOG.debug("Indexing blobs in %s", self.filepath)
+            with _locked(self._lock_filepath):
+                total = self._scan()
+            if self._size < total:
+                # only the very last entry can be incomplete, if we
+                # died in the middle of writing it
+                LOG.warning("Ignoring truncated blob in %s", self.filepath)
+        return self._index
+
+    def _find(self, digest):
+        index = self._load_index()
+        if digest not in index:
+            # another process may have added it
+            with _locked(self._lock_filepath):
+                self._scan()
+        return index.get(digest)
+
+    def __len__(self):
+        return len(self._load_index())
+
+    def __contains__(self, digest):
+        return self._find(binascii.unhexlify(digest)) is not None
+
+    def __iter__(self):
+        """Iterate over the digests of all blobs in the store."""
+        for digest in self._load_index():
+            yield binascii.hexlify(digest).decode("ascii")
+
+    def get(self, digest):
+        entry = self._find(binascii.unhexlify(digest))
+        if entry is None:
+            raise KeyError(digest)
+        start, length = entry
+        if self._map is None or start + length > len(self._map):
+            # the file has grown since it was mapped
+            with open(self.filepath, "rb") as infile:
+                self._map = mmap.mmap(
+                    infile.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map[start:start + length].decode("utf-8")
+
+    def put(self, text):
+        """Add text to the store, if it isn't already there, and get a
+        BlobRef to it."""
+        if isinstance(text, six.text_type):
+            text = text.encode("utf-8")
+        digest = hashlib.sha1(text).digest()
+        index = self._load_index()
+        if digest not in index:
+            with _locked(self._lock_filepath, exclusive=True):
+                # catch up with entries from other processes, which
+                # may include this one
+                self._scan()
+                if digest not in index:
+                    self._append(digest, text)
+        return BlobRef(self, binascii.hexlify(digest).decode("ascii"))
+
+    def _append(self, digest, text):
+        """Add an entry. The caller must hold an exclusive lock."""
+        if self._outfile is None:
+            self._outfile = open(self.filepath, "ab")
+        # throw away any incomplete entry at the end; with the lock
+        # held, it can only be left over from a crash
+        self._outfile.truncate(self._size)
+        self._outfile.write(self._header.pack(digest, len(text)))
+        self._outfile.write(text)
+        # flush, so that the new entry can be mapped straight away,
+        # and seen by other processes
+        self._outfile.flush()
+        self._index[digest] = (self._size + self._header.size, len(text))
+        self._size += self._header.size + len(text)
+
+    def sync(self):
+        """Make sure that everything that's been added is on disk."""
+        if self._outfile is not None:
+            os.fsync(self._outfile.fileno())
+
+
+class BlobSerializer(Serializer):
+    cls = BlobRef
+
+    def __init__(self, database):
+        self.database = database
+
+    def encode(self, value):
+        return value.digest
+
+    def decode(self, value):
+        return BlobRef(self.database.blobs, value)
+
+
+class Codec(object):
+    """Serialize and deserialize whole records with a set of serializers.
+
+    Rather than offering each value to each serializer in turn, values
+    are encoded by looking up their exact type, and decoded by looking
+    up the tag in their magic prefix.
+    """
+
+    def __init__(self, serializers):
+        self.encoders = dict((s.cls, s) for s in serializers)
+        self.decoders = dict((s.tag, s) for s in serializers)
+
+    def encode_value(self, value):
+        serializer = self.encoders.get(type(value))
+        if serializer is None:
+            return value
+        return "{%s}%s" % (serializer.tag, serializer.encode(value))
+
+    def decode_value(self, value):
+        if isinstance(value, six.string_types) and value[:1] == "{":
+            end = value.find("}")
+            serializer = self.decoders.get(value[1:end])
+            if serializer is not None:
+                return serializer.decode(value[end + 1:])
+        return value
+
+    def encode(self, record):
+        encode_value = self.encode_value
+        return dict((k, encode_value(v)) for k, v in six.iteritems(record))
+
+    def decode(self, record):
+        decode_value = self.decode_value
+        return dict((k, decode_value(v)) for k, v in six.iteritems(record))
+
 
 class Fixture(collections.Mapping):
     def __init__(  # pylint: disable=super-init-not-called
@@ -124,7 +560,7 @@ class Fixture(collections.Mapping):
     def _load_data(self):
         if self._data is None:
             LOG.debug("Loading fixture data from %s", self._filepath)
-            raw_data = yaml.safe_load(open(self._filepath))
+            raw_data = utils.load_yaml(self._filepath)
             self._data = {r[self.key]: r for r in raw_data}
 
     def __getitem__(self, key):
@@ -146,169 +582,2833 @@ class Fixture(collections.Mapping):
         return repr(dict(self))
 
 
-class Database(collections.MutableSequence):
-    serializers = [DatetimeSerializer(), DateSerializer(), TimeSerializer()]
+def _key_hash(key):
+    """Hash a record key, the same way in every process and on every
+    version of Python."""
+    return int(
+        binascii.hexlify(
+            hashlib.md5(six.text_type(key).encode("utf-8")).digest()), 16)
 
-    def __init__(self, filename):  # pylint: disable=super-init-not-called
-        self.filename = filename
-        self._data = None
-        self._by_key = None
-        self._sync = True
-        self._needs_write = set()
 
-    @contextlib.contextmanager
-    def delay_write(self):
-        self._sync = False
-        yield
-        self._sync = True
-        self._save()
+class Sharding(object):
+    """A policy for dividing the records of a keyed database among
+    shards by their keys.
 
-    def get_shard(self, record):
+    The shard that a key belongs in must be decided by the key alone,
+    so that a record can be found without reading every shard. Shards
+    that grow past ``max_size`` bytes are split further by the
+    backend, if it supports that; without a ``max_size``, they never
+    are.
+    """
+    name = None
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+
+    def shard(self, key):
+        """Get the name of the shard that a key belongs in."""
+        raise NotImplementedError
+
+    def config(self):
+        """Get the settings that decide which shard each key belongs in,
+        as a dict that can be passed back to make_sharding()."""
+        return {"by": self.name}
+
+    def __eq__(self, other):
+        return (isinstance(other, Sharding)
+                and self.config() == other.config())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, ", ".join(
+            "%s=%r" % i for i in sorted(self.config().items())
+            if i[0] != "by"))
+
+
+class PrefixSharding(Sharding):
+    """Shard by the first ``length`` characters of the key, except that
+    keys that start with any of ``prefixes`` are sharded by that
+    prefix instead."""
+    name = "prefix"
+
+    def __init__(self, length=2, prefixes=(), max_size=None):
+        super(PrefixSharding, self).__init__(max_size=max_size)
+        self.length = length
+        self.prefixes = tuple(prefixes)
+
+    def shard(self, key):
+        for prefix in self.prefixes:
+            if key.startswith(prefix):
+                return prefix
+        return key.strip()[0:self.length].upper()
+
+    def config(self):
+        config = super(PrefixSharding, self).config()
+        config.update(length=self.length, prefixes=list(self.prefixes))
+        return config
+
+
+class HashSharding(Sharding):
+    """Shard by a hash of the key, into a fixed number of buckets."""
+    name = "hash"
+
+    def __init__(self, buckets=16, max_size=None):
+        super(HashSharding, self).__init__(max_size=max_size)
+        self.buckets = buckets
+
+    def shard(self, key):
+        return "h%02d" % (_key_hash(key) % self.buckets)
+
+    def config(self):
+        config = super(HashSharding, self).config()
+        config.update(buckets=self.buckets)
+        return config
+
+
+SHARDING = {
+    "prefix": PrefixSharding,
+    "hash": HashSharding,
+}
+
+
+def make_sharding(by="prefix", **settings):
+    """Create a sharding policy from its settings, as given in the
+    config file or saved with the list of shards."""
+    if by not in SHARDING:
+        raise ValueError("Unknown sharding policy %s; choose from %s" %
+                         (by, ", ".join(sorted(SHARDING))))
+    try:
+        return SHARDING[by](**{str(k): v for k, v in settings.items()})
+    except TypeError as err:
+        raise ValueError("Bad settings for %s sharding: %s" % (by, err))
+
+
+@six.add_metaclass(abc.ABCMeta)
+class Backend(object):
+    """Storage for the serialized records of a single database.
+
+    Records are addressed by position or, in keyed databases, by
+    key. Backends don't save changes until save() is called.
+
+    A backend may split its records into shards, with each key
+    belonging to exactly one shard; backends that don't shard their
+    records have a single shard, None.
+    """
+
+    def __init__(self, database, location):
+        self.database = database
+        self.location = location
+
+    @property
+    def directory(self):
+        """The directory that the backend keeps its files in."""
+        return self.location
+
+    @abc.abstractproperty
+    def loaded(self):
+        """Whether or not any data has been read from storage yet."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def __len__(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def __iter__(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get(self, idx):
+        """Get the record at the given position."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set(self, idx, record):
+        """Replace the record at the given position."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def insert(self, idx, record):
+        """Insert a record before the given position."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete(self, idx):
+        """Delete the record at the given position."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def contains(self, key):
+        """Whether or not a record with the given key exists."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def fetch(self, key):
+        """Get the record with the given key, or None."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def store(self, record, fields=None):
+        """Replace the existing record with the same key as ``record``.
+
+        If ``fields`` is given, only those fields have changed, and
+        backends that merge their changes with other processes' keep
+        any changes that were made to the other fields meanwhile.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def remove(self, key):
+        """Delete the record with the given key."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def save(self, force=False):
+        """Write outstanding changes to storage."""
+        raise NotImplementedError
+
+    # how often, in seconds, to check whether another process has
+    # changed data that's already been read
+    reload_interval = 1.0
+
+    # whether contains() is answered from an index in storage, without
+    # reading any records
+    indexed_keys = False
+
+    def shards(self):
+        return [None]
+
+    def refresh(self, shard):
+        """Read a shard again if another process has changed it since
+        it was read, checking at most every ``reload_interval``
+        seconds."""
+        pass
+
+    def key_shard(self, key):  # pylint: disable=unused-argument,no-self-use
+        """Get the shard that a key belongs in."""
         return None
 
+    def shard_records(self, shard):  # pylint: disable=unused-argument
+        """Get the records in a shard, as they are on disk now."""
+        return iter(self)
+
+    def release(self, shard):
+        """Drop the records of a shard from memory, unless there are
+        unsaved changes to it; they're read again when they're next
+        needed. Backends that don't hold records in memory have
+        nothing to do."""
+        pass
+
+    def rebalance(self):
+        """Move records between shards according to the database's
+        sharding policy, saving any changes first. Returns the new
+        list of shards.
+
+        Backends that don't shard their records have nothing to do.
+        """
+        self.save()
+        return self.shards()
+
+    @abc.abstractmethod
+    def shard_stamp(self, shard):
+        """Describe the current state of a shard's files on disk, so
+        that data derived from them can tell when it's stale."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def known_stamp(self, shard):
+        """Get the stamp of a shard as it was when its records were
+        last read or written, or None if there are unsaved changes to
+        it."""
+        raise NotImplementedError
+
+    def append(self, record):
+        self.insert(len(self), record)
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def project(self, fields):
+        """Iterate over the records, with only the given fields."""
+        for record in self:
+            yield _project(record, fields)
+
+    def stream(self, fields=None):
+        """Iterate over the records, optionally with only some fields,
+        without holding them all in memory, where the backend can."""
+        if fields is None:
+            return iter(self)
+        return self.project(fields)
+
+
+def _project(record, fields):
+    return {f: record[f] for f in fields if f in record}
+
+
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_JSON_DELIMITERS = frozenset(" \t\n\r,]")
+
+
+def _iter_json_array(infile, chunk_size=64 * 1024):
+    """Decode a JSON array from a file one element at a time, so that
+    only one element (and one chunk of the file) is ever in memory."""
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    eof = False
+    # what's expected next: the opening bracket, the first element
+    # (or the closing bracket), an element, or a comma (or the
+    # closing bracket)
+    expect = "start"
+    while True:
+        pos = _JSON_WHITESPACE.match(buf, pos).end()
+        if pos == len(buf) and not eof:
+            chunk = infile.read(chunk_size)
+            eof = not chunk
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+
+        char = buf[pos:pos + 1]
+        if expect == "start":
+            if char != "[":
+                raise ValueError("Expected a JSON array at position %s" % pos)
+            expect = "first"
+            pos += 1
+        elif char == "]" and expect in ("first", "comma"):
+            return
+        elif expect == "comma":
+            if char != ",":
+                raise ValueError("Expected , or ] at position %s" % pos)
+            expect = "element"
+            pos += 1
+        else:
+            try:
+                element, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+                end = None
+            if end is None or (buf[end:end + 1] not in _JSON_DELIMITERS
+                               and not eof):
+                # the element (a number, say) may carry on past what's
+                # been read
+                chunk = infile.read(chunk_size)
+                eof = not chunk
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+            yield element
+            expect = "comma"
+            pos = end
+
+
+def _copy_container(value):
+    """Deeply copy a dict or list from a record.
+
+    Records only ever hold JSON-compatible containers, which this
+    copies much faster than copy.deepcopy().
+    """
+    if isinstance(value, dict):
+        return {
+            k: _copy_container(v) if isinstance(v, (dict, list)) else v
+            for k, v in six.iteritems(value)
+        }
+    return [
+        _copy_container(v) if isinstance(v, (dict, list)) else v
+        for v in value
+    ]
+
+
+def _copy_record(record):
+    return {
+        k: _copy_container(v) if isinstance(v, (dict, list)) else v
+        for k, v in six.iteritems(record)
+    }
+
+
+_MISSING = object()
+
+
+class Columns(object):
+    """The layout of the values in a group of compact rows."""
+
+    def __init__(self, names):
+        self.names = tuple(names)
+        self.positions = {n: i for i, n in enumerate(self.names)}
+
+
+class Row(collections.Mapping):
+    """A compact, read-only record.
+
+    The values of the fields in the row's Columns are kept in a tuple,
+    so the field names themselves are stored once for all of the rows
+    that share the Columns, rather than once per record. The tuple
+    stops at the last field the record has, so if the Columns are
+    ordered from most to least common, records with few fields stay
+    small. Any other fields are kept in a small dict on the side.
+    """
+
+    __slots__ = ("columns", "values", "extra")
+
+    def __init__(self, columns, values, extra=None):
+        self.columns = columns
+        self.values = values
+        self.extra = extra
+
+    @classmethod
+    def from_record(cls, columns, record, share=None):
+        """Build a row from a dict.
+
+        ``share``, if it's given, is called with each key and value,
+        and returns an equal object that can be shared with other
+        rows.
+        """
+        positions = columns.positions
+        values = [_MISSING] * len(columns.names)
+        end = 0
+        extra = None
+        for key, val in six.iteritems(record):
+            if share is not None:
+                val = share(val)
+            pos = positions.get(key)
+            if pos is not None:
+                values[pos] = val
+                end = max(end, pos + 1)
+            else:
+                if extra is None:
+                    extra = {}
+                if share is not None:
+                    key = share(key)
+                extra[key] = val
+        return cls(columns, tuple(values[:end]), extra)
+
+    def __getitem__(self, key):
+        pos = self.columns.positions.get(key)
+        if pos is not None:
+            if pos < len(self.values) and self.values[pos] is not _MISSING:
+                return self.values[pos]
+        elif self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def iteritems(self):
+        for name, val in six.moves.zip(self.columns.names, self.values):
+            if val is not _MISSING:
+                yield name, val
+        if self.extra is not None:
+            for item in six.iteritems(self.extra):
+                yield item
+
+    def __iter__(self):
+        for name, _ in self.iteritems():
+            yield name
+
+    def __len__(self):
+        return (len(self.values) - self.values.count(_MISSING) +
+                len(self.extra or ()))
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, dict(self.iteritems()))
+
+
+class JSONBackend(Backend):
+    """Sharded JSON files.
+
+    Each shard is read into memory in its entirety, but only once it's
+    needed: looking up a record by key reads just the shard that would
+    contain it, while anything positional (including iteration) reads
+    every shard. Records are kept grouped by shard, in the order the
+    shards are listed in.
+
+    If the database is compact, records are kept in memory as Rows,
+    with one Columns layout per shard, and all of the records share a
+    single copy of each distinct string.
+
+    Records can also be streamed from the files without keeping them:
+    each shard that isn't already in memory is decoded one record at
+    a time, unless it has a journal, which can only be replayed over
+    the whole shard.
+
+    Several processes can use the same files at once. Each shard is
+    read and written under an advisory lock on it, and a shard that's
+    already been read is read again if another process has changed
+    it. Changes that haven't been saved are kept as a list of journal
+    entries, whether or not the database is journaled, so that if the
+    shard has changed on disk when they're saved, they can be
+    replayed over the other process's version of it.
+
+    Keyed databases are divided among shards by their sharding policy,
+    which is saved with the list of shards. Once a shard is written
+    past the policy's ``max_size``, it's split by a hash of its keys
+    into ``split_ways`` pieces, named after it; a key belongs in a
+    piece whenever its shard has been split. Other processes pick up
+    splits when they next read the list of shards, and move any
+    unsaved changes to the pieces.
+    """
+
+    # fields that are in fewer than this fraction of the records in a
+    # shard are kept out of the shard's Columns
+    sparse_fraction = 0.05
+
+    # number of shards to write at once
+    write_threads = 4
+
+    # number of pieces to split a shard into once it grows too large
+    split_ways = 4
+
+    def __init__(self, database, location):
+        super(JSONBackend, self).__init__(database, location)
+        self._shards = None
+        self._on_disk = None
+        self._listed = None
+        self._sharding = None
+        self._records = {}
+        self._by_key = {}
+        self._columns = {}
+        self._strings = {}
+        self._stamps = {}
+        self._list_stamp = None
+        self._checked = {}
+        self._needs_write = set()
+        self._pending = collections.defaultdict(list)
+
+    @property
+    def loaded(self):
+        return bool(self._records)
+
     def _get_filepath(self, suffix=None):
-        if _DB_PATH is None:
-            raise DatabaseNotReady(self.filename)
         if suffix is None:
-            filename = self.filename
+            filename = self.database.filename
         else:
-            name, ext = os.path.splitext(self.filename)
+            name, ext = os.path.splitext(self.database.filename)
             filename = "%s-%s%s" % (name, suffix, ext)
-        return os.path.join(_DB_PATH, filename)
-
-    def _load(self, force=False):
-        if force or self._data is None:
-            self._data = []
-            shards = [None]
-            shard_filepath = self._get_filepath(suffix="shards")
-            if os.path.exists(shard_filepath):
-                LOG.debug("Loading list of shards from %s", shard_filepath)
-                shards = json.load(open(shard_filepath))
-
-            for shard in shards:
-                filepath = self._get_filepath(suffix=shard)
-                LOG.debug("Loading data from %s", filepath)
-                shard_data = json.load(open(filepath))
-                self._data.extend(shard_data)
-
-    def _shard_data(self):
-        shards = collections.defaultdict(list)
-        for record in self._data:
-            shards[self.get_shard(record)].append(record)
-        return shards
+        return os.path.join(self.location, filename)
+
+    def _get_journal_filepath(self, suffix=None):
+        return "%s.journal" % os.path.splitext(self._get_filepath(suffix))[0]
+
+    def _get_lock_filepath(self, suffix=None):
+        return "%s.lock" % os.path.splitext(self._get_filepath(suffix))[0]
+
+    def _read_shard_list(self):
+        shard_filepath = self._get_filepath(suffix="shards")
+        self._list_stamp = _file_stamp(shard_filepath)
+        if os.path.exists(shard_filepath):
+            LOG.debug("Loading list of shards from %s", shard_filepath)
+            listed = json.load(open(shard_filepath))
+            if isinstance(listed, dict):
+                self._sharding = make_sharding(**listed["sharding"])
+                listed = listed["shards"]
+            return listed
+        elif os.path.exists(self._get_filepath()):
+            return [None]
+        LOG.debug("%s does not exist yet", self._get_filepath())
+        return []
+
+    def _load_shard_list(self):
+        if self._shards is None:
+            self._shards = self._read_shard_list()
+            if self._list_stamp[1] is not None:
+                self._listed = list(self._shards)
+            self._on_disk = set(self._shards)
+            if (self._sharding is not None
+                    and self.database.sharding is not None
+                    and self._sharding != self.database.sharding):
+                LOG.warning(
+                    "%s is sharded by %r, not %r as configured; run "
+                    "'crashes rebalance' to reshard it",
+                    self.database.filename, self._sharding,
+                    self.database.sharding)
+        return self._shards
 
-    def _save(self, force=False):
-        if not self._sync:
+    @property
+    def sharding(self):
+        """The sharding policy that the shards on disk follow: the one
+        saved with the list of shards, or else the database's own."""
+        self._load_shard_list()
+        return self._sharding or self.database.sharding
+
+    def _list_changed(self):
+        return (_file_stamp(self._get_filepath(suffix="shards")) !=
+                self._list_stamp)
+
+    def _refresh_shard_list(self):
+        """Pick up any shards that other processes have added, and drop
+        any that they've split or rebalanced away."""
+        if self._shards is None or not self._list_changed():
             return
-
-        sharded_data = self._shard_data()
+        listed = self._read_shard_list()
+        added = [s for s in listed if s not in self._shards]
+        if added:
+            LOG.debug("Found new shards %s for %s", added,
+                      self.database.filename)
+            self._shards.extend(added)
+        removed = []
+        if self.database.key is not None:
+            # a shard that was never listed is only gone if another
+            # process created it too, and then split it
+            removed = [
+                s for s in self._shards if s not in listed and (
+                    s in (self._listed or []) or self._is_split(s, listed))
+            ]
+        self._listed = listed
+        self._on_disk.update(listed)
+        if removed:
+            self._drop_shards(removed)
+
+    def _drop_shards(self, shards):
+        """Forget shards that another process has split or rebalanced
+        away, and move any unsaved changes to them to the shards that
+        their records belong in now."""
+        entries = []
+        for shard in shards:
+            LOG.info("%s was split or rebalanced by another process",
+                     self._get_filepath(suffix=shard))
+            self._shards.remove(shard)
+            entries.extend(self._pending.pop(shard, []))
+            for state in (self._records, self._by_key, self._columns,
+                          self._stamps, self._checked):
+                state.pop(shard, None)
+            self._needs_write.discard(shard)
+            self._on_disk.discard(shard)
+            self.database._reloaded(shard)  # pylint: disable=protected-access
+
+        key = self.database.key
+        while entries:
+            moved = collections.OrderedDict()
+            for entry in entries:
+                entry_key = entry[1] if entry[0] == "x" else entry[1][key]
+                moved.setdefault(self.key_shard(entry_key),
+                                 []).append((entry_key, entry))
+            entries = []
+            for shard, shard_entries in moved.items():
+                old_records = self._load_shard(shard)
+                if old_records is None:
+                    if self.key_shard(shard_entries[0][0]) != shard:
+                        # it's been split again since the list of
+                        # shards was read
+                        entries.extend(e for _, e in shard_entries)
+                        continue
+                    self._add_shard(shard)
+                    old_records = []
+                shard_entries = [e for _, e in shard_entries]
+                self._set_shard(
+                    shard,
+                    self._replay([dict(r) for r in old_records],
+                                 shard_entries))
+                self._pending[shard].extend(shard_entries)
+                self._needs_write.add(shard)
+                self.database._reloaded(  # pylint: disable=protected-access
+                    shard, old_records, self._records[shard])
+
+    def shards(self):
+        self._refresh_shard_list()
+        return list(self._load_shard_list())
+
+    def shard_stamp(self, shard):
+        return [
+            _file_stamp(self._get_filepath(suffix=shard)),
+            _file_stamp(self._get_journal_filepath(suffix=shard)),
+            _generation(self._get_lock_filepath(shard))
+        ]
+
+    def known_stamp(self, shard):
+        if shard in self._needs_write or shard in self._pending:
+            return None
+        return self._stamps.get(shard)
+
+    def _has_files(self, shard):
+        """Whether a shard has a file or a journal."""
+        return (os.path.exists(self._get_filepath(suffix=shard))
+                or os.path.exists(self._get_journal_filepath(suffix=shard)))
+
+    def _read_shard(self, shard):
+        """Read a shard, and replay its journal. The caller must hold a
+        lock on the shard."""
+        filepath = self._get_filepath(suffix=shard)
+        records = []
+        if os.path.exists(filepath):
+            LOG.debug("Loading data from %s", filepath)
+            with _open_shard_file(filepath) as infile:
+                records = json.load(infile)
+        # a new shard is always written in full, but a journal with no
+        # shard file next to it still holds the only copy of its changes
+        entries = self._read_journal(shard)
+        if entries:
+            LOG.debug("Replaying %s journal entries over %s", len(entries),
+                      filepath)
+            records = self._replay(records, entries)
+        return records
+
+    def _set_shard(self, shard, records):
+        if self.database.compact:
+            records = self._compact(shard, records)
+        self._records[shard] = records
+        self._index_keys(shard)
+
+    def _load_shard(self, shard, check=False):
+        """Read a single shard into memory, if it isn't already.
+
+        If it is, and it's been ``reload_interval`` seconds since it
+        was last checked (or ``check`` is set), it's read again if
+        another process has changed it.
+
+        Returns the records in the shard, or None if there is no such
+        shard.
+        """
+        if shard in self._records:
+            now = time.time()
+            last = self._checked.get(shard, 0)
+            if check or now - last > self.reload_interval:
+                self._checked[shard] = now
+                if self.shard_stamp(shard) != self._stamps.get(shard):
+                    # another process may have split the shard, rather
+                    # than changed it
+                    self._refresh_shard_list()
+                    if shard not in self._records:
+                        return None
+                    with _locked(self._get_lock_filepath(shard)):
+                        split = self._list_changed()
+                        if not split:
+                            self._reload_shard(shard)
+                    if split:
+                        return self._load_shard(shard, check=True)
+            return self._records[shard]
+
+        if shard not in self._load_shard_list():
+            self._refresh_shard_list()
+            if shard not in self._shards:
+                return None
+        if self._has_files(shard):
+            with _locked(self._get_lock_filepath(shard)):
+                self._stamps[shard] = self.shard_stamp(shard)
+                records = self._read_shard(shard)
+        else:
+            # there's nothing to read, so there's no need for a lock,
+            # and no lock file is made for a shard that doesn't exist
+            self._stamps[shard] = self.shard_stamp(shard)
+            records = []
+        if not records:
+            # the shard may be empty because another process has split
+            # it since the list of shards was read
+            self._refresh_shard_list()
+            if shard not in self._shards:
+                return None
+        self._checked[shard] = time.time()
+        self._set_shard(shard, records)
+        return self._records[shard]
+
+    def _reload_shard(self, shard):
+        """Read a shard again if another process has changed it, and
+        replay any unsaved changes over the new version. The caller
+        must hold a lock on the shard."""
+        stamp = self.shard_stamp(shard)
+        if stamp == self._stamps.get(shard):
+            return
+        LOG.info("%s was changed by another process, reloading",
+                 self._get_filepath(suffix=shard))
+        records = self._read_shard(shard)
+        entries = self._pending.get(shard)
+        if entries:
+            if (self.database.key is None
+                    and any(e[0] != "a" for e in entries)):
+                # only appends can be replayed by position over
+                # someone else's changes
+                raise ConcurrentModification(
+                    "%s was changed by another process while it was "
+                    "being changed" % self._get_filepath(suffix=shard))
+            records = self._replay(records, entries)
+        old_records = self._records.get(shard, [])
+        self._stamps[shard] = stamp
+        self._set_shard(shard, records)
+        self._on_disk.add(shard)
+        self.database._reloaded(  # pylint: disable=protected-access
+            shard, old_records, self._records[shard])
+
+    def _load(self):
+        self._refresh_shard_list()
+        for shard in self._load_shard_list():
+            self._load_shard(shard)
+
+    def shard_records(self, shard):
+        return self._load_shard(shard, check=True) or []
+
+    def refresh(self, shard):
+        if shard in self._records:
+            self._load_shard(shard)
+
+    def release(self, shard):
+        if (shard not in self._records or shard in self._needs_write
+                or shard in self._pending):
+            return
+        LOG.debug("Releasing shard %s of %s", shard, self.database.filename)
+        for state in (self._records, self._by_key, self._columns,
+                      self._stamps, self._checked):
+            state.pop(shard, None)
+        if not self._records:
+            self._strings = {}
+
+    def _intern(self, value):
+        """Share a single copy of each distinct string in a value, which
+        may be (or contain) a dict or list."""
+        if isinstance(value, six.string_types):
+            # intern() doesn't accept unicode on Python 2, so do it by
+            # hand
+            return self._strings.setdefault(value, value)
+        elif isinstance(value, dict):
+            return {
+                self._intern(k): self._intern(v)
+                for k, v in six.iteritems(value)
+            }
+        elif isinstance(value, list):
+            return [self._intern(v) for v in value]
+        return value
+
+    def _compact(self, shard, records):
+        """Convert the records in a shard to Rows with a shared layout."""
+        counts = collections.Counter(k for r in records for k in r)
+        threshold = len(records) * self.sparse_fraction
+        self._columns[shard] = Columns(
+            self._intern(k)
+            for k in sorted(counts, key=lambda k: (-counts[k], k))
+            if counts[k] >= threshold)
+        return [self._pack(shard, r) for r in records]
+
+    def _pack(self, shard, record):
+        if not self.database.compact:
+            return record
+        if shard not in self._columns:
+            self._columns[shard] = Columns(
+                sorted(self._intern(k) for k in record))
+        return Row.from_record(self._columns[shard], record, self._intern)
+
+    def _index_keys(self, shard):
+        if self.database.key is not None:
+            self._by_key[shard] = {
+                r[self.database.key]: i
+                for i, r in enumerate(self._records[shard])
+            }
+
+    @staticmethod
+    def _piece(shard, bucket):
+        return "%s.%s" % (shard, bucket)
+
+    @staticmethod
+    def _is_split(shard, shards):
+        prefix = "%s." % shard
+        return any(s.startswith(prefix) for s in shards if s is not None)
+
+    def _bucket(self, key, depth):
+        """Get the piece that a key goes in when a shard that's already
+        been split ``depth`` times is split again."""
+        # the high bits of the hash are used, so that the buckets are
+        # independent of those of HashSharding
+        return ((_key_hash(key) >> 64) // self.split_ways**depth %
+                self.split_ways)
+
+    def key_shard(self, key):
+        sharding = self.sharding
+        if sharding is None:
+            return self.database.get_shard({self.database.key: key})
+        shard = sharding.shard(key)
+        depth = 0
+        while (shard not in self._shards
+               and self._is_split(shard, self._shards)):
+            shard = self._piece(shard, self._bucket(key, depth))
+            depth += 1
+        return shard
+
+    def _record_shard(self, record):
+        if self.database.key is None:
+            return self.database.get_shard(record)
+        return self.key_shard(record[self.database.key])
+
+    def _load_key_shard(self, key):
+        """Find the shard that a key belongs in, and read it.
+
+        Returns the shard and its records, or None for the records if
+        the shard doesn't exist.
+        """
+        shard = self.key_shard(key)
+        records = self._load_shard(shard)
+        if records is None and self.key_shard(key) != shard:
+            # reading the shard found that it had just been split
+            shard = self.key_shard(key)
+            records = self._load_shard(shard)
+        return shard, records
+
+    def _locate(self, idx):
+        """Find the shard, and index within it, of a database index."""
+        self._load()
+        if idx < 0:
+            idx += len(self)
+        if idx >= 0:
+            for shard in self._shards:
+                if idx < len(self._records[shard]):
+                    return shard, idx
+                idx -= len(self._records[shard])
+        raise IndexError("database index out of range")
+
+    def _read_journal(self, suffix):
+        filepath = self._get_journal_filepath(suffix=suffix)
+        if not os.path.exists(filepath):
+            return []
+        entries = []
+        with open(filepath) as journal:
+            for line in journal:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # only the very last entry can be incomplete, if
+                    # we died in the middle of appending it
+                    LOG.warning("Ignoring truncated journal entry in %s",
+                                filepath)
+                    break
+        return entries
+
+    def _journal_entry(self, operation, shard, shard_idx, record,
+                       fields=None):
+        """Build a journal entry describing a change to a single record.
+
+        ``operation`` is one of "set", "insert", or "delete". Keyed
+        databases are journaled by key, so entries can be replayed
+        without knowing where in the shard the record lives; entries
+        for unkeyed databases record the index within the shard. If
+        only some ``fields`` of a keyed record were set, only they are
+        journaled, so that replaying the entry over another process's
+        changes to the record doesn't undo them.
+        """
+        key = self.database.key
+        if key is not None:
+            if operation == "delete":
+                return ["x", record[key]]
+            elif operation == "set" and fields is not None:
+                changed = {f: record[f] for f in fields if f in record}
+                changed[key] = record[key]
+                return ["m", changed]
+            return ["p", record]
+
+        if (operation == "insert"
+                and shard_idx == len(self._records[shard]) - 1):
+            return ["a", record]
+        if operation == "delete":
+            return ["d", shard_idx]
+        return [operation[0], shard_idx, record]
+
+    def _replay(self, records, entries):
+        """Apply journal entries to the records loaded from a shard."""
+        if self.database.key is not None:
+            return self._replay_keyed(records, entries)
+
+        for entry in entries:
+            if entry[0] == "a":
+                records.append(entry[1])
+            elif entry[0] == "i":
+                records.insert(entry[1], entry[2])
+            elif entry[0] == "s":
+                records[entry[1]] = entry[2]
+            elif entry[0] == "d":
+                del records[entry[1]]
+        return records
+
+    def _replay_keyed(self, records, entries):
+        key = self.database.key
+        by_key = {r[key]: i for i, r in enumerate(records)}
+        for operation, arg in entries:
+            if operation == "p":
+                if arg[key] in by_key:
+                    records[by_key[arg[key]]] = arg
+                else:
+                    by_key[arg[key]] = len(records)
+                    records.append(arg)
+            elif operation == "m":
+                if arg[key] in by_key:
+                    record = dict(records[by_key[arg[key]]])
+                    record.update(arg)
+                    records[by_key[arg[key]]] = record
+                else:
+                    LOG.warning("Dropping changes to %s, which no longer "
+                                "exists", arg[key])
+            elif operation == "x" and arg in by_key:
+                records[by_key.pop(arg)] = None
+        return [r for r in records if r is not None]
+
+    def _record_change(self, operation, shard, shard_idx, record,
+                       fields=None):
+        self._needs_write.add(shard)
+        self._pending[shard].append(
+            self._journal_entry(operation, shard, shard_idx, record, fields))
+
+    @staticmethod
+    def _write_uninterruptibly(func, *args):
+        """Run a database write to completion, even across Ctrl-C.
+
+        Returns True if the write was interrupted, in which case the
+        caller should abort once all of its writes are done.
+        """
+        interrupted = False
+        while True:
+            try:
+                func(*args)
+                return interrupted
+            except (SystemExit, KeyboardInterrupt):
+                LOG.info("Caught Ctrl-C, "
+                         "aborting after database writes are complete")
+                interrupted = True
+
+    @staticmethod
+    def _write_file(filepath, data):
+        """Replace a file, without ever leaving it partially written.
+
+        The data is written to a temporary file next to the real one,
+        synced to disk, and then renamed over the real file, so a crash
+        at any point leaves either the old contents or the new.
+        """
+        tmp_filepath = "%s.tmp" % filepath
+        if isinstance(data, six.text_type):
+            data = data.encode("utf-8")
+        with open(tmp_filepath, "wb") as outfile:
+            outfile.write(data)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.rename(tmp_filepath, filepath)
+
+        # make sure the rename itself is on disk, too
+        dirfd = os.open(os.path.dirname(filepath) or ".", os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+
+    def _encode_shard(self, records):
+        data = json.dumps(records, separators=(',', ':'), default=dict)
+        if self.database.compression is None:
+            return data
+        if isinstance(data, six.text_type):
+            data = data.encode("utf-8")
+        return self.database.compression.compress(data)
+
+    def _write_shard(self, suffix, records):
+        filepath = self._get_filepath(suffix=suffix)
+        LOG.debug("Saving %s records to %s", len(records), filepath)
+        self._write_file(filepath, self._encode_shard(records))
+
+        journal_filepath = self._get_journal_filepath(suffix=suffix)
+        if os.path.exists(journal_filepath):
+            LOG.debug("Folded journal %s into %s", journal_filepath, filepath)
+            os.unlink(journal_filepath)
+
+    def _write_shard_list(self, shards):
+        shard_filepath = self._get_filepath(suffix="shards")
+        LOG.debug("Saving list of shards to %s", shard_filepath)
+        listed = list(shards)
+        if self.database.key is not None and self.sharding is not None:
+            listed = {"sharding": self.sharding.config(), "shards": listed}
+        self._write_file(shard_filepath,
+                         json.dumps(listed, separators=(',', ':')))
+
+    @staticmethod
+    def _wait(result):
+        # waiting with a timeout, rather than without one, lets Ctrl-C
+        # through on Python 2
+        while not result.ready():
+            result.wait(1)
+
+    @staticmethod
+    def _append_journal(filepath, offset, data):
+        with open(filepath, "a") as journal:
+            # if a previous attempt was interrupted, throw away
+            # whatever part of it made it to disk
+            journal.truncate(offset)
+            journal.write(data)
+
+    def _flush_shard(self, suffix, full):
+        """Write out the pending changes to a shard, by appending them
+        to its journal or, if ``full`` is set or the journal has grown
+        too large, by writing the whole shard. The caller must hold an
+        exclusive lock on the shard.
+
+        Returns True if the write was interrupted.
+        """
+        entries = self._pending.pop(suffix, [])
         abort = False
-        wrote_any_shard = False
-        for suffix, records in sharded_data.items():
+        if not full:
+            filepath = self._get_journal_filepath(suffix=suffix)
+            offset = 0
+            if os.path.exists(filepath):
+                offset = os.path.getsize(filepath)
+            data = "".join(
+                "%s\n" % json.dumps(e, separators=(',', ':'), default=dict)
+                for e in entries)
+            LOG.debug("Appending %s entries to %s", len(entries), filepath)
+            abort = self._write_uninterruptibly(self._append_journal,
+                                                filepath, offset, data)
+            full = offset + len(data) > self.database.journal_max_size
+        if full:
+            abort |= self._write_uninterruptibly(
+                self._write_shard, suffix, self._records[suffix])
+        _count_write(self._get_lock_filepath(suffix))
+        self._stamps[suffix] = self.shard_stamp(suffix)
+        self._on_disk.add(suffix)
+        return abort
+
+    def _write_shards(self, suffixes, full=True):
+        """Write out the pending changes to several shards, concurrently.
+
+        All of the shards are locked first, and any that another
+        process has changed since they were read are reloaded, with
+        the pending changes replayed over them. Shards that aren't on
+        disk yet are always written in full. If another process has
+        split any of the shards meanwhile, the changes to them are
+        moved to the pieces, and written there instead.
+
+        Returns True if the writes were interrupted.
+        """
+        if not suffixes:
+            return False
+
+        locks = []
+        try:
+            # always lock shards in the same order, so that two
+            # processes can never each be waiting on the other
+            for suffix in sorted(suffixes, key=str):
+                locks.append(
+                    _lock(self._get_lock_filepath(suffix), exclusive=True))
+            if not self._list_changed():
+                return self._flush_shards(suffixes, full)
+        finally:
+            for lock in locks:
+                _unlock(lock)
+
+        # the list of shards has changed, so some of these may have
+        # been split; changes to them are moved to the pieces without
+        # holding any locks, since that can mean reading the pieces
+        self._refresh_shard_list()
+        suffixes = [s for s in suffixes if s in self._records]
+        moved = [s for s in self._pending if s not in suffixes]
+        self._needs_write.difference_update(moved)
+        return self._write_shards(suffixes + moved, full)
+
+    def _flush_shards(self, suffixes, full):
+        """Write out the pending changes to several shards, which the
+        caller must hold exclusive locks on."""
+        for suffix in suffixes:
+            self._reload_shard(suffix)
+        # a shard with no shard file yet is always written in full, so
+        # that its journal is never the only copy of it
+        jobs = [(s, full or s not in self._on_disk
+                 or not os.path.exists(self._get_filepath(suffix=s)))
+                for s in suffixes]
+
+        if len(jobs) == 1:
+            return self._flush_shard(*jobs[0])
+
+        # threads, rather than processes, so that the records don't
+        # need to be pickled; the GIL is released while the shards are
+        # written and synced to disk
+        workers = pool.ThreadPool(min(self.write_threads, len(jobs)))
+        result = workers.map_async(
+            lambda job: self._flush_shard(*job), jobs, chunksize=1)
+        workers.close()
+        abort = self._write_uninterruptibly(self._wait, result)
+        workers.join()
+        # re-raise any exception from a worker thread
+        return any(result.get()) or abort
+
+    def _save_shard_list(self):
+        """Write the list of shards, if it has changed since it was last
+        read or written.
+
+        Returns True if the write was interrupted.
+        """
+        if self._listed == self._shards:
+            return False
+        with _locked(self._get_lock_filepath("shards"), exclusive=True):
+            # another process may have added shards of its own
+            self._refresh_shard_list()
+            listed = self._listed or []
+            shards = listed + [s for s in self._shards if s not in listed]
+            if self._listed is not None and shards == listed:
+                return False
+            abort = self._write_uninterruptibly(self._write_shard_list,
+                                                shards)
+            self._listed = shards
+            self._list_stamp = _file_stamp(
+                self._get_filepath(suffix="shards"))
+        return abort
+
+    def _save_journal(self):
+        """Append pending journal entries to each shard's journal.
+
+        New shards, and shards whose journals have grown too large,
+        are written out in full instead.
+        """
+        suffixes = list(self._pending)
+        abort = self._write_shards(suffixes, full=False)
+        self._needs_write.clear()
+        abort |= self._save_shard_list()
+        abort |= self._split_large_shards(suffixes)
+
+        if abort:
+            raise SystemExit("Caught Ctrl-C during database write")
+
+    def save(self, force=False):
+        if not self.loaded:
+            return
+
+        if not os.path.isdir(self.location):
+            # e.g., a new location that the databases are being
+            # migrated to
+            try:
+                os.makedirs(self.location)
+            except OSError:
+                if not os.path.isdir(self.location):
+                    raise
+
+        if self.database.journal and not force:
+            self._save_journal()
+            return
+
+        dirty = []
+        for suffix in self._shards:
+            if suffix not in self._records:
+                LOG.debug("Shard %s was never loaded, skipping write", suffix)
+                continue
             if not force and suffix not in self._needs_write:
                 LOG.debug("Shard %s has no new data, skipping write", suffix)
                 continue
-            if suffix in self._needs_write:
-                self._needs_write.remove(suffix)
+            self._needs_write.discard(suffix)
+            dirty.append(suffix)
 
-            write_success = False
-            while not write_success:
-                try:
-                    filepath = self._get_filepath(suffix=suffix)
-                    LOG.debug("Saving %s records to %s", len(records),
-                              filepath)
-                    json.dump(
-                        records, open(filepath, "w"), separators=(',', ':'))
-                    write_success = True
-                    wrote_any_shard = True
-                except (SystemExit, KeyboardInterrupt):
-                    LOG.info("Caught Ctrl-C, "
-                             "aborting after database writes are complete")
-                    abort = True
-
-        if wrote_any_shard:
-            write_success = False
-            while not write_success:
-                try:
-                    shard_filepath = self._get_filepath(suffix="shards")
-                    LOG.debug("Saving list of shards to %s", shard_filepath)
-                    json.dump(
-                        sharded_data.keys(),
-                        open(shard_filepath, "w"),
-                        separators=(',', ':'))
-                    write_success = True
-                except (SystemExit, KeyboardInterrupt):
-                    LOG.info("Caught Ctrl-C, "
-                             "aborting after database writes are complete")
-                    abort = True
+        abort = self._write_shards(dirty)
+        # the list of shards goes last, so it never lists a shard
+        # that hasn't been written
+        abort |= self._save_shard_list()
+        abort |= self._split_large_shards(dirty)
 
         if abort:
             raise SystemExit("Caught Ctrl-C during database write")
 
-    def sync(self):
-        self._save(force=True)
+    def _split_large_shards(self, shards):
+        """Split any of the given shards that have been written past the
+        configured maximum size.
 
-    def _serialize(self, record):
-        retval = {}
-        for key, val in record.items():
-            for serializer in self.serializers:
-                try:
-                    retval[key] = serializer.serialize(val)
-                    break
-                except SerializationNotSupported:
-                    pass
-            else:
-                retval[key] = val
+        Returns True if the writes were interrupted.
+        """
+        if (self.database.key is None or self.database.sharding is None
+                or not self.database.sharding.max_size):
+            return False
+        abort = False
+        for shard in shards:
+            filepath = self._get_filepath(suffix=shard)
+            if (len(self._records.get(shard, [])) > 1
+                    and os.path.exists(filepath) and os.path.getsize(filepath)
+                    > self.database.sharding.max_size):
+                abort |= self._split_shard(shard)
+        return abort
+
+    def _split_shard(self, shard):
+        """Split a shard into ``split_ways`` pieces, by a hash of the keys.
+
+        The pieces are written before the list of shards is changed to
+        name them instead of the shard, and the shard's own files are
+        only removed after that, so that the shards that are listed
+        always hold every record.
+
+        Returns True if the writes were interrupted.
+        """
+        with _locked(self._get_lock_filepath("shards"), exclusive=True):
+            # pick up splits by other processes before locking the
+            # shard, since moving changes to the pieces means reading
+            # them
+            self._refresh_shard_list()
+            if shard not in (self._listed or []):
+                return False
+            with _locked(self._get_lock_filepath(shard), exclusive=True):
+                self._reload_shard(shard)
+                if self._pending.get(shard):
+                    return False
+                return self._write_pieces(shard)
+
+    def _write_pieces(self, shard):
+        key = self.database.key
+        records = self._records[shard]
+        base = self.sharding.shard(records[0][key])
+        depth = shard[len(base):].count(".")
+        pieces = [self._piece(shard, n) for n in range(self.split_ways)]
+        groups = [[] for _ in pieces]
+        for record in records:
+            groups[self._bucket(record[key], depth)].append(dict(record))
+        LOG.info("Splitting %s into %s shards of %s records",
+                 self._get_filepath(suffix=shard), len(pieces),
+                 "/".join(str(len(g)) for g in groups))
+
+        abort = False
+        for piece, piece_records in zip(pieces, groups):
+            with _locked(self._get_lock_filepath(piece), exclusive=True):
+                abort |= self._write_uninterruptibly(self._write_shard, piece,
+                                                     piece_records)
+                _count_write(self._get_lock_filepath(piece))
+        listed = list(self._listed)
+        listed[listed.index(shard):listed.index(shard) + 1] = pieces
+        abort |= self._write_uninterruptibly(self._write_shard_list, listed)
+        self._listed = listed
+        self._list_stamp = _file_stamp(self._get_filepath(suffix="shards"))
+        for filepath in (self._get_filepath(suffix=shard),
+                         self._get_journal_filepath(suffix=shard)):
+            if os.path.exists(filepath):
+                os.unlink(filepath)
+        _count_write(self._get_lock_filepath(shard))
+
+        idx = self._shards.index(shard)
+        self._shards[idx:idx + 1] = pieces
+        for state in (self._records, self._by_key, self._columns,
+                      self._stamps, self._checked):
+            state.pop(shard, None)
+        self._on_disk.discard(shard)
+        self.database._reloaded(shard)  # pylint: disable=protected-access
+        for piece, piece_records in zip(pieces, groups):
+            self._stamps[piece] = self.shard_stamp(piece)
+            self._checked[piece] = time.time()
+            self._set_shard(piece, piece_records)
+            self._on_disk.add(piece)
+            self.database._reloaded(  # pylint: disable=protected-access
+                piece, [], self._records[piece])
+        return abort
+
+    def _layout(self, records):
+        """Divide records among shards according to the database's
+        sharding policy, splitting any shard that would be larger than
+        its maximum size. Returns a dict of shard to records."""
+        key = self.database.key
+        sharding = self.database.sharding
+        layout = collections.OrderedDict()
+        for record in records:
+            layout.setdefault(sharding.shard(record[key]), []).append(record)
+
+        retval = collections.OrderedDict()
+        todo = [(s, r, 0) for s, r in layout.items()]
+        while todo:
+            shard, shard_records, depth = todo.pop(0)
+            if (not sharding.max_size or len(shard_records) < 2
+                    or len(self._encode_shard(shard_records)) <=
+                    sharding.max_size):
+                retval[shard] = shard_records
+                continue
+            groups = [[] for _ in range(self.split_ways)]
+            for record in shard_records:
+                groups[self._bucket(record[key], depth)].append(record)
+            todo[0:0] = [(self._piece(shard, n), g, depth + 1)
+                         for n, g in enumerate(groups)]
         return retval
 
-    def _deserialize(self, record):
-        retval = {}
-        for key, val in record.items():
-            for serializer in self.serializers:
+    def rebalance(self):
+        if self.database.key is None or self.database.sharding is None:
+            return super(JSONBackend, self).rebalance()
+        self.save()
+
+        with _locked(self._get_lock_filepath("shards"), exclusive=True):
+            while True:
+                old = self._read_shard_list()
+                layout = self._layout(
+                    r for s in old for r in self._read_locked(s))
+                locked = sorted(set(old) | set(layout), key=str)
+                locks = []
                 try:
-                    retval[key] = serializer.deserialize(val)
-                    break
-                except DeserializationNotSupported:
-                    pass
+                    for shard in locked:
+                        locks.append(
+                            _lock(self._get_lock_filepath(shard),
+                                  exclusive=True))
+                    # records may have been added since the layout was
+                    # worked out, and they may need new shards, which
+                    # aren't locked
+                    layout = self._layout(
+                        r for s in old for r in self._read_shard(s))
+                    if set(layout).issubset(locked):
+                        return self._write_layout(old, layout)
+                finally:
+                    for lock in locks:
+                        _unlock(lock)
+
+    def _read_locked(self, shard):
+        if not self._has_files(shard):
+            return []
+        with _locked(self._get_lock_filepath(shard)):
+            return self._read_shard(shard)
+
+    def _write_layout(self, old, layout):
+        """Replace the shards in ``old`` with those in ``layout``, which
+        the caller must hold exclusive locks on, along with the list of
+        shards. Returns the new list of shards."""
+        LOG.info("Rebalancing %s from %s shards to %s, by %r",
+                 self.database.filename, len(old), len(layout),
+                 self.database.sharding)
+        abort = False
+        for shard, records in layout.items():
+            abort |= self._write_uninterruptibly(self._write_shard, shard,
+                                                 records)
+            _count_write(self._get_lock_filepath(shard))
+        # the records held in memory are out of date now, so the
+        # database resets its backend after this
+        self._shards = list(layout)
+        self._sharding = self.database.sharding
+        abort |= self._write_uninterruptibly(self._write_shard_list,
+                                             self._shards)
+        for shard in old:
+            if shard not in layout:
+                for filepath in (self._get_filepath(suffix=shard),
+                                 self._get_journal_filepath(suffix=shard)):
+                    if os.path.exists(filepath):
+                        os.unlink(filepath)
+                _count_write(self._get_lock_filepath(shard))
+
+        if abort:
+            raise SystemExit("Caught Ctrl-C during database write")
+        return list(layout)
+
+    def __len__(self):
+        self._load()
+        return sum(len(r) for r in self._records.values())
+
+    def __iter__(self):
+        self._load()
+        # iterate by index, so that records can be replaced
+        # mid-iteration
+        for shard in list(self._shards):
+            records = self._records[shard]
+            idx = 0
+            while idx < len(records):
+                yield records[idx]
+                idx += 1
+
+    def project(self, fields):
+        # the records are held in memory, so the partial records need
+        # to be copies
+        for record in super(JSONBackend, self).project(fields):
+            yield _copy_record(record)
+
+    def _stream_shard(self, shard):
+        """Iterate over the records in a shard on disk, without
+        reading them all into memory at once."""
+        filepath = self._get_filepath(suffix=shard)
+        records = None
+        split = False
+        with _locked(self._get_lock_filepath(shard)):
+            if os.path.exists(self._get_journal_filepath(suffix=shard)):
+                records = self._read_shard(shard)
+            elif not os.path.exists(filepath):
+                split = self._list_changed()
+                records = []
             else:
-                retval[key] = val
+                # shards are only ever replaced by renaming a new file
+                # over them, so this file can still be read once the
+                # lock is released
+                infile = _open_shard_file(filepath)
+        if split:
+            # another process has split the shard since the list of
+            # shards was read, so stream the pieces instead
+            self._refresh_shard_list()
+            for piece in list(self._shards):
+                if piece is not None and piece.startswith("%s." % shard):
+                    for record in self._stream_shard(piece):
+                        yield record
+            return
+        if records is not None:
+            for record in records:
+                yield record
+            return
+
+        LOG.debug("Streaming data from %s", filepath)
+        with infile:
+            for record in _iter_json_array(infile):
+                yield record
+
+    def stream(self, fields=None):
+        self._refresh_shard_list()
+        for shard in list(self._load_shard_list()):
+            loaded = None
+            if shard in self._records:
+                loaded = self._load_shard(shard)
+            if loaded is None:
+                records = self._stream_shard(shard)
+            else:
+                # the shard is in memory already, and may have changes
+                # that haven't been saved
+                records = list(loaded)
+            for record in records:
+                if fields is not None:
+                    record = _project(record, fields)
+                yield record if loaded is None else _copy_record(record)
+
+    def get(self, idx):
+        shard, shard_idx = self._locate(idx)
+        return self._records[shard][shard_idx]
+
+    def set(self, idx, record):
+        shard, shard_idx = self._locate(idx)
+        key = self.database.key
+        if (self._record_shard(record) != shard
+                or (key is not None
+                    and record[key] != self._records[shard][shard_idx][key])):
+            # the record's key has changed, so it may belong to a
+            # different shard now
+            self.delete(idx)
+            self.append(record)
+            return
+
+        self._records[shard][shard_idx] = self._pack(shard, record)
+        self._record_change("set", shard, shard_idx, record)
+
+    def _add_shard(self, shard):
+        LOG.debug("Creating new shard %s for %s", shard,
+                  self.database.filename)
+        self._load_shard_list().append(shard)
+        self._records[shard] = []
+        self._by_key[shard] = {}
+        # as far as we know, the shard isn't on disk; if another
+        # process writes it first, the two are merged when it's saved
+        stamp = self.shard_stamp(shard)
+        self._stamps[shard] = [[f[0], None] for f in stamp[:2]] + stamp[2:]
+
+    def _insert(self, shard, shard_idx, record):
+        records = self._records[shard]
+        records.insert(shard_idx, self._pack(shard, record))
+        if self.database.key is not None:
+            if shard_idx == len(records) - 1:
+                self._by_key[shard][record[self.database.key]] = shard_idx
+            else:
+                self._index_keys(shard)
+        self._record_change("insert", shard, shard_idx, record)
+
+    def insert(self, idx, record):
+        self._load()
+        shard = self._record_shard(record)
+        if shard not in self._records:
+            self._add_shard(shard)
+
+        # records are grouped by shard, so put the new record as close
+        # to the requested position as its shard allows
+        if idx < 0:
+            idx += len(self)
+        start = 0
+        for other in self._shards:
+            if other == shard:
+                break
+            start += len(self._records[other])
+        shard_idx = max(0, min(idx - start, len(self._records[shard])))
+        self._insert(shard, shard_idx, record)
+
+    def append(self, record):
+        if self.database.key is None:
+            shard = self.database.get_shard(record)
+            records = self._load_shard(shard)
+        else:
+            shard, records = self._load_key_shard(record[self.database.key])
+        if records is None:
+            self._add_shard(shard)
+        self._insert(shard, len(self._records[shard]), record)
+
+    def delete(self, idx):
+        shard, shard_idx = self._locate(idx)
+        self._record_change("delete", shard, shard_idx,
+                            self._records[shard][shard_idx])
+        del self._records[shard][shard_idx]
+        self._index_keys(shard)
+
+    def contains(self, key):
+        shard, records = self._load_key_shard(key)
+        return records is not None and key in self._by_key[shard]
+
+    def fetch(self, key):
+        shard, records = self._load_key_shard(key)
+        if records is None or key not in self._by_key[shard]:
+            return None
+        return self._records[shard][self._by_key[shard][key]]
+
+    def store(self, record, fields=None):
+        key = record[self.database.key]
+        shard, records = self._load_key_shard(key)
+        if records is None:
+            raise KeyError(key)
+        shard_idx = self._by_key[shard][key]
+        if fields is not None:
+            # the record may have been read before another process's
+            # changes to it were loaded, so only take the fields that
+            # were actually changed
+            merged = dict(self._records[shard][shard_idx])
+            merged.update((f, record[f]) for f in fields if f in record)
+            record = merged
+        self._records[shard][shard_idx] = self._pack(shard, record)
+        self._record_change("set", shard, shard_idx, record, fields)
+
+    def remove(self, key):
+        shard, records = self._load_key_shard(key)
+        if records is None:
+            raise KeyError(key)
+        shard_idx = self._by_key[shard][key]
+        self._record_change("delete", shard, shard_idx,
+                            self._records[shard][shard_idx])
+        del self._records[shard][shard_idx]
+        self._index_keys(shard)
+
+
+class SQLiteBackend(Backend):
+    """One table per database in a single SQLite file.
+
+    Only the records that are asked for are read, so lookups and
+    updates by key don't need the whole database in memory. Changes
+    are made inside a transaction that's committed when the database
+    is saved, so each delay_write() block is a single transaction.
+    """
+
+    # number of records to fetch at a time while iterating
+    page_size = 500
+
+    indexed_keys = True
+
+    def __init__(self, database, location):
+        super(SQLiteBackend, self).__init__(database, location)
+        self._table = os.path.splitext(database.filename)[0]
+        self._conn = None
+        self._stamp = None
+        self._changes = 0
+        self._data_version = None
+        self._checked = 0
+        self._len = None
+        self._json1 = None
+
+    @property
+    def directory(self):
+        return os.path.dirname(self.location)
+
+    @property
+    def loaded(self):
+        return self._conn is not None
+
+    def _connect(self):
+        if self._conn is None:
+            LOG.debug("Opening %s for %s", self.location,
+                      self.database.filename)
+            self._conn = sqlite3.connect(self.location)
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS "%s" '
+                '(seq REAL NOT NULL, key TEXT UNIQUE, record TEXT NOT NULL)'
+                % self._table)
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS "%s_seq" ON "%s" (seq)' %
+                (self._table, self._table))
+            self._conn.commit()
+            self._data_version = self._get_data_version()
+            self._checked = time.time()
+            self._take_stamp()
+        return self._conn
+
+    def _get_data_version(self):
+        # this changes whenever another connection commits
+        return self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def _take_stamp(self):
+        """Note the state of the file, if what's been read from it is
+        known to be up to date."""
+        version = self._get_data_version()
+        stamp = self.shard_stamp(None)
+        if (version == self._data_version
+                and self._get_data_version() == version):
+            self._stamp = stamp
+            self._changes = self._conn.total_changes
+        else:
+            self._stamp = None
+
+    def refresh(self, shard):
+        now = time.time()
+        if self._conn is None or now - self._checked < self.reload_interval:
+            return
+        self._checked = now
+        version = self._get_data_version()
+        if version != self._data_version:
+            LOG.info("%s was changed by another process", self.location)
+            self._data_version = version
+            self._len = None
+            self.database._reloaded(None)  # pylint: disable=protected-access
+
+    def shard_stamp(self, shard):
+        return [
+            _file_stamp(self.location),
+            _file_stamp("%s-journal" % self.location),
+            _file_stamp("%s-wal" % self.location)
+        ]
+
+    def known_stamp(self, shard):
+        # SQLite does its own locking, and everything that's read comes
+        # straight from the file, so this is only needed to know what
+        # the key index reflects
+        if self._conn is None or self._conn.total_changes != self._changes:
+            return None
+        return self._stamp
+
+    def _execute(self, query, params=()):
+        return self._connect().execute(
+            query.replace("{table}", '"%s"' % self._table), params)
+
+    def _key(self, record):
+        if self.database.key is None:
+            return None
+        return record[self.database.key]
+
+    @staticmethod
+    def _encode(record):
+        return json.dumps(record, separators=(',', ':'), default=dict)
+
+    def _rowid(self, idx):
+        if idx < 0:
+            idx += len(self)
+        row = None
+        if idx >= 0:
+            row = self._execute(
+                "SELECT rowid FROM {table} ORDER BY seq LIMIT 1 OFFSET ?",
+                (idx, )).fetchone()
+        if row is None:
+            raise IndexError("database index out of range")
+        return row[0]
+
+    def __len__(self):
+        if self._len is None:
+            self._len = self._execute(
+                "SELECT COUNT(*) FROM {table}").fetchone()[0]
+        return self._len
+
+    def _pages(self, columns, params=()):
+        """Select columns from every row, in order.
+
+        This pages through the table rather than holding a cursor
+        open, so that the database can be changed (and committed)
+        mid-iteration.
+        """
+        params = tuple(params)
+        rows = self._execute(
+            "SELECT seq, %s FROM {table} ORDER BY seq LIMIT ?" % columns,
+            params + (self.page_size, )).fetchall()
+        while rows:
+            for row in rows:
+                yield row[1:]
+            rows = self._execute(
+                "SELECT seq, %s FROM {table} WHERE seq > ? "
+                "ORDER BY seq LIMIT ?" % columns,
+                params + (rows[-1][0], self.page_size)).fetchall()
+
+    def __iter__(self):
+        self.refresh(None)
+        for record, in self._pages("record"):
+            yield json.loads(record)
+
+    @property
+    def has_json1(self):
+        """Whether or not SQLite was built with the JSON1 extension."""
+        if self._json1 is None:
+            try:
+                self._execute("SELECT json_type('{}')")
+                self._json1 = True
+            except sqlite3.OperationalError:
+                self._json1 = False
+        return self._json1
+
+    def project(self, fields):
+        if not self.has_json1:
+            for record in super(SQLiteBackend, self).project(fields):
+                yield record
+            return
+
+        # let SQLite pick the fields out of each record, so that the
+        # rest of the record is never decoded. json_extract() with
+        # more than one path gives a JSON array of the values, with
+        # numbers exactly as they were written; it gives null for
+        # missing fields, though, so the fields that are actually
+        # there are selected too.
+        paths = ['$."%s"' % f for f in fields]
+        columns = (
+            "json_extract(record, %s), "
+            "(SELECT json_group_array(key) FROM json_each(record) "
+            "WHERE key IN (%s))" % (", ".join("?" * max(len(paths), 2)),
+                                    ", ".join("?" * len(fields))))
+        params = (paths * 2)[:max(len(paths), 2)] + list(fields)
+        for values, present in self._pages(columns, params):
+            present = set(json.loads(present))
+            yield {
+                f: v
+                for f, v in zip(fields, json.loads(values)) if f in present
+            }
+
+    def get(self, idx):
+        row = self._execute("SELECT record FROM {table} WHERE rowid = ?",
+                            (self._rowid(idx), )).fetchone()
+        return json.loads(row[0])
+
+    def set(self, idx, record):
+        self._execute("UPDATE {table} SET key = ?, record = ? WHERE rowid = ?",
+                      (self._key(record), self._encode(record),
+                       self._rowid(idx)))
+
+    def insert(self, idx, record):
+        length = len(self)
+        if idx < 0:
+            idx = max(0, idx + length)
+        if idx >= length:
+            last = self._execute("SELECT MAX(seq) FROM {table}").fetchone()[0]
+            seq = 0 if last is None else last + 1
+        else:
+            # squeeze the new record in between its neighbors, so that
+            # nothing needs to be renumbered until there's no room left
+            seq = self._seq_before(idx)
+            if seq is None:
+                self._renumber()
+                seq = self._seq_before(idx)
+        self._execute(
+            "INSERT INTO {table} (seq, key, record) VALUES (?, ?, ?)",
+            (seq, self._key(record), self._encode(record)))
+        self._len = length + 1
+
+    def _seq_before(self, idx):
+        """Get a sequence number between the records at ``idx`` and the
+        one before it, or None if they're too close to tell apart any
+        number between them."""
+        neighbors = [
+            r[0] for r in self._execute(
+                "SELECT seq FROM {table} ORDER BY seq LIMIT 2 OFFSET ?",
+                (max(0, idx - 1), ))
+        ]
+        if idx == 0:
+            return neighbors[0] - 1
+        low, high = neighbors
+        seq = (low + high) / 2.0
+        if low < seq < high:
+            return seq
+        return None
+
+    def _renumber(self):
+        """Number the records afresh, a whole number apart, keeping
+        their order."""
+        LOG.debug("Renumbering records in %s", self._table)
+        rowids = [
+            r[0] for r in self._execute("SELECT rowid FROM {table} "
+                                        "ORDER BY seq").fetchall()
+        ]
+        self._connect().executemany(
+            'UPDATE "%s" SET seq = ? WHERE rowid = ?' % self._table,
+            ((i, rowid) for i, rowid in enumerate(rowids)))
+
+    def delete(self, idx):
+        self._execute("DELETE FROM {table} WHERE rowid = ?",
+                      (self._rowid(idx), ))
+        self._len = None
+
+    def contains(self, key):
+        return self._execute("SELECT 1 FROM {table} WHERE key = ?",
+                             (key, )).fetchone() is not None
+
+    def fetch(self, key):
+        row = self._execute("SELECT record FROM {table} WHERE key = ?",
+                            (key, )).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def store(self, record, fields=None):
+        if fields is not None:
+            # take the write lock before reading the record, so that
+            # no other process can change it in between, and only
+            # take the fields that were actually changed
+            cursor = self._execute(
+                "UPDATE {table} SET key = key WHERE key = ?",
+                (self._key(record), ))
+            if cursor.rowcount == 0:
+                raise KeyError(self._key(record))
+            merged = self.fetch(self._key(record))
+            merged.update((f, record[f]) for f in fields if f in record)
+            record = merged
+        cursor = self._execute("UPDATE {table} SET record = ? WHERE key = ?",
+                               (self._encode(record), self._key(record)))
+        if cursor.rowcount == 0:
+            raise KeyError(self._key(record))
+
+    def remove(self, key):
+        cursor = self._execute("DELETE FROM {table} WHERE key = ?", (key, ))
+        if cursor.rowcount == 0:
+            raise KeyError(key)
+        self._len = None
+
+    def extend(self, records):
+        last = self._execute("SELECT MAX(seq) FROM {table}").fetchone()[0]
+        start = 0 if last is None else last + 1
+        self._connect().executemany(
+            'INSERT INTO "%s" (seq, key, record) VALUES (?, ?, ?)' %
+            self._table, ((start + i, self._key(r), self._encode(r))
+                          for i, r in enumerate(records)))
+        self._len = None
+
+    def save(self, force=False):
+        if self._conn is not None:
+            self._conn.commit()
+            self._take_stamp()
+
+
+class HashIndex(object):
+    """Index of record keys by the (serialized) value of one field.
+
+    Records that lack the field are indexed under None.
+    """
+
+    def __init__(self, field):
+        self.field = field
+        self._keys = collections.defaultdict(set)
+
+    def add(self, key, record):
+        self._keys[record.get(self.field)].add(key)
+
+    def discard(self, key, record):
+        value = record.get(self.field)
+        if value in self._keys:
+            self._keys[value].discard(key)
+            if not self._keys[value]:
+                del self._keys[value]
+
+    def values(self):
+        return list(self._keys.keys())
+
+    def find(self, value):
+        return self._keys.get(value, set())
+
+
+class SortedIndex(HashIndex):
+    """Hash index that can also look up ranges of values, in order."""
+
+    def __init__(self, field):
+        super(SortedIndex, self).__init__(field)
+        self._sorted = []
+
+    def add(self, key, record):
+        value = record.get(self.field)
+        if value is not None and value not in self._keys:
+            bisect.insort(self._sorted, value)
+        super(SortedIndex, self).add(key, record)
+
+    def discard(self, key, record):
+        super(SortedIndex, self).discard(key, record)
+        value = record.get(self.field)
+        if value is not None and value not in self._keys:
+            idx = bisect.bisect_left(self._sorted, value)
+            if idx < len(self._sorted) and self._sorted[idx] == value:
+                del self._sorted[idx]
+
+    def range(self, low=None, high=None):
+        """Get the indexed values from ``low`` up to (not including)
+        ``high``, in order. None values are never included."""
+        start = 0
+        if low is not None:
+            start = bisect.bisect_left(self._sorted, low)
+        end = len(self._sorted)
+        if high is not None:
+            end = bisect.bisect_left(self._sorted, high)
+        return self._sorted[start:end]
+
+
+class BloomFilter(object):
+    """Set membership test that is never wrong about an item that was
+    added, and only rarely wrong about one that wasn't."""
+
+    # with ten bits per item, seven hashes gives the fewest false
+    # positives (just under 1%)
+    bits_per_item = 10
+    hashes = 7
+
+    def __init__(self, bits, data=None):
+        self.bits = bits
+        if data is None:
+            self.data = bytearray(bits // 8)
+        else:
+            self.data = bytearray(data)
+
+    @classmethod
+    def for_count(cls, count):
+        """Create an empty filter sized for the given number of items."""
+        bits = max(64, count * cls.bits_per_item)
+        return cls(bits + -bits % 8)
+
+    def _positions(self, item):
+        first, second = struct.unpack(">QQ", hashlib.md5(item).digest())
+        for i in range(self.hashes):
+            yield (first + i * second) % self.bits
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.data[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        return all(self.data[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(item))
+
+
+class _MappedKeys(object):
+    """The keys of one shard in a memory-mapped key index file, which
+    can be read like a dict of encoded key to flags."""
+
+    def __init__(self, index_map, start, count, width, bloom_bits):
+        bloom_end = start + bloom_bits // 8
+        self._map = index_map
+        self._bloom = BloomFilter(bloom_bits, index_map[start:bloom_end])
+        self._offset = start
+        self._start = bloom_end
+        self.count = count
+        self.width = width
+        self.bloom_bits = bloom_bits
+
+    def raw(self):
+        """Get the section as it is in the file, Bloom filter and all."""
+        return self._map[self._offset:
+                         self._start + self.count * (self.width + 1)]
+
+    def get(self, key):
+        if len(key) > self.width or key not in self._bloom:
+            return None
+        padded = key.ljust(self.width, b"\0")
+        slot = self.width + 1
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            start = self._start + mid * slot
+            found = self._map[start:start + self.width]
+            if found < padded:
+                low = mid + 1
+            elif found > padded:
+                high = mid
+            else:
+                return bytearray(self._map[start + self.width:
+                                           start + slot])[0]
+        return None
+
+    def items(self):
+        slot = self.width + 1
+        for i in range(self.count):
+            start = self._start + i * slot
+            yield (self._map[start:start + self.width].rstrip(b"\0"),
+                   bytearray(self._map[start + self.width:start + slot])[0])
+
+
+class KeyIndex(object):
+    """Persistent list of the keys in a database, with flags.
+
+    The file has a section for each shard of the database, holding
+    the shard's keys in sorted, fixed-width slots, each followed by a
+    byte of flags, behind a Bloom filter. It's memory-mapped, so
+    whether a key exists, and whether each flag (whether or not a
+    given field is true, and whether it's set at all) is set for it,
+    can be answered without loading or deserializing any records.
+
+    Each section is stamped with the state of the shard's files that
+    it reflects, and isn't used once they've changed. Sections that
+    are changed here are held as dicts until they're saved, at which
+    point they're merged with whatever other processes have saved in
+    the meantime. Writing a shard without changing its keys or flags
+    only moves its section's stamp, which is written out lazily;
+    until it is, other processes rebuild the section from the shard.
+    """
+
+    # flags are kept in a single byte, with a bit for whether each
+    # field is true and another for whether it's set to anything but
+    # None
+    max_flags = 4
+
+    # the version of the file format, which is bumped whenever the
+    # meaning of the flags changes
+    version = 2
+
+    def __init__(self, filepath, flags):
+        if len(flags) > self.max_flags:
+            raise ValueError("At most %s key flags are supported" %
+                             self.max_flags)
+        self.filepath = filepath
+        self.flags = tuple(flags)
+        self._sections = {}
+        self._stamps = {}
+        # sections whose keys or flags have changed
+        self._dirty = set()
+        # sections that have been checked against unsaved changes to
+        # their shards, and those that have been restamped since
+        self._touched = set()
+        self._restamped = set()
+
+    @staticmethod
+    def _encode_key(key):
+        return six.text_type(key).encode("utf-8")
+
+    def _mask(self, record):
+        mask = 0
+        for i, flag in enumerate(self.flags):
+            value = record.get(flag)
+            if value:
+                mask |= 1 << i
+            if value is not None:
+                mask |= 1 << (i + self.max_flags)
+        return mask
+
+    def _read(self):
+        """Read the index file.
+
+        Returns dicts of the sections in it and of their stamps, each
+        keyed by shard.
+        """
+        try:
+            with open(self.filepath, "rb") as infile:
+                header = json.loads(infile.readline().decode("utf-8"))
+                if (header.get("version") != self.version
+                        or header["flags"] != list(self.flags)):
+                    LOG.debug("Key flags in %s have changed", self.filepath)
+                    return {}, {}
+                index_map = mmap.mmap(
+                    infile.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError, KeyError) as err:
+            LOG.debug("Could not read key index %s: %s", self.filepath, err)
+            return {}, {}
+
+        sections = {}
+        stamps = {}
+        data_start = index_map.find(b"\n") + 1
+        for section in header["sections"]:
+            start = data_start + section["offset"]
+            end = (start + section["bloom_bits"] // 8 +
+                   section["count"] * (section["width"] + 1))
+            if end > len(index_map):
+                LOG.warning("Key index %s is truncated, ignoring it",
+                            self.filepath)
+                return {}, {}
+            sections[section["shard"]] = _MappedKeys(
+                index_map, start, section["count"], section["width"],
+                section["bloom_bits"])
+            stamps[section["shard"]] = section["stamp"]
+        return sections, stamps
+
+    def load(self):
+        """Read the index file, if there is one."""
+        self._sections, self._stamps = self._read()
+        self._dirty = set()
+        self._touched = set()
+        self._restamped = set()
+
+    def current(self, shard, stamp):
+        """Whether the index has the keys of a shard as it was when its
+        files had the given stamp."""
+        return shard in self._sections and self._stamps.get(shard) == stamp
+
+    def changed(self, shard):
+        """Whether a shard's keys have changed since they were saved."""
+        return shard in self._dirty
+
+    def _lookup(self, shard, key):
+        """Get the flags for a key, or None if there is no such key."""
+        section = self._sections.get(shard)
+        if section is None:
+            return None
+        return section.get(self._encode_key(key))
+
+    def contains(self, shard, key):
+        return self._lookup(shard, key) is not None
+
+    def _flag_bit(self, flag):
+        try:
+            return 1 << self.flags.index(flag)
+        except ValueError:
+            raise NoSuchIndex("%s is not a key flag" % flag)
+
+    def flagged(self, shard, key, flag):
+        """Whether or not a key exists and has the given flag set."""
+        return bool((self._lookup(shard, key) or 0) & self._flag_bit(flag))
+
+    def flag_value(self, shard, key, flag):
+        """Get a flag for a key as True or False, or None if there is no
+        such key or its field is unset or None."""
+        bit = self._flag_bit(flag)
+        mask = self._lookup(shard, key) or 0
+        if not mask & (bit << self.max_flags):
+            return None
+        return bool(mask & bit)
+
+    def _writable(self, shard):
+        section = self._sections.get(shard)
+        if not isinstance(section, dict):
+            section = dict(section.items()) if section is not None else {}
+            self._sections[shard] = section
+        self._dirty.add(shard)
+        return section
+
+    def _get_section(self, shard):
+        self._touched.add(shard)
+        return self._sections.get(shard) or {}
+
+    def add(self, shard, key, record):
+        encoded = self._encode_key(key)
+        mask = self._mask(record)
+        if self._get_section(shard).get(encoded) != mask:
+            self._writable(shard)[encoded] = mask
+
+    def discard(self, shard, key):
+        encoded = self._encode_key(key)
+        if self._get_section(shard).get(encoded) is not None:
+            self._writable(shard).pop(encoded)
+
+    def set_section(self, shard, key, records):
+        """Replace the keys of a shard with those of the given records."""
+        self._sections[shard] = {
+            self._encode_key(r[key]): self._mask(r)
+            for r in records
+        }
+        self._dirty.add(shard)
+        self._restamped.discard(shard)
+
+    def forget(self, shard):
+        """Drop the keys of a shard, so that they'll be rebuilt."""
+        self._sections.pop(shard, None)
+        self._stamps.pop(shard, None)
+        for shards in (self._dirty, self._touched, self._restamped):
+            shards.discard(shard)
+
+    def _dump(self, sections, stamps):
+        header = {
+            "version": self.version,
+            "flags": self.flags,
+            "sections": []
+        }
+        chunks = []
+        offset = 0
+        for shard in sorted(sections, key=str):
+            section = sections[shard]
+            if isinstance(section, _MappedKeys):
+                # unchanged since it was read, so it's copied as is
+                chunk = section.raw()
+                count = section.count
+                width = section.width
+                bloom_bits = section.bloom_bits
+            else:
+                items = sorted(section.items())
+                count = len(items)
+                width = max([len(k) for k, _ in items] or [0])
+                bloom = BloomFilter.for_count(count)
+                for key, _ in items:
+                    bloom.add(key)
+                bloom_bits = bloom.bits
+                chunk = b"".join([bytes(bloom.data)] + [
+                    k.ljust(width, b"\0") + six.int2byte(mask)
+                    for k, mask in items
+                ])
+            header["sections"].append({
+                "shard": shard,
+                "stamp": stamps[shard],
+                "offset": offset,
+                "count": count,
+                "width": width,
+                "bloom_bits": bloom_bits,
+            })
+            chunks.append(chunk)
+            offset += len(chunk)
+        return b"".join([json.dumps(header).encode("utf-8"), b"\n"] + chunks)
+
+    def save(self, known_stamp, shards=None, flush=False):
+        """Write the sections that have changed, merged with the sections
+        that other processes have saved.
+
+        ``known_stamp`` is called with each changed shard, and gives
+        the stamp of the shard's files that its keys reflect, or None
+        if they include changes that haven't been saved yet; those
+        sections are kept until they have been. If ``shards`` is
+        given, sections for any other shards, which have been split or
+        rebalanced away, are dropped.
+
+        Sections whose keys haven't changed are only restamped here,
+        and written along with the next section that has changed, or
+        when ``flush`` is set.
+        """
+        ready = {}
+        for shard in self._dirty | self._touched:
+            stamp = known_stamp(shard)
+            if stamp is None:
+                continue
+            self._touched.discard(shard)
+            if shard in self._dirty:
+                ready[shard] = stamp
+            elif (shard in self._sections
+                  and stamp != self._stamps.get(shard)):
+                self._stamps[shard] = stamp
+                self._restamped.add(shard)
+        if not ready and not (flush and self._restamped):
+            return
+        for shard in self._restamped:
+            ready.setdefault(shard, self._stamps[shard])
+
+        with _locked("%s.lock" % self.filepath, exclusive=True):
+            sections, stamps = self._read()
+            if shards is not None:
+                for shard in set(sections) - set(shards):
+                    del sections[shard]
+                    del stamps[shard]
+            for shard, stamp in ready.items():
+                sections[shard] = self._sections[shard]
+                stamps[shard] = stamp
+            # the index can always be rebuilt, so it's enough that it's
+            # replaced atomically
+            tmp_path = "%s.tmp" % self.filepath
+            try:
+                with open(tmp_path, "wb") as outfile:
+                    outfile.write(self._dump(sections, stamps))
+                os.rename(tmp_path, self.filepath)
+            except (IOError, OSError) as err:
+                LOG.warning("Could not write key index %s: %s",
+                            self.filepath, err)
+                return
+
+        for shard in self._dirty:
+            if shard not in ready:
+                sections[shard] = self._sections[shard]
+        self._sections = sections
+        self._stamps = stamps
+        self._dirty.difference_update(ready)
+        self._restamped.clear()
+
+
+class Snapshot(object):
+    """Pickled copy of the records in a database, already deserialized.
+
+    Deserializing every record -- decoding the JSON, and then parsing
+    the dates and times in it -- is most of the cost of reading a
+    whole database, so processes that never change it can load this
+    instead. Like the key index, the snapshot has a section for each
+    shard, stamped with the state of the shard's files that it
+    reflects; sections for shards that have changed since are rebuilt
+    when it's loaded, and the snapshot rewritten. It can always be
+    rebuilt, so one that can't be read is simply ignored.
+    """
+
+    # bump this whenever the records in snapshots change shape
+    version = 1
+
+    def __init__(self, filepath, key=None):
+        self.filepath = filepath
+        self.key = key
+        self.records = []
+        self._by_key = {}
+
+    def _read(self):
+        """Read the snapshot file, giving a dict of its sections, each
+        a tuple of the shard's stamp and its records, keyed by
+        shard."""
+        try:
+            with open(self.filepath, "rb") as infile:
+                version, sections = pickle.load(infile)
+            if version == self.version:
+                return sections
+            LOG.debug("Snapshot %s is out of date", self.filepath)
+        except (IOError, OSError):
+            pass
+        except Exception as err:  # pylint: disable=broad-except
+            # a snapshot written by another version of Python or
+            # pickle can fail in any number of ways; just rebuild it
+            LOG.debug("Ignoring unreadable snapshot %s: %s", self.filepath,
+                      err)
+        return {}
+
+    def _write(self, sections):
+        with _locked("%s.lock" % self.filepath, exclusive=True):
+            tmp_path = "%s.tmp" % self.filepath
+            try:
+                with open(tmp_path, "wb") as outfile:
+                    pickle.dump((self.version, sections), outfile,
+                                pickle.HIGHEST_PROTOCOL)
+                os.rename(tmp_path, self.filepath)
+            except (IOError, OSError) as err:
+                LOG.warning("Could not write snapshot %s: %s",
+                            self.filepath, err)
+
+    def load(self, backend, decode):
+        """Load the records of each of the backend's shards, reading
+        and deserializing them with ``decode`` for any shard that has
+        changed since the snapshot was written."""
+        sections = self._read()
+        shards = backend.shards()
+        stale = [
+            s for s in shards
+            if s not in sections or sections[s][0] != backend.shard_stamp(s)
+        ]
+        if stale:
+            LOG.debug("Building snapshot of %s shards of %s", len(stale),
+                      self.filepath)
+            for shard in stale:
+                records = [decode(r) for r in backend.shard_records(shard)]
+                sections[shard] = (backend.known_stamp(shard), records)
+        if stale or set(sections) != set(shards):
+            # shards with unsaved changes can't be stamped, so they
+            # aren't written
+            self._write({
+                s: sections[s]
+                for s in shards if sections[s][0] is not None
+            })
+
+        self.records = [r for s in shards for r in sections[s][1]]
+        if self.key is not None:
+            self._by_key = {r[self.key]: r for r in self.records}
+
+        # the snapshot has everything that's needed now, so the
+        # backend needn't hold a second copy of it
+        for shard in shards:
+            backend.release(shard)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def get(self, key):
+        """Get a record by key. Raises KeyError if there's no such
+        record."""
+        return self._by_key[key]
+
+
+BACKENDS = {
+    "json": JSONBackend,
+    "sqlite": SQLiteBackend,
+}
+
+
+def parse_uri(uri):
+    """Split a database URI into the backend name and path.
+
+    As with SQLAlchemy, ``sqlite:///crashes.sqlite`` is a path
+    relative to the database directory and ``sqlite:////tmp/crashes.sqlite``
+    is an absolute path. The path can be omitted entirely for the
+    JSON backend (e.g., ``json:``) to use the database directory
+    itself.
+    """
+    scheme, _, path = uri.partition(":")
+    if path.startswith("//"):
+        path = path[2:]
+        if path.startswith("/"):
+            path = path[1:]
+    if scheme not in BACKENDS:
+        raise NoSuchDatabase("Unknown database backend %r in %s" % (scheme,
+                                                                   uri))
+    return scheme, path
+
+
+CacheInfo = collections.namedtuple("CacheInfo",
+                                   ["hits", "misses", "maxsize", "currsize"])
+
+
+class RecordCache(object):
+    """Bounded cache of deserialized records, evicting the least
+    recently used record first."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._records = collections.OrderedDict()
+
+    def get(self, key):
+        try:
+            record = self._records.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self._records[key] = record
+        self.hits += 1
+        return record
+
+    def add(self, key, record):
+        if self.maxsize <= 0:
+            return
+        self._records.pop(key, None)
+        self._records[key] = record
+        while len(self._records) > self.maxsize:
+            self._records.popitem(last=False)
+
+    def discard(self, key):
+        self._records.pop(key, None)
+
+    def discard_from(self, idx):
+        """Discard all records cached by a position at or after idx."""
+        for key in [k for k in self._records if k >= idx]:
+            del self._records[key]
+
+    def clear(self):
+        self._records.clear()
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize,
+                         len(self._records))
+
+
+class CachedRecord(object):
+    """A deserialized record in the cache, which is only ever handed
+    out as a copy so that callers can't change the cached record."""
+
+    __slots__ = ("record", "containers")
+
+    def __init__(self, record):
+        self.record = record
+        # every other value in a record is immutable, so only these
+        # need to be copied deeply
+        self.containers = [
+            k for k, v in six.iteritems(record)
+            if isinstance(v, (dict, list))
+        ]
+
+    def copy(self, cls=dict):
+        retval = cls(self.record)
+        for key in self.containers:
+            retval[key] = _copy_container(retval[key])
+        return retval
+
+    def track(self):
+        """Get a copy of the record that knows which of its fields have
+        been changed."""
+        record = self.copy(cls=TrackedRecord)
+        record.original = self.record
+        return record
+
+
+class TrackedRecord(dict):
+    """A deserialized record that remembers the values it was read
+    with, so that only the fields that have changed since need to be
+    serialized and written when it's saved.
+
+    Fields are compared with their original values, rather than
+    changes being recorded as they're made, so that changes to lists
+    and dicts within the record are caught too.
+    """
+
+    # the record as it was read, which is never changed in place
+    original = None
+
+    def changes(self):
+        """Get the fields that have changed, as a partial record, or
+        None if any field has been removed."""
+        original = self.original
+        if any(f not in self for f in original):
+            return None
+        return {
+            f: v
+            for f, v in six.iteritems(self)
+            if f not in original or v != original[f]
+        }
+
+    def saved(self, fields):
+        """Note that the given fields have been saved as they are
+        now."""
+        original = dict(self.original)
+        original.update(
+            (f, _copy_container(self[f]) if isinstance(self[f], (
+                dict, list)) else self[f]) for f in fields)
+        self.original = original
+
+
+class Database(collections.MutableSequence):
+    serializers = [DatetimeSerializer(), DateSerializer(), TimeSerializer()]
+    key = None
+
+    # once a shard's journal grows past this many bytes, it's folded
+    # back into the shard file
+    journal_max_size = 1024 * 1024
+
+    # fields whose text is kept out of the records, in a BlobStore
+    text_fields = ()
+
+    # how to divide the records among shards, as a Sharding; only
+    # keyed databases can be sharded
+    sharding = None
+
+    # how to compress the shards, as a Compression, or None to write
+    # them as plain JSON
+    compression = None
+
+    # set in processes that never change the database, which then
+    # read its records from a Snapshot rather than deserializing them
+    read_only = False
+
+    def __init__(self, filename, journal=False, cache_size=4096,
+                 compact=False):  # pylint: disable=super-init-not-called
+        self.filename = filename
+        self.journal = journal
+        self.cache_size = cache_size
+        self.compact = compact
+        self.uri = None
+        self.codec = None
+        self._backend = None
+        self._blobs = None
+        self._cache = None
+        self._snapshot = None
+        self._sync = True
+        self._reset()
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            uri = self.uri or _DB_URI
+            if _DB_PATH is None or uri is None:
+                raise DatabaseNotReady(self.filename)
+            scheme, path = parse_uri(uri)
+            location = os.path.join(_DB_PATH, path)
+            LOG.debug("Using %s backend at %s for %s", scheme, location,
+                      self.filename)
+            self._backend = BACKENDS[scheme](self, location)
+        return self._backend
+
+    def using(self, uri):
+        """Get a copy of this database that is stored at the given URI."""
+        other = copy.copy(self)
+        other.uri = uri
+        other._reset()  # pylint: disable=protected-access
+        return other
+
+    @property
+    def blobs(self):
+        if self._blobs is None:
+            name = os.path.splitext(self.filename)[0]
+            self._blobs = BlobStore(
+                os.path.join(self.backend.directory, "%s-text.blobs" % name))
+        return self._blobs
+
+    def _reset(self):
+        self._backend = None
+        self._blobs = None
+        self._snapshot = None
+        self._cache = RecordCache(self.cache_size)
+        self.codec = Codec(self.serializers + [BlobSerializer(self)])
+
+    def cache_info(self):
+        """Get hit, miss, and size statistics for the record cache."""
+        return self._cache.info()
+
+    @contextlib.contextmanager
+    def delay_write(self):
+        self._sync = False
+        yield
+        self._sync = True
+        self._save()
+        self._save_indexes(flush=True)
+
+    def get_shard(self, record):
+        return None
+
+    def rebalance(self):
+        """Move records between shards according to the sharding policy,
+        splitting any shards that are too large. Returns the new list
+        of shards."""
+        if self._blobs is not None:
+            self._blobs.sync()
+        shards = self.backend.rebalance()
+        self._reset()
+        return shards
+
+    def _get_snapshot(self):
+        if self._snapshot is None:
+            name = os.path.splitext(self.filename)[0]
+            snapshot = Snapshot(
+                os.path.join(self.backend.directory,
+                             "%s-snapshot.pickle" % name), self.key)
+            snapshot.load(self.backend, self._snapshot_record)
+            self._snapshot = snapshot
+        return self._snapshot
+
+    def _snapshot_record(self, record):
+        """Deserialize a record for the snapshot. Blob references can't
+        be pickled, so text fields are left serialized."""
+        text = {f: record[f] for f in self.text_fields if f in record}
+        retval = self._deserialize(record)
+        retval.update(text)
         return retval
 
+    def _from_snapshot(self, record, fields=None):
+        """Get a copy of a record from the snapshot, optionally with
+        only some fields."""
+        if fields is not None:
+            record = _project(record, fields)
+        retval = _copy_record(record)
+        for field in self.text_fields:
+            if field in retval:
+                retval[field] = self.codec.decode_value(retval[field])
+        return retval
+
+    def _save(self):
+        self._snapshot = None
+        if self._sync:
+            if self._blobs is not None:
+                self._blobs.sync()
+            self.backend.save()
+            self._save_indexes()
+
+    def sync(self):
+        if self._blobs is not None:
+            self._blobs.sync()
+        self.backend.save(force=True)
+        self._save_indexes(flush=True)
+
+    def _save_indexes(self, flush=False):
+        """Write any indexes that are kept on disk. Indexes may put off
+        writing changes that only matter to other processes, unless
+        ``flush`` is set."""
+        pass
+
+    def _reloaded(self, shard, old_records=None, new_records=None):
+        """Called by the backend when it finds that another process has
+        changed a shard that it's read. ``old_records`` and
+        ``new_records`` are the shard's serialized records before and
+        after, if the backend knows them."""
+        # pylint: disable=unused-argument
+        self._cache.clear()
+        self._snapshot = None
+
+    def store_text(self, record):
+        """Move the text in a serialized record into the blob store.
+
+        The record is changed in place, and returned.
+        """
+        for field in self.text_fields:
+            value = record.get(field)
+            if (value and isinstance(value, six.string_types)
+                    and not value.startswith("{BlobSerializer}")):
+                record[field] = self.codec.encode_value(self.blobs.put(value))
+        return record
+
+    def _serialize(self, record):
+        return self.store_text(self.codec.encode(record))
+
+    def _deserialize(self, record):
+        return self.codec.decode(record)
+
+    def _fetch(self, key):
+        return self.backend.get(key)
+
+    def _cache_key(self, idx, record):  # pylint: disable=unused-argument
+        return idx
+
+    def _get_cached(self, key, data=None):
+        """Get a deserialized record from the cache, falling back to
+        deserializing the given serialized record, or to fetching it
+        from the backend.
+
+        Callers always get their own copy of the record, so the
+        cached record can't be changed out from under the cache.
+        """
+        cached = self._cache.get(key)
+        if cached is not None:
+            return cached.copy()
+        if data is None:
+            data = self._fetch(key)
+        record = self._deserialize(data)
+        if self._cache.maxsize > 0:
+            cached = CachedRecord(record)
+            self._cache.add(key, cached)
+            return cached.copy()
+        return record
+
+    def _get_position(self, idx):
+        if idx < 0:
+            idx += len(self)
+        return idx
+
     def __getitem__(self, key):
-        self._load()
-        return self._deserialize(self._data[key])
+        if self.read_only:
+            return self._from_snapshot(
+                self._get_snapshot().records[self._get_position(key)])
+        return self._get_cached(self._get_position(key))
 
     def __setitem__(self, key, value):
-        self._load()
-        self._data[key] = self._serialize(value)
-        self._needs_write.add(self.get_shard(self._data[key]))
+        key = self._get_position(key)
+        self.backend.set(key, self._serialize(value))
+        self._cache.discard(key)
         self._save()
 
     def __delitem__(self, key):
-        self._load()
-        record = self._data.pop(key)
-        self._needs_write.add(self.get_shard(record[key]))
+        key = self._get_position(key)
+        self.backend.delete(key)
+        self._cache.discard_from(key)
         self._save()
 
     def __len__(self):
-        self._load()
-        return len(self._data)
+        if self.read_only:
+            return len(self._get_snapshot())
+        return len(self.backend)
+
+    def __iter__(self):
+        if self.read_only:
+            for record in self._get_snapshot():
+                yield self._from_snapshot(record)
+            return
+        for idx, record in enumerate(self.backend):
+            yield self._get_cached(self._cache_key(idx, record), record)
+
+    def iter(self, fields=None, stream=False):
+        """Iterate over the records, optionally with only some fields.
+
+        Asking for only the fields that are needed skips deserializing
+        the rest of each record, and the SQLite backend doesn't even
+        decode them. Partial records are never cached.
+
+        If ``stream`` is set, the records are read from storage as
+        they're needed, rather than loaded all at once and kept, so
+        that a pass over the whole database doesn't need all of it in
+        memory. Streamed records aren't cached either.
+
+        Read-only databases serve every other pass from their
+        snapshot, which is held in memory once it's loaded; a streamed
+        pass reads from storage even then, so that it never loads it.
+        """
+        if stream:
+            return (self._deserialize(r) for r in self.backend.stream(fields))
+        if self.read_only:
+            return (self._from_snapshot(r, fields)
+                    for r in self._get_snapshot())
+        if fields is None:
+            return iter(self)
+        return (self._deserialize(r) for r in self.backend.project(fields))
 
     def insert(self, index, value):
-        self._load()
-        self._data.insert(index, self._serialize(value))
-        self._needs_write.add(self.get_shard(self._data[index]))
+        index = self._get_position(index)
+        self.backend.insert(index, self._serialize(value))
+        self._cache.discard_from(index)
+        self._save()
+
+    def append(self, value):
+        self.backend.append(self._serialize(value))
         self._save()
 
+    def append_many(self, values):
+        """Append many records, saving only once."""
+        self.backend.extend([self._serialize(v) for v in values])
+        self._save()
+
+    def extend(self, values):
+        self.append_many(values)
+
     def __str__(self):
-        if self._data is None:
+        if self._backend is None or not self._backend.loaded:
             return "%s(%s, not loaded)" % (self.__class__.__name__,
                                            self.filename)
         return "%s(%s=%s)" % (self.__class__.__name__, self.filename,
                               dict(self))
 
     def __repr__(self):
-        if self._data is None:
+        if self._backend is None or not self._backend.loaded:
             return "%s(%s, not loaded)" % (self.__class__.__name__,
                                            self.filename)
         return "%s(%s=%r)" % (self.__class__.__name__, self.filename,
@@ -316,42 +3416,382 @@ class Database(collections.MutableSequence):
 
 
 class KeyedDatabase(Database):
-    def __init__(self, filename, key):
-        super(KeyedDatabase, self).__init__(filename)
+    # secondary indexes to maintain, as a dict of field name to index
+    # class (HashIndex or SortedIndex)
+    indexes = {}
+
+    # boolean fields to keep in the key index alongside each key, so
+    # they can be checked with flagged()
+    key_flags = ()
+
+    def __init__(self,
+                 filename,
+                 key,
+                 journal=False,
+                 cache_size=4096,
+                 compact=False):
+        super(KeyedDatabase, self).__init__(
+            filename, journal=journal, cache_size=cache_size, compact=compact)
         self.key = key
+        self._indexes = None
+        # the order that the indexed keys were stored in, as a dict of
+        # key to position, so that lookups return records in it
+        self._order = None
+        self._keys = None
+
+    def _reset(self):
+        super(KeyedDatabase, self)._reset()
+        self._indexes = None
+        self._order = None
+        self._keys = None
 
-    def _load(self, force=False):
-        super(KeyedDatabase, self)._load(force=force)
-        if self._by_key is None:
-            self._by_key = {d[self.key]: i for i, d in enumerate(self._data)}
+    def get_shard(self, record):
+        if self.sharding is None:
+            return None
+        return self.sharding.shard(record[self.key])
+
+    def _get_key_index(self):
+        if self._keys is None:
+            name = os.path.splitext(self.filename)[0]
+            keys = KeyIndex(
+                os.path.join(self.backend.directory, "%s-keys.idx" % name),
+                self.key_flags)
+            keys.load()
+            stale = [
+                s for s in self.backend.shards()
+                if not keys.current(s, self.backend.shard_stamp(s))
+            ]
+            if stale:
+                LOG.debug("Building key index for %s shards of %s",
+                          len(stale), self.filename)
+                for shard in stale:
+                    keys.set_section(shard, self.key,
+                                     self.backend.shard_records(shard))
+                keys.save(self.backend.known_stamp, self.backend.shards())
+            self._keys = keys
+        return self._keys
+
+    def _get_keys_for(self, key):
+        """Get the key index, and the shard that a key belongs in, with
+        the index up to date for that shard."""
+        keys = self._get_key_index()
+        shard = self.backend.key_shard(key)
+        if keys.changed(shard):
+            # the shard has changed here, so the index is only out of
+            # date if another process has changed it too, and the
+            # backend tells us about that
+            self.backend.refresh(shard)
+        elif not keys.current(shard, self.backend.shard_stamp(shard)):
+            keys.set_section(shard, self.key,
+                             self.backend.shard_records(shard))
+        return keys, shard
+
+    def _save_indexes(self, flush=False):
+        if self._keys is not None:
+            self._keys.save(self.backend.known_stamp,
+                            self.backend.shards(),
+                            flush=flush)
+
+    def _reloaded(self, shard, old_records=None, new_records=None):
+        super(KeyedDatabase, self)._reloaded(shard, old_records,
+                                             new_records)
+        if old_records is None:
+            self._indexes = None
+            if self._keys is not None:
+                self._keys.forget(shard)
+            return
 
-    def __getitem__(self, idx):
-        self._load()
-        if idx in self._by_key:
-            idx = self._by_key[idx]
+        if self._keys is not None:
+            self._keys.set_section(shard, self.key, new_records)
+        if self._indexes is not None:
+            for index in self._indexes.values():
+                for record in old_records:
+                    index.discard(record[self.key], record)
+                for record in new_records:
+                    index.add(record[self.key], record)
+            for record in new_records:
+                self._add_order(record[self.key])
+
+    def _get_index(self, field):
+        if self._indexes is None:
+            # indexes are built from the serialized records, so
+            # nothing needs to be deserialized
+            LOG.debug("Building indexes on %s for %s", ", ".join(
+                self.indexes.keys()), self.filename)
+            self._indexes = {
+                f: cls(f)
+                for f, cls in self.indexes.items()
+            }
+            self._order = {}
+            if self.read_only:
+                records = (self._index_fields(r)
+                           for r in self._get_snapshot())
+            else:
+                records = self.backend
+            for record in records:
+                self._add_order(record[self.key])
+                for index in self._indexes.values():
+                    index.add(record[self.key], record)
         try:
-            data = self._data[idx]
-        except TypeError:
-            raise KeyError(idx)
-        return self._deserialize(data)
+            return self._indexes[field]
+        except KeyError:
+            raise NoSuchIndex("%s is not indexed in %s" % (field,
+                                                           self.filename))
+
+    def _reindex(self, old_record, new_record):
+        if old_record is not None and (
+                new_record is None
+                or new_record[self.key] != old_record[self.key]):
+            keys, shard = self._get_keys_for(old_record[self.key])
+            keys.discard(shard, old_record[self.key])
+        if new_record is not None:
+            keys, shard = self._get_keys_for(new_record[self.key])
+            keys.add(shard, new_record[self.key], new_record)
+
+        if self._indexes is None:
+            return
+        for index in self._indexes.values():
+            if old_record is not None:
+                index.discard(old_record[self.key], old_record)
+            if new_record is not None:
+                index.add(new_record[self.key], new_record)
+        if new_record is not None:
+            self._add_order(new_record[self.key])
+
+    def _add_order(self, key):
+        if key not in self._order:
+            self._order[key] = len(self._order)
+
+    def _serialize_value(self, field, value):
+        return self._serialize({field: value})[field]
+
+    def _deserialize_value(self, field, value):
+        return self._deserialize({field: value})[field]
+
+    def _index_fields(self, record):
+        """Serialize the key and the indexed fields of a deserialized
+        record, for indexing."""
+        retval = {
+            f: self.codec.encode_value(record[f])
+            for f in self.indexes if f in record
+        }
+        retval[self.key] = record[self.key]
+        return retval
+
+    def _get_fields(self, key, fields=None):
+        if self.read_only:
+            return self._from_snapshot(self._get_snapshot().get(key), fields)
+        if fields is None:
+            return self[key]
+        return _copy_record(
+            self._deserialize(_project(self._fetch(key), fields)))
+
+    def find(self, fields=None, **criteria):
+        """Find records by the values of indexed fields.
+
+        Each criterion is either a value that the field must equal,
+        or a function that is called with each distinct value of the
+        field and returns whether or not records with that value
+        match. Only the matching records are deserialized. For
+        instance::
+
+            db.collisions.find(
+                parsed=True,
+                road_location=lambda loc: loc not in (None, "unknown"))
+
+        Records are returned in the order they were stored in, as
+        iterating over the database would. As with iter(), ``fields``
+        limits the fields that are returned.
+        """
+        keys = None
+        for field, value in criteria.items():
+            index = self._get_index(field)
+            if callable(value):
+                matches = set()
+                for indexed in index.values():
+                    if value(self._deserialize_value(field, indexed)):
+                        matches.update(index.find(indexed))
+            else:
+                matches = index.find(self._serialize_value(field, value))
+            keys = matches if keys is None else keys & matches
+        for key in sorted(keys or (), key=self._order.get):
+            yield self._get_fields(key, fields)
+
+    def range(self, field, low=None, high=None, reverse=False, fields=None):
+        """Find records whose value of an indexed field falls between
+        ``low`` and (not including) ``high``, ordered by that field,
+        and then by the order they were stored in.
+
+        Either end of the range can be omitted. Records without the
+        field, or where it is None, are never included. As with
+        iter(), ``fields`` limits the fields that are returned.
+        """
+        index = self._get_index(field)
+        if not isinstance(index, SortedIndex):
+            raise NoSuchIndex("%s does not have a sorted index in %s" %
+                              (field, self.filename))
+        if low is not None:
+            low = self._serialize_value(field, low)
+        if high is not None:
+            high = self._serialize_value(field, high)
+        values = index.range(low, high)
+        if reverse:
+            values.reverse()
+        for value in values:
+            for key in sorted(index.find(value), key=self._order.get,
+                              reverse=reverse):
+                yield self._get_fields(key, fields)
+
+    def _fetch(self, key):
+        data = self.backend.fetch(key)
+        if data is None:
+            raise KeyError(key)
+        return data
+
+    def _get_cached(self, key, data=None):
+        """Get a TrackedRecord from the cache, as for
+        Database._get_cached(), so that saving it back only writes
+        the fields that have changed."""
+        cached = self._cache.get(key)
+        if cached is None:
+            if data is None:
+                data = self._fetch(key)
+            cached = CachedRecord(self._deserialize(data))
+            if self._cache.maxsize > 0:
+                self._cache.add(key, cached)
+        return cached.track()
+
+    def _cache_key(self, idx, record):
+        # records are cached by key, so that inserting or deleting
+        # records doesn't shift the cache
+        return record[self.key]
+
+    def __getitem__(self, idx):
+        if self.read_only:
+            snapshot = self._get_snapshot()
+            if isinstance(idx, six.integer_types):
+                return self._from_snapshot(snapshot.records[idx])
+            return self._from_snapshot(snapshot.get(idx))
+        if isinstance(idx, six.integer_types):
+            data = self.backend.get(idx)
+            return self._get_cached(data[self.key], data)
+        # make sure that a cached record isn't one that another process
+        # has changed since
+        self.backend.refresh(self.backend.key_shard(idx))
+        return self._get_cached(idx)
+
+    def _get_old_record(self, idx):
+        """Get the serialized record that's about to change, if the
+        indexes or the cache need to know about it."""
+        if isinstance(idx, six.integer_types):
+            return self.backend.get(idx)
+        elif self._indexes is None:
+            return None
+        return self.backend.fetch(idx)
+
+    def _invalidate(self, old_record, new_record):
+        for record in (old_record, new_record):
+            if record is not None:
+                self._cache.discard(record[self.key])
 
     def __setitem__(self, idx, value):
-        self._load()
-        if idx in self._by_key:
-            idx = self._by_key[idx]
-        super(KeyedDatabase, self).__setitem__(idx, value)
-        self._by_key[value[self.key]] = idx
+        self._set(idx, value)
+
+    def _set(self, idx, value, fields=None):
+        self._store(idx, value, fields=fields)
+        self._save()
+
+    def _store(self, idx, value, fields=None):
+        """Change a record without saving.
+
+        If a record that was read from this database is being written
+        back, only the fields that have changed are.
+        """
+        if (fields is None and isinstance(value, TrackedRecord)
+                and value.original is not None
+                and value.original.get(self.key) == idx
+                and value.get(self.key) == idx):
+            changes = value.changes()
+            if changes is not None:
+                # text that's still inline in the stored record is
+                # moved out now that the record is written again
+                changes.update(
+                    (f, value[f]) for f in self.text_fields
+                    if f not in changes and value.get(f)
+                    and isinstance(value.original.get(f), six.string_types))
+                if changes:
+                    changes[self.key] = idx
+                    self._merge(changes)
+                    value.saved(changes)
+                return
+        record = self._serialize(value)
+        old_record = self._get_old_record(idx)
+        if isinstance(idx, six.integer_types):
+            self.backend.set(idx, record)
+        else:
+            self.backend.store(record, fields=fields)
+            self._cache.discard(idx)
+        self._reindex(old_record, record)
+        self._invalidate(old_record, record)
+
+    def _merge(self, value):
+        """Merge a partial record into the existing record with the same
+        key, without saving.
+
+        Only the given fields are serialized, and the backend merges
+        them into the serialized record, so the existing record is
+        never deserialized.
+        """
+        record = self._serialize(value)
+        key = record[self.key]
+        old_record = self._get_old_record(key)
+        # only the fields that were given are marked as changed, so
+        # that if another process has changed other fields of the
+        # same record since it was read, those changes are kept
+        self.backend.store(record, fields=list(record))
+        new_record = self.backend.fetch(key)
+        self._reindex(old_record, new_record)
+        self._invalidate(old_record, new_record)
+
+    def _append(self, value):
+        """Append a record without saving."""
+        record = self._serialize(value)
+        self.backend.append(record)
+        self._reindex(None, record)
+        self._invalidate(None, record)
 
     def __delitem__(self, idx):
-        self._load()
-        if idx in self._by_key:
-            idx = self._by_key[idx]
-            del self._by_key[idx]
-        super(KeyedDatabase, self).__delitem__(idx)
+        old_record = self._get_old_record(idx)
+        if isinstance(idx, six.integer_types):
+            self.backend.delete(idx)
+        else:
+            self.backend.remove(idx)
+            self._cache.discard(idx)
+            keys, shard = self._get_keys_for(idx)
+            keys.discard(shard, idx)
+        self._reindex(old_record, None)
+        self._invalidate(old_record, None)
+        self._save()
 
-    def insert(self, idx, value):
-        super(KeyedDatabase, self).insert(idx, value)
-        self._by_key[value[self.key]] = idx
+    def insert(self, index, value):
+        record = self._serialize(value)
+        self.backend.insert(index, record)
+        self._reindex(None, record)
+        self._invalidate(None, record)
+        self._save()
+
+    def append(self, value):
+        self._append(value)
+        self._save()
+
+    def append_many(self, values):
+        """Append many records, saving only once."""
+        records = [self._serialize(v) for v in values]
+        self.backend.extend(records)
+        for record in records:
+            self._reindex(None, record)
+            self._invalidate(None, record)
+        self._save()
 
     def get(self, key, default=None):
         try:
@@ -363,47 +3803,80 @@ class KeyedDatabase(Database):
         return self.exists(record[self.key])
 
     def exists(self, key):
-        self._load()
-        return key in self._by_key
+        if self.backend.indexed_keys:
+            return self.backend.contains(key)
+        keys, shard = self._get_keys_for(key)
+        return keys.contains(shard, key)
+
+    def flagged(self, key, flag):
+        """Whether or not a record exists with the given key and a
+        true value for the given field, which must be one of
+        ``key_flags``. Neither loads nor deserializes any records."""
+        keys, shard = self._get_keys_for(key)
+        return keys.flagged(shard, key, flag)
+
+    def flag_value(self, key, flag):
+        """Get the value of a field that's one of ``key_flags`` as True
+        or False, or None if there's no record with the given key, or
+        the field is unset or None in it. Like flagged(), this neither
+        loads nor deserializes any records."""
+        keys, shard = self._get_keys_for(key)
+        return keys.flag_value(shard, key, flag)
 
     def replace(self, record):
-        self._load()
-        idx = self._by_key[record[self.key]]
-        self[idx] = record
+        self[record[self.key]] = record
 
     update = replace
 
     def merge(self, record):
-        self._load()
-        idx = self._by_key[record[self.key]]
-        new_record = copy.deepcopy(self[idx])
-        new_record.update(record)
-        # we replace the old record, even though it's slower, in order
-        # to ensure that __setitem__() is called, with all of its
-        # attendant magic -- updating the key data, saving, etc.
-        self[idx] = new_record
-        return self[idx]
+        self._merge(record)
+        self._save()
+        return self[record[self.key]]
+
+    def merge_many(self, records):
+        """Merge many partial records, as merge() does, saving only
+        once."""
+        for record in records:
+            self._merge(record)
+        self._save()
 
     def update_many(self, records):
+        """Replace many records, saving only once."""
         for record in records:
-            self.update(record)
+            self._store(record[self.key], record)
+        self._save()
 
     def upsert(self, record):
         if self.exists(record[self.key]):
-            self.update_one(record)
+            self.update(record)
         else:
-            return self.append(record)
+            self.append(record)
+
+    def upsert_many(self, records):
+        """Replace each of the records that exists, and append each that
+        doesn't, saving only once."""
+        for record in records:
+            if self.exists(record[self.key]):
+                self._store(record[self.key], record)
+            else:
+                self._append(record)
+        self._save()
 
 
 class CollisionDatabase(KeyedDatabase):
-    def get_shard(self, record):
-        if record[self.key].startswith("NDOR"):
-            return "NDOR"
-        else:
-            return record[self.key].strip()[0:2].upper()
+    text_fields = ("report", "report_continued")
+    key_flags = ("parsed", "hit_and_run")
+    indexes = {
+        "road_location": HashIndex,
+        "parsed": HashIndex,
+        "date": SortedIndex,
+    }
+
+    sharding = PrefixSharding(length=2, prefixes=["NDOR"])
 
 
 _DB_PATH = None
+_DB_URI = None
 _FIXTURE_PATH = None
 
 # pylint: disable=invalid-name
@@ -432,9 +3905,46 @@ tickets = Database("tickets.json")
 collisions = CollisionDatabase("collisions.json", key="case_no")
 traffic = Database("traffic.json")
 
+DATABASES = (tickets, collisions, traffic)
 
-def init(db_path, fixture_path):
-    global _DB_PATH, _FIXTURE_PATH  # pylint: disable=global-statement
+
+@atexit.register
+def _flush_indexes():
+    """Write out any index changes that were put off, so that other
+    processes don't need to rebuild them."""
+    for database in DATABASES:
+        try:
+            database._save_indexes(  # pylint: disable=protected-access
+                flush=True)
+        except (IOError, OSError) as err:
+            LOG.debug("Could not write indexes for %s: %s", database.filename,
+                      err)
+
+
+def init(db_path,
+         fixture_path,
+         uri="json:",
+         journal=False,
+         cache_size=4096,
+         compact=False,
+         sharding=None,
+         compression=None,
+         read_only=False):
+    global _DB_PATH, _DB_URI, _FIXTURE_PATH  # pylint: disable=global-statement
 
     _DB_PATH = db_path
+    _DB_URI = uri
     _FIXTURE_PATH = fixture_path
+
+    for database in DATABASES:
+        database.journal = journal
+        database.cache_size = cache_size
+        database.compact = compact
+        database.read_only = read_only
+        if sharding is not None and database.sharding is not None:
+            database.sharding = sharding
+        if compression is not None:
+            # by database name, e.g. "collisions"
+            database.compression = compression.get(
+                os.path.splitext(database.filename)[0])
+        database._reset()  # pylint: disable=protected-access
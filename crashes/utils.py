@@ -1,7 +1,14 @@
 """Assorted utility functions."""
 
+import hashlib
+import logging
 import os
 
+from six.moves import cPickle as pickle
+import yaml
+
+LOG = logging.getLogger(__name__)
+
 
 def case_no_to_filename(case_no):
     return "%s.PDF" % case_no.replace("-", "").upper()
@@ -13,10 +20,63 @@ def filename_to_case_no(fpath):
     return "%s-%s" % (case_id[0:2], case_id[2:])
 
 
+def get_text(value):
+    """Get the text of a text field, which may be stored out-of-line."""
+    if hasattr(value, "read"):
+        return value.read()
+    return value
+
+
 def get_report_text(report):
-    if report.get("report"):
-        contd = report.get("report_continued", "")
-        if contd and report["report"].endswith(contd):
-            return report["report"]
-        return report["report"] + contd
+    text = get_text(report.get("report"))
+    if text:
+        contd = get_text(report.get("report_continued", ""))
+        if contd and text.endswith(contd):
+            return text
+        return text + contd
     return ""
+
+
+def _yaml_cache_path(filepath):
+    dirname, basename = os.path.split(os.path.abspath(filepath))
+    return os.path.join(dirname, ".%s.pickle" % basename)
+
+
+def load_yaml(filepath, loader=yaml.safe_load):
+    """Load a YAML file, by way of a compiled cache if possible.
+
+    Parsing YAML is slow, so the parsed data is pickled to a hidden
+    file next to the source. The cache is keyed by a hash of the
+    source, so it's simply rebuilt whenever the YAML changes; it's
+    never required, so a cache that can't be read or written is
+    ignored.
+    """
+    with open(filepath, "rb") as yamlfile:
+        source = yamlfile.read()
+    digest = hashlib.sha1(source)
+    digest.update(loader.__name__.encode("ascii"))
+    digest = digest.hexdigest()
+
+    cache_path = _yaml_cache_path(filepath)
+    try:
+        with open(cache_path, "rb") as cachefile:
+            cached_digest, data = pickle.load(cachefile)
+        if cached_digest == digest:
+            return data
+        LOG.debug("Cache of %s is out of date", filepath)
+    except (IOError, OSError):
+        pass
+    except Exception as err:  # pylint: disable=broad-except
+        # a cache written by another version of Python or pickle
+        # can fail in any number of ways; just rebuild it
+        LOG.debug("Ignoring unreadable cache of %s: %s", filepath, err)
+
+    data = loader(source)
+    tmp_path = "%s.tmp" % cache_path
+    try:
+        with open(tmp_path, "wb") as cachefile:
+            pickle.dump((digest, data), cachefile, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, cache_path)
+    except (IOError, OSError) as err:
+        LOG.debug("Could not write cache of %s: %s", filepath, err)
+    return data
@@ -0,0 +1,62 @@
+"""Helpers shared by the tests."""
+
+import datetime
+import shutil
+import tempfile
+import unittest
+
+from crashes import db
+from crashes import utils
+
+
+def make_record(num, prefix="B9", **fields):
+    """Make a collision record with a key and some typical fields."""
+    record = {
+        "case_no": "%s-%06d" % (prefix, num),
+        "date": datetime.date(2019, 1, 1) + datetime.timedelta(num % 365),
+        "parsed": True,
+        "report": "Report number %s" % num,
+    }
+    record.update(fields)
+    return record
+
+
+def read_text(record):
+    """Get a copy of a record with its text fields read in."""
+    return {k: utils.get_text(v) for k, v in record.items()}
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """Test case that initializes the databases in a new directory."""
+
+    def setUp(self):
+        super(DatabaseTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+        # other processes' changes are picked up on the next read,
+        # rather than once a second
+        reload_interval = db.JSONBackend.reload_interval
+        db.JSONBackend.reload_interval = 0
+        self.addCleanup(setattr, db.JSONBackend, "reload_interval",
+                        reload_interval)
+        self.init()
+
+    def init(self, sharding=None, compression=None, **kwargs):
+        """Initialize the databases afresh, as a new process would."""
+        if sharding is None:
+            sharding = db.make_sharding(
+                by="prefix", length=2, prefixes=["NDOR"])
+        db.init(
+            self.tmpdir,
+            self.tmpdir,
+            sharding=sharding,
+            compression=compression or {},
+            **kwargs)
+
+    def assertRecords(self, database, expected):
+        """Assert that a database holds exactly the given records."""
+        self.assertEqual(
+            sorted(
+                (read_text(r) for r in database), key=lambda r: r["case_no"]),
+            sorted(expected, key=lambda r: r["case_no"]))
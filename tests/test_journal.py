@@ -0,0 +1,134 @@
+"""Tests for journaled writes and replaying unsaved changes."""
+
+import os
+
+from crashes import db
+from tests import base
+
+
+class TestJournal(base.DatabaseTestCase):
+    def setUp(self):
+        super(TestJournal, self).setUp()
+        self.records = [base.make_record(i) for i in range(20)]
+        db.collisions.append_many(self.records)
+        self.init(journal=True)
+
+    def _journal_path(self, shard="B9"):
+        return os.path.join(self.tmpdir, "collisions-%s.journal" % shard)
+
+    def test_changes_are_journaled(self):
+        key = self.records[0]["case_no"]
+        db.collisions.merge({"case_no": key, "initials": "AB"})
+        self.assertTrue(os.path.exists(self._journal_path()))
+
+        self.init(journal=True)
+        self.assertEqual(db.collisions[key]["initials"], "AB")
+
+    def test_replay(self):
+        expected = [dict(r) for r in self.records]
+        expected[3]["initials"] = "CD"
+        db.collisions.merge({
+            "case_no": expected[3]["case_no"],
+            "initials": "CD"
+        })
+        del db.collisions[expected[5]["case_no"]]
+        del expected[5]
+        expected.append(base.make_record(100))
+        db.collisions.append(base.make_record(100))
+
+        self.init(journal=True)
+        self.assertRecords(db.collisions, expected)
+        self.assertRecords(db.collisions.using("json:"), expected)
+
+    def test_fold(self):
+        db.collisions.journal_max_size = 512
+        self.addCleanup(delattr, db.collisions, "journal_max_size")
+        for i, record in enumerate(self.records):
+            db.collisions.merge({"case_no": record["case_no"], "count": i})
+            record["count"] = i
+        # the journal is folded into the shard each time it passes the
+        # limit, so it never holds more than one batch of changes past
+        # it
+        self.assertLess(os.path.getsize(self._journal_path()), 1024)
+
+        self.init(journal=True)
+        self.assertRecords(db.collisions, self.records)
+
+    def test_replay_over_other_process(self):
+        key = self.records[0]["case_no"]
+        other = db.collisions.using("json:")
+        self.assertEqual(len(other), len(self.records))
+
+        with other.delay_write():
+            other.merge({"case_no": key, "injured": True})
+            # this saves while the other process has unsaved changes
+            # to the same shard, which are replayed over it when they
+            # are saved
+            db.collisions.merge({"case_no": key, "initials": "EF"})
+
+        self.init(journal=True)
+        self.assertEqual(db.collisions[key]["initials"], "EF")
+        self.assertTrue(db.collisions[key]["injured"])
+
+
+class TestJournalNewShards(base.DatabaseTestCase):
+    def setUp(self):
+        super(TestJournalNewShards, self).setUp()
+        self.init(journal=True)
+
+    def _write(self, filename, data):
+        with open(os.path.join(self.tmpdir, filename), "w") as outfile:
+            outfile.write(data)
+
+    def test_append_to_empty_database(self):
+        records = [base.make_record(i) for i in range(5)]
+        db.collisions.append_many(records)
+        # a new shard is written in full, not just journaled
+        self.assertTrue(
+            os.path.exists(os.path.join(self.tmpdir, "collisions-B9.json")))
+
+        self.init(journal=True)
+        self.assertEqual(len(db.collisions), len(records))
+        for record in records:
+            self.assertEqual(
+                base.read_text(db.collisions.get(record["case_no"])),
+                record)
+        self.assertRecords(db.collisions, records)
+
+    def test_merge_into_new_shard(self):
+        records = [base.make_record(i) for i in range(5)]
+        db.collisions.append_many(records)
+        new = base.make_record(1, prefix="C1")
+        db.collisions.append(new)
+        db.collisions.merge({"case_no": new["case_no"], "initials": "AB"})
+        new["initials"] = "AB"
+
+        self.init(journal=True)
+        self.assertEqual(len(db.collisions), len(records) + 1)
+        self.assertEqual(
+            base.read_text(db.collisions.get(new["case_no"])), new)
+        self.assertRecords(db.collisions, records + [new])
+
+    def test_append_to_listed_shard_with_no_file(self):
+        # a shard that's listed, but has never been written
+        self._write("tickets-shards.json", "[null]")
+        self.init(journal=True)
+        tickets = [{"ticket": i} for i in range(5)]
+        db.tickets.append_many(tickets)
+        self.assertTrue(
+            os.path.exists(os.path.join(self.tmpdir, "tickets.json")))
+
+        self.init(journal=True)
+        self.assertEqual(len(db.tickets), len(tickets))
+        self.assertEqual(db.tickets[0], tickets[0])
+        self.assertEqual(list(db.tickets), tickets)
+
+    def test_replay_journal_with_no_shard_file(self):
+        self._write("tickets-shards.json", "[null]")
+        self._write("tickets.journal",
+                    '["a",{"ticket":1}]\n["a",{"ticket":2}]\n')
+
+        self.init(journal=True)
+        self.assertEqual(list(db.tickets), [{"ticket": 1}, {"ticket": 2}])
+        self.assertEqual(list(db.tickets.iter(stream=True)),
+                         [{"ticket": 1}, {"ticket": 2}])
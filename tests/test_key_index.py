@@ -0,0 +1,69 @@
+"""Tests for the on-disk key index."""
+
+import os
+
+from crashes import db
+from tests import base
+
+
+class TestKeyIndex(base.DatabaseTestCase):
+    def setUp(self):
+        super(TestKeyIndex, self).setUp()
+        self.records = [base.make_record(i) for i in range(20)]
+        db.collisions.append_many(self.records)
+        self.init(journal=True)
+        self.key = self.records[0]["case_no"]
+        self.assertTrue(db.collisions.exists(self.key))
+
+    def _index_stamp(self):
+        return db._file_stamp(  # pylint: disable=protected-access
+            os.path.join(self.tmpdir, "collisions-keys.idx"))
+
+    def _stale_shards(self):
+        keys = db.KeyIndex(
+            os.path.join(self.tmpdir, "collisions-keys.idx"),
+            db.collisions.key_flags)
+        keys.load()
+        backend = db.collisions.backend
+        return [
+            s for s in backend.shards()
+            if not keys.current(s, backend.shard_stamp(s))
+        ]
+
+    def test_unflagged_changes_dont_rewrite_index(self):
+        stamp = self._index_stamp()
+        for i in range(5):
+            db.collisions.merge({"case_no": self.key, "initials": "A%s" % i})
+        self.assertEqual(self._index_stamp(), stamp)
+        # the index is still up to date in this process
+        self.assertTrue(db.collisions.exists(self.key))
+        self.assertEqual(db.collisions.flag_value(self.key, "parsed"), True)
+
+    def test_flag_changes_are_saved(self):
+        db.collisions.merge({"case_no": self.key, "parsed": False})
+
+        self.init(journal=True)
+        self.assertEqual(db.collisions.flag_value(self.key, "parsed"), False)
+        self.assertFalse(db.collisions.flagged(self.key, "parsed"))
+
+    def test_stamps_are_written_after_delay_write(self):
+        with db.collisions.delay_write():
+            db.collisions.merge({"case_no": self.key, "initials": "AB"})
+            new = base.make_record(100)
+            db.collisions.append(new)
+        self.assertEqual(self._stale_shards(), [])
+
+        self.init(journal=True)
+        self.assertTrue(db.collisions.exists(new["case_no"]))
+        self.assertFalse(
+            db.collisions.exists(base.make_record(101)["case_no"]))
+
+    def test_sqlite_exists(self):
+        uri = "sqlite:///crashes.sqlite"
+        db.collisions.using(uri).append_many(self.records[:3])
+
+        sqlite = db.collisions.using(uri)
+        self.assertTrue(sqlite.exists(self.key))
+        self.assertFalse(sqlite.exists(self.records[3]["case_no"]))
+        # SQLite's own index on the keys answers it
+        self.assertIsNone(sqlite._keys)  # pylint: disable=protected-access
@@ -0,0 +1,67 @@
+"""Tests for copying the databases between storage backends."""
+
+import argparse
+
+from crashes.commands import migrate
+from crashes import db
+from tests import base
+
+
+class TestMigrate(base.DatabaseTestCase):
+    def setUp(self):
+        super(TestMigrate, self).setUp()
+        self.collisions = [
+            base.make_record(i, prefix=p)
+            for i, p in enumerate(["B8", "B9", "NDOR"] * 5)
+        ]
+        db.collisions.append_many(self.collisions)
+        self.tickets = [{
+            "case_no": r["case_no"],
+            "initials": "AB",
+            "desc": "Ticket %s" % i
+        } for i, r in enumerate(self.collisions[:4])]
+        db.tickets.extend(self.tickets)
+
+    def _migrate(self, source, dest):
+        options = argparse.Namespace(
+            source=source, dest=dest, database="json:")
+        self.assertEqual(migrate.Migrate(options)(), 0)
+
+    def test_round_trip(self):
+        sqlite = "sqlite:///crashes.sqlite"
+        self._migrate("json:", sqlite)
+        self.assertRecords(db.collisions.using(sqlite), self.collisions)
+        self.assertEqual(list(db.tickets.using(sqlite)), self.tickets)
+
+        copy = "json:///copy"
+        self._migrate(sqlite, copy)
+        self.assertRecords(db.collisions.using(copy), self.collisions)
+        self.assertEqual(list(db.tickets.using(copy)), self.tickets)
+        record = self.collisions[0]
+        self.assertEqual(
+            base.read_text(db.collisions.using(copy)[record["case_no"]]),
+            record)
+
+    def test_inline_text_is_moved_out(self):
+        # write a record the way they were written before text was
+        # kept out of line
+        record = base.make_record(100)
+        db.collisions.backend.append(db.collisions.codec.encode(record))
+        db.collisions.sync()
+        self.assertEqual(
+            db.collisions.backend.fetch("B9-000100")["report"],
+            record["report"])
+
+        sqlite = "sqlite:///crashes.sqlite"
+        self._migrate("json:", sqlite)
+        dest = db.collisions.using(sqlite)
+        self.assertTrue(
+            dest.backend.fetch("B9-000100")["report"].startswith(
+                "{BlobSerializer}"))
+        self.assertEqual(base.read_text(dest["B9-000100"]), record)
+
+    def test_refuses_to_overwrite(self):
+        sqlite = "sqlite:///crashes.sqlite"
+        self._migrate("json:", sqlite)
+        self.assertRaises(SystemExit, self._migrate, "json:", sqlite)
+        self.assertRaises(SystemExit, self._migrate, "json:", "json:")
@@ -0,0 +1,171 @@
+"""Tests for telling the types of report pages apart."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from crashes.commands import parse
+
+
+class Text(object):
+    """Stand-in for a pdfminer text box."""
+
+    def __init__(self, text=""):
+        self.text = text
+
+    def get_text(self):
+        return self.text
+
+
+def make_objects(texts, count=1):
+    """Make the objects on a page, with the given text at the given
+    positions, and blank objects everywhere else."""
+    objects = [Text() for _ in range(max([count] + [i + 1 for i in texts]))]
+    for idx, text in texts.items():
+        objects[idx] = Text(text)
+    return objects
+
+
+SAMPLES = {
+    "report": {0: "Motor Vehicle  Accident  Report\n"},
+    "diagram": {0: "THE  FOLLOWING INFORMATION  IS REQUIRED\n"},
+    "addl_diagram": {0: "ADDITIONAL  -  DIAGRAM\n"},
+    "40a": {241: "40a\n"},
+    "40b": {368: "40b\n"},
+    "truck_bus": {0: "Supplemental Truck  and  Bus\n"},
+}
+
+
+class TestPageTypes(unittest.TestCase):
+    def test_classify_samples(self):
+        for name, texts in SAMPLES.items():
+            objects = make_objects(texts)
+            text = parse.get_text(objects)
+            candidates = parse.PDFPage.classify(text)
+            self.assertEqual([c.name for c in candidates], [name])
+            self.assertEqual(
+                parse.PDFPage.factory(objects, {
+                    "start_index": {},
+                    "start_y": {}
+                }).name, name)
+
+    def test_generic_signatures(self):
+        # an unknown page that happens to mention a form number could
+        # only be one of the continuation pages, but that isn't enough
+        # to go on without matching its layout
+        objects = make_objects({0: "Continued on 40a\n"}, count=400)
+        candidates = parse.PDFPage.classify(parse.get_text(objects))
+        self.assertEqual([c.name for c in candidates], ["40a"])
+        self.assertFalse(candidates[0].distinctive)
+        self.assertRaises(parse.UnknownPageType, parse.PDFPage.factory,
+                          objects, {"start_index": {}, "start_y": {}})
+
+    def test_continuation_page_with_report_heading(self):
+        objects = make_objects({
+            0: "Motor Vehicle  Accident  Report\n",
+            241: "40a\n"
+        })
+        candidates = parse.PDFPage.classify(parse.get_text(objects))
+        self.assertEqual(
+            sorted(c.name for c in candidates), ["40a", "report"])
+
+
+def write_pdf(filepath, pages):
+    """Write a PDF with a page for each list of (x, y, text) strings,
+    drawn in that order."""
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    kids = []
+    for strings in pages:
+        content = b"".join(
+            b"BT /F1 12 Tf %d %d Td (" % (x, y) + text.encode("ascii") +
+            b") Tj ET\n" for x, y, text in strings)
+        objects.append(b"<< /Length %d >>\nstream\n" % len(content) +
+                       content + b"endstream")
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            b"/Resources << /Font << /F1 3 0 R >> >> "
+            b"/Contents %d 0 R >>" % (len(objects)))
+        kids.append(b"%d 0 R" % len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(kids), len(kids))
+
+    data = b"%PDF-1.4\n"
+    offsets = []
+    for num, obj in enumerate(objects, 1):
+        offsets.append(len(data))
+        data += b"%d 0 obj\n" % num + obj + b"\nendobj\n"
+    xref = len(data)
+    data += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    data += b"".join(b"%010d 00000 n \n" % o for o in offsets)
+    data += (b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+             % (len(objects) + 1, xref))
+    with open(filepath, "wb") as outfile:
+        outfile.write(data)
+
+
+class TestClassifyPDF(unittest.TestCase):
+    layout = {"start_index": {}, "start_y": {}}
+
+    def setUp(self):
+        super(TestClassifyPDF, self).setUp()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.filepath = os.path.join(tmpdir, "report.pdf")
+
+        analyze = parse.LayoutAggregator.analyze
+        self.analyzed = []
+
+        def count_analyze(device, ltpage):
+            self.analyzed.append(ltpage.pageid)
+            analyze(device, ltpage)
+
+        patcher = mock.patch.object(parse.LayoutAggregator, "analyze",
+                                    count_analyze)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _pages(self, pages, skip=()):
+        write_pdf(self.filepath, pages)
+        doc = parse.PDFDocument(self.filepath, self.layout)
+        try:
+            return list(doc.pages(skip=skip))
+        finally:
+            doc.stream.close()
+
+    def test_skip_classified_page(self):
+        heading = (72, 700, "Motor Vehicle  Accident  Report")
+        pages = self._pages([[heading, (72, 600, "Page one")],
+                             [heading, (72, 600, "Page two")]],
+                            skip=["report"])
+        self.assertEqual(pages, [])
+        self.assertEqual(self.analyzed, [])
+
+        pages = self._pages([[heading]])
+        self.assertEqual([p.name for p in pages], ["report"])
+        self.assertEqual(len(self.analyzed), 1)
+
+    def test_unclassified_page_is_analyzed(self):
+        # the heading isn't drawn in one piece, so it can't be told
+        # from the characters alone
+        pages = self._pages([[(72, 700, "Motor Vehicle  Accident"),
+                              (72, 600, "Investigator"),
+                              (246, 700, "  Report")]], skip=["report"])
+        self.assertEqual(len(self.analyzed), 1)
+        self.assertEqual(len(pages), 1)
+        self.assertIsInstance(pages[0], parse.UnknownPageType)
+
+    def test_generic_signature_is_analyzed(self):
+        pages = self._pages([[(72, 700, "Continued on 40a")]],
+                            skip=["40a"])
+        self.assertEqual(len(self.analyzed), 1)
+        self.assertIsInstance(pages[0], parse.UnknownPageType)
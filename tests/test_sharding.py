@@ -0,0 +1,101 @@
+"""Tests for splitting and rebalancing the shards of a database."""
+
+import json
+import os
+
+from crashes import db
+from tests import base
+
+
+class TestSharding(base.DatabaseTestCase):
+    def setUp(self):
+        super(TestSharding, self).setUp()
+        self.records = [
+            base.make_record(i, prefix=p)
+            for i, p in enumerate(["B8", "B9", "NDOR"] * 40)
+        ]
+
+    def _split_sharding(self):
+        return db.make_sharding(
+            by="prefix", length=2, prefixes=["NDOR"], max_size=2048)
+
+    def _listed_shards(self):
+        with open(os.path.join(self.tmpdir,
+                               "collisions-shards.json")) as shardfile:
+            listed = json.load(shardfile)
+        if isinstance(listed, dict):
+            return listed["shards"]
+        return listed
+
+    def assertReadable(self, database):
+        self.assertRecords(database, self.records)
+        for record in self.records:
+            self.assertEqual(
+                base.read_text(database[record["case_no"]]), record)
+
+    def test_no_split_by_default(self):
+        db.collisions.append_many(self.records)
+        self.assertEqual(sorted(self._listed_shards()), ["B8", "B9", "NDOR"])
+
+    def test_split(self):
+        self.init(sharding=self._split_sharding())
+        db.collisions.append_many(self.records)
+
+        shards = self._listed_shards()
+        self.assertNotIn("B9", shards)
+        self.assertIn("B9.0", shards)
+        for shard in shards:
+            self.assertTrue(
+                os.path.exists(
+                    os.path.join(self.tmpdir, "collisions-%s.json" % shard)))
+
+        self.init(sharding=self._split_sharding())
+        self.assertReadable(db.collisions)
+
+    def test_split_by_other_process(self):
+        db.collisions.append_many(self.records[:30])
+        other = db.collisions.using("json:")
+        self.assertEqual(len(other), 30)
+
+        self.init(sharding=self._split_sharding())
+        db.collisions.append_many(self.records[30:])
+        self.assertIn("B9.0", self._listed_shards())
+
+        # the other process still has the old list of shards, and
+        # picks up the split when it next reads them
+        self.assertReadable(other)
+        other.merge({"case_no": self.records[-1]["case_no"], "x": 1})
+        self.records[-1]["x"] = 1
+        self.init()
+        self.assertReadable(db.collisions)
+
+    def test_no_locks_for_missing_shards(self):
+        db.collisions.append_many(self.records)
+        with open(os.path.join(self.tmpdir, "collisions-shards.json"),
+                  "w") as shardfile:
+            json.dump(["B7", "B8", "B9", "NDOR"], shardfile)
+
+        self.init()
+        self.assertReadable(db.collisions)
+        db.collisions.merge({"case_no": self.records[0]["case_no"], "x": 1})
+        self.assertFalse(
+            os.path.exists(os.path.join(self.tmpdir, "collisions-B7.lock")))
+        self.assertFalse(
+            os.path.exists(os.path.join(self.tmpdir, "collisions-B7.json")))
+
+    def test_rebalance(self):
+        db.collisions.append_many(self.records)
+        old_shards = self._listed_shards()
+
+        sharding = db.make_sharding(by="hash", buckets=4)
+        self.init(sharding=sharding)
+        shards = db.collisions.rebalance()
+        self.assertEqual(len(shards), 4)
+        self.assertEqual(sorted(self._listed_shards()), sorted(shards))
+        for shard in old_shards:
+            self.assertFalse(
+                os.path.exists(
+                    os.path.join(self.tmpdir, "collisions-%s.json" % shard)))
+
+        self.init(sharding=sharding)
+        self.assertReadable(db.collisions)
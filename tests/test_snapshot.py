@@ -0,0 +1,83 @@
+"""Tests for reading read-only databases from snapshots."""
+
+import os
+
+from crashes import db
+from tests import base
+
+
+class TestSnapshot(base.DatabaseTestCase):
+    def setUp(self):
+        super(TestSnapshot, self).setUp()
+        self.records = [
+            base.make_record(i, prefix=p)
+            for i, p in enumerate(["B8", "B9", "NDOR"] * 10)
+        ]
+        db.collisions.append_many(self.records)
+        self.snapshot_path = os.path.join(self.tmpdir,
+                                          "collisions-snapshot.pickle")
+
+    def test_read(self):
+        self.init(read_only=True)
+        self.assertRecords(db.collisions, self.records)
+        self.assertTrue(os.path.exists(self.snapshot_path))
+
+        record = self.records[4]
+        self.assertEqual(
+            base.read_text(db.collisions[record["case_no"]]), record)
+        self.assertEqual(
+            [r["case_no"] for r in db.collisions.find(date=record["date"])],
+            [record["case_no"]])
+        self.assertEqual(
+            list(db.collisions.iter(fields=["case_no", "parsed"])), [{
+                "case_no":
+                r["case_no"],
+                "parsed":
+                True
+            } for r in db.collisions.using("json:")])
+        self.assertRaises(KeyError, db.collisions.__getitem__, "B9-999999")
+
+    def test_shards_released(self):
+        self.init(read_only=True)
+        self.assertRecords(db.collisions, self.records)
+        # only the snapshot holds the records
+        self.assertFalse(db.collisions.backend.loaded)
+
+    def test_release_keeps_unsaved_changes(self):
+        backend = db.collisions.backend
+        shard = backend.key_shard(self.records[0]["case_no"])
+        with db.collisions.delay_write():
+            db.collisions.merge({
+                "case_no": self.records[0]["case_no"],
+                "initials": "AB"
+            })
+            backend.release(shard)
+        self.init()
+        self.assertEqual(
+            db.collisions[self.records[0]["case_no"]]["initials"], "AB")
+
+    def test_changes_invalidate(self):
+        self.init(read_only=True)
+        self.assertRecords(db.collisions, self.records)
+
+        self.init()
+        record = self.records[1]
+        db.collisions.merge({"case_no": record["case_no"], "initials": "AB"})
+        record["initials"] = "AB"
+        db.collisions.append(base.make_record(100, prefix="B7"))
+        self.records.append(base.make_record(100, prefix="B7"))
+
+        self.init(read_only=True)
+        self.assertRecords(db.collisions, self.records)
+        self.assertEqual(db.collisions[record["case_no"]]["initials"], "AB")
+
+    def test_stream_skips_snapshot(self):
+        self.init(read_only=True)
+        self.assertRecords(db.collisions.iter(stream=True), self.records)
+        self.assertFalse(os.path.exists(self.snapshot_path))
+
+    def test_unreadable_snapshot(self):
+        with open(self.snapshot_path, "wb") as snapshot:
+            snapshot.write(b"not a pickle")
+        self.init(read_only=True)
+        self.assertRecords(db.collisions, self.records)
@@ -0,0 +1,28 @@
+"""Tests for the SQLite storage backend."""
+
+from crashes import db
+from tests import base
+
+
+class TestSQLite(base.DatabaseTestCase):
+    def setUp(self):
+        super(TestSQLite, self).setUp()
+        self.traffic = db.traffic.using("sqlite:///crashes.sqlite")
+
+    def test_insert_keeps_order(self):
+        expected = [{"count": 0}, {"count": 1}, {"count": 2}]
+        self.traffic.extend(expected)
+        # each insert halves the gap at the same spot, until there's
+        # no room left and the records are renumbered
+        for i in range(3, 100):
+            expected.insert(2, {"count": i})
+            self.traffic.insert(2, {"count": i})
+        expected.insert(0, {"count": 100})
+        self.traffic.insert(0, {"count": 100})
+
+        self.assertEqual(list(self.traffic), expected)
+        self.assertEqual([self.traffic[i] for i in range(len(expected))],
+                         expected)
+        self.traffic.sync()
+        self.assertEqual(list(db.traffic.using("sqlite:///crashes.sqlite")),
+                         expected)
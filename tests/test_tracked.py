@@ -0,0 +1,93 @@
+"""Tests for writing back only the changed fields of records."""
+
+from crashes import db
+from tests import base
+
+
+class TestTrackedRecord(base.DatabaseTestCase):
+    def setUp(self):
+        super(TestTrackedRecord, self).setUp()
+        self.records = [base.make_record(i) for i in range(10)]
+        db.collisions.append_many(self.records)
+        self.key = self.records[0]["case_no"]
+
+    def test_changes(self):
+        record = db.collisions[self.key]
+        self.assertIsInstance(record, db.TrackedRecord)
+        self.assertEqual(record.changes(), {})
+
+        record["initials"] = "AB"
+        record["parsed"] = False
+        self.assertEqual(record.changes(), {"initials": "AB", "parsed": False})
+
+        del record["date"]
+        self.assertIsNone(record.changes())
+
+    def test_changes_in_containers(self):
+        db.collisions.merge({"case_no": self.key, "tags": ["a"]})
+        record = db.collisions[self.key]
+        record["tags"].append("b")
+        self.assertEqual(record.changes(), {"tags": ["a", "b"]})
+        # the cached record isn't changed along with the copy
+        self.assertEqual(db.collisions[self.key]["tags"], ["a"])
+
+    def test_keeps_other_changes(self):
+        record = db.collisions[self.key]
+        other = db.collisions.using("json:")
+        other.merge({"case_no": self.key, "initials": "AB"})
+
+        record["parsed"] = False
+        db.collisions[self.key] = record
+
+        self.init()
+        saved = db.collisions[self.key]
+        self.assertEqual(saved["initials"], "AB")
+        self.assertFalse(saved["parsed"])
+
+    def test_removed_field(self):
+        record = db.collisions[self.key]
+        del record["date"]
+        db.collisions[self.key] = record
+
+        self.init()
+        self.assertNotIn("date", db.collisions[self.key])
+
+    def test_saved_again(self):
+        record = db.collisions[self.key]
+        record["initials"] = "AB"
+        db.collisions[self.key] = record
+        self.assertEqual(record.changes(), {})
+        record["initials"] = "CD"
+        db.collisions[self.key] = record
+
+        self.init()
+        self.assertEqual(db.collisions[self.key]["initials"], "CD")
+
+    def test_unchanged(self):
+        stamps = [
+            db.collisions.backend.shard_stamp(s)
+            for s in db.collisions.backend.shards()
+        ]
+        db.collisions[self.key] = db.collisions[self.key]
+        self.assertEqual([
+            db.collisions.backend.shard_stamp(s)
+            for s in db.collisions.backend.shards()
+        ], stamps)
+
+    def test_inline_text_moved_out(self):
+        # write a record the way they were written before text was
+        # kept out of line
+        record = base.make_record(100)
+        db.collisions.backend.append(db.collisions.codec.encode(record))
+        db.collisions.sync()
+
+        tracked = db.collisions[record["case_no"]]
+        tracked["initials"] = "AB"
+        db.collisions[record["case_no"]] = tracked
+        record["initials"] = "AB"
+
+        self.init()
+        stored = db.collisions.backend.fetch(record["case_no"])
+        self.assertTrue(stored["report"].startswith("{BlobSerializer}"))
+        self.assertEqual(
+            base.read_text(db.collisions[record["case_no"]]), record)